@@ -1,76 +1,114 @@
-import boto3
+import argparse
 import cv2
+import hashlib
 import numpy as np
 import os
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-# Load environment variables
-BUCKET_NAME = os.getenv('WEBCAMTIMELAPSE_BUCKET_NAME')
-if not BUCKET_NAME:
-    raise ValueError("No BUCKET_NAME environment variable set")
-    
+import subprocess
+import sys
+import time
+import traceback
+from collections import deque
+from itertools import groupby
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from downloader import Downloader
+from frame_index import frame_index_from_env
+from s3_layout import is_frame_key, latest_frames, list_frames
+from storage import storage_from_env
+
 LOCAL_IMAGE_DIR = './images'
 TIMELAPSE_VIDEO_PATH = './timelapse.mp4'
+DOWNLOAD_CONCURRENCY = 32 # Parallel downloads, also the connection pool size
 FRAME_RATE = 30 # FPS
 OUTPUT_VIDEO_DURATION = 200 # Seconds
 
-def list_images_in_s3(bucket_name):
-    s3 = boto3.client('s3')
-    images = []
-    continuation_token = None
+# Streaming assembly: frames go storage -> memory -> decode -> ffmpeg stdin, nothing
+# is staged on disk and the video is only encoded once
+STREAM_ASSEMBLY = True
+STREAM_WORKERS = 16 # Concurrent fetch + decode tasks
+REORDER_BUFFER_SIZE = 64 # Frames in flight, bounds memory use
 
-    # Only retrieve the latest (roughtly) frame_rate*duration number of images
-    while True:
-        if continuation_token:
-            response = s3.list_objects_v2(Bucket=bucket_name, ContinuationToken=continuation_token)
-        else:
-            response = s3.list_objects_v2(Bucket=bucket_name)
+# Incremental assembly: each UTC hour is encoded once into a cached segment and
+# the video is a stream copy concat of the segments, so a rebuild only encodes
+# hours whose frame list changed (the open hour and the window's first hour)
+INCREMENTAL_ASSEMBLY = True
+SEGMENT_DIR = './segments'
+ENCODER_ARGS = ['-c:v', 'libx264', '-crf', '23', '-preset', 'fast', '-pix_fmt', 'yuv420p']
+
+# Exit codes
+EXIT_OK = 0
+EXIT_NO_IMAGES = 1
+EXIT_CANCELLED = 2
+EXIT_FAILED = 3
 
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                images.append((obj['Key'], obj['LastModified']))
+DAEMON_INTERVAL = 3600 # Seconds between rebuilds in --daemon mode
 
-        if response.get('IsTruncated'):  # Check if there are more objects to retrieve
-            continuation_token = response.get('NextContinuationToken')
-        else:
-            break
+# S3, MinIO or a local directory, see storage.py. The client behind it is
+# shared, so daemon rebuilds reuse its connections.
+storage = storage_from_env(max_pool_connections=max(DOWNLOAD_CONCURRENCY, STREAM_WORKERS), max_attempts=5, retry_mode='adaptive')
+
+# Kept warm across daemon rebuilds
+_downloader = None
+
+def list_images(storage, count=FRAME_RATE*OUTPUT_VIDEO_DURATION, since=None, until=None, session_id=None, step=1):
+    # timelapse.db indexes every uploaded frame, when it's here that's a
+    # single local query
+    frame_index = frame_index_from_env()
+    if frame_index is not None:
+        try:
+            frames = frame_index.latest(count, since=since, until=until, session_id=session_id, step=step)
+        finally:
+            frame_index.close()
+        if frames:
+            return [(frame.key, frame.captured_utc) for frame in reversed(frames)]
+    if session_id is not None:
+        print("Sessions are only known to timelapse.db, no frames found for that session")
+        return []
+
+    # The hour/day manifests already list the frames, one GET per day
+    count *= step
+    if since is not None:
+        frames = list_frames(storage, since, until or datetime.now(timezone.utc) + timedelta(hours=1))[-count:]
+    else:
+        frames = latest_frames(storage, count, until=until)
+    if frames:
+        images = [(frame['key'], datetime.fromisoformat(frame['timestamp'])) for frame in frames]
+        images.sort(key=lambda x: x[1], reverse=True)
+        return images[::step]
+
+    # Bucket hasn't been migrated to the partitioned layout yet (see
+    # migrate_s3_keys.py), list everything
+    images = []
+    for obj in storage.list_range():
+        if not is_frame_key(obj.key):
+            continue
+        if (since and obj.last_modified < since) or (until and obj.last_modified >= until):
+            continue
+        images.append((obj.key, obj.last_modified))
 
     # Sort the images by last modified time in descending order
     images.sort(key=lambda x: x[1], reverse=True)
 
     # Return only the latest frame_rate*duration number of images
-    images = images[:FRAME_RATE*OUTPUT_VIDEO_DURATION]
+    images = images[:count:step]
 
     return images
 
-def download_image(s3, bucket_name, image_key, local_dir):
-    local_path = os.path.join(local_dir, os.path.basename(image_key))
-    if not image_exists_localy(image_key, local_dir):
-        s3.download_file(bucket_name, image_key, local_path)
-        print(f"Downloaded {image_key} to {local_path}")
-    else:
-        print(f"Skipped {image_key}, already exists at {local_path}")
-
-def image_exists_localy(image_key, local_dir):
-    local_path = os.path.join(local_dir, os.path.basename(image_key))
-    return os.path.exists(local_path)
+def get_downloader(storage, local_dir):
+    global _downloader
+    if _downloader is None:
+        _downloader = Downloader(storage, local_dir, concurrency=DOWNLOAD_CONCURRENCY)
+    return _downloader
 
 def filter_already_downloaded_images(images, local_dir):
-    new_images = [(image_key, last_modified) for image_key, last_modified in images if not image_exists_localy(image_key, local_dir)]
-    old_images = [(image_key, last_modified) for image_key, last_modified in images if image_exists_localy(image_key, local_dir)]
-    return new_images, old_images
+    # One lookup per key in the local cache index, no filesystem stats
+    return get_downloader(storage, local_dir).filter_cached(images)
 
 
-def download_images(bucket_name, images, local_dir):
-    s3 = boto3.client('s3')
-    if not os.path.exists(local_dir):
-        os.makedirs(local_dir)
-    
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(download_image, s3, bucket_name, image_key, local_dir) for image_key, _ in images]
-        for future in as_completed(futures):
-            future.result()
+def download_images(storage, images, local_dir):
+    failed = get_downloader(storage, local_dir).download_all(images)
+    if failed:
+        print(f"{len(failed)} images could not be downloaded and will be skipped")
 
 def create_timelapse_video(local_dir, images, video_path, frame_rate):
     images = sorted(images, key=lambda x: x[1])
@@ -90,6 +128,9 @@ def create_timelapse_video(local_dir, images, video_path, frame_rate):
     for image_key, _ in images:
         image_path = os.path.join(local_dir, os.path.basename(image_key))
         frame = cv2.imread(image_path)
+        if frame is None:
+            print(f"Skipped {image_path}, not downloaded")
+            continue
         video.write(frame)
         print(f"Added {image_path} to the video.")
 
@@ -104,39 +145,250 @@ def create_timelapse_video(local_dir, images, video_path, frame_rate):
     os.remove(video_path)
     print(f"Original video deleted: {video_path}")
 
-def main():
-    print("Listing images in S3 bucket...")
-    images = list_images_in_s3(BUCKET_NAME)
+def fetch_and_decode_image(storage, image_key):
+    # Frames already in the local cache don't need another GET
+    cache = get_downloader(storage, LOCAL_IMAGE_DIR).cache
+    if image_key in cache:
+        frame = cv2.imread(cache.path_for(image_key))
+        if frame is not None:
+            return frame
 
-    # trim images
-    # get last (output_video_length*frame_rate) images
-    images = images[-OUTPUT_VIDEO_DURATION*FRAME_RATE:]
+    body = storage.get(image_key).data
+    # imdecode releases the GIL, so decoding runs in parallel across the pool
+    frame = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise IOError(f"Failed to decode {image_key}")
+    return frame
 
-    images, filteredOutImages  = filter_already_downloaded_images(images, LOCAL_IMAGE_DIR)
+def open_ffmpeg_encoder(video_path, width, height, frame_rate, encoder_args=ENCODER_ARGS):
+    # Raw BGR frames on stdin, one encode straight to the web optimized file
+    command = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(frame_rate),
+        '-i', '-',
+        *encoder_args,
+        # The index up front so browsers can start playing before the download ends (MP4 only)
+        *(['-movflags', '+faststart'] if video_path.endswith('.mp4') else []),
+        video_path,
+    ]
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
 
-    if images:
-        start_time = images[-1][1].strftime('%Y-%m-%d %H:%M:%S')
-        end_time = images[-0][1].strftime('%Y-%m-%d %H:%M:%S')
-    else:
-        print(f"No images available in the S3 bucket {BUCKET_NAME}.")
+def stream_timelapse_video(storage, images, video_path, frame_rate, workers=STREAM_WORKERS, buffer_size=REORDER_BUFFER_SIZE,
+                           decode=None, width=None, encoder_args=ENCODER_ARGS, on_frame=None):
+    """Fetch, decode and encode `images` in timestamp order, returns the number of frames written.
+
+    `decode(key)` returns a BGR frame, fetch_and_decode_image by default.
+    With `width` every frame is scaled to that width, otherwise to the size
+    of the first one. `on_frame(written)` is called after each frame.
+    """
+    images = sorted(images, key=lambda x: x[1])
+    if not images:
+        print("No images found.")
+        return 0
+    if decode is None:
+        decode = lambda image_key: fetch_and_decode_image(storage, image_key)
+
+    encoder = None
+    size = None
+    written = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Futures are kept in timestamp order; only buffer_size are in flight
+        # so frames that finish early wait in a bounded reorder window
+        pending = deque()
+        keys = iter(images)
+
+        def submit_next():
+            image = next(keys, None)
+            if image is not None:
+                pending.append((image[0], executor.submit(decode, image[0])))
+
+        for _ in range(buffer_size):
+            submit_next()
+
+        try:
+            while pending:
+                image_key, future = pending.popleft()
+                submit_next()
+
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    print(f"Skipped {image_key}: {e}")
+                    continue
+
+                if encoder is None:
+                    if width:
+                        # yuv420p needs even dimensions
+                        size = (width // 2 * 2, max(2, round(frame.shape[0] * width / frame.shape[1] / 2) * 2))
+                    else:
+                        size = (frame.shape[1], frame.shape[0])
+                    encoder = open_ffmpeg_encoder(video_path, size[0], size[1], frame_rate, encoder_args)
+                if (frame.shape[1], frame.shape[0]) != size:
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+                encoder.stdin.write(frame.tobytes())
+                written += 1
+                if on_frame is not None:
+                    on_frame(written)
+        finally:
+            # Don't leave queued fetches running if encoding failed
+            for _, future in pending:
+                future.cancel()
+            if encoder is not None:
+                encoder.stdin.close()
+                encoder.wait()
+
+    if encoder is None or encoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to create {video_path}")
+    print(f"Timelapse video with {written} frames streamed to {video_path}")
+    return written
 
+def group_into_segments(images):
+    images = sorted(images, key=lambda x: x[1])
+    return [list(segment) for _, segment in groupby(images, key=lambda x: x[1].replace(minute=0, second=0, microsecond=0))]
+
+def segment_path(segment_images, frame_rate):
+    # Keyed by everything that affects the encoded bytes, a segment is only
+    # rendered again when its frames or the encoder settings change
+    digest = hashlib.sha1()
+    digest.update(f"{frame_rate}|{' '.join(ENCODER_ARGS)}".encode())
+    for image_key, _ in segment_images:
+        digest.update(b'\n' + image_key.encode())
+    return os.path.join(SEGMENT_DIR, f"{digest.hexdigest()}.mp4")
+
+def concat_segments(segment_paths, video_path):
+    list_path = os.path.join(SEGMENT_DIR, 'concat.txt')
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+
+    # Every segment is its own encode with identical settings, so each starts
+    # on a keyframe and they can be joined without re-encoding
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', '-movflags', '+faststart', video_path]
+    subprocess.run(command, check=True)
+    os.remove(list_path)
+
+def render_timelapse_incremental(storage, images, video_path, frame_rate):
+    os.makedirs(SEGMENT_DIR, exist_ok=True)
+
+    segment_paths = []
+    rendered = 0
+    for segment_images in group_into_segments(images):
+        path = segment_path(segment_images, frame_rate)
+        if not os.path.exists(path):
+            # Render next to the final name so an interrupted run leaves no half segment
+            partial_path = path.replace('.mp4', '.part.mp4')
+            stream_timelapse_video(storage, segment_images, partial_path, frame_rate)
+            os.replace(partial_path, path)
+            rendered += 1
+        segment_paths.append(path)
+
+    if not segment_paths:
+        print("No images found.")
+        return
+
+    concat_segments(segment_paths, video_path)
+    print(f"Timelapse video from {len(segment_paths)} segments ({rendered} rendered, {len(segment_paths) - rendered} cached) at {video_path}")
+
+    # Segments that fell out of the window won't be used again
+    keep = {os.path.basename(path) for path in segment_paths}
+    for name in os.listdir(SEGMENT_DIR):
+        if name.endswith('.mp4') and name not in keep:
+            os.remove(os.path.join(SEGMENT_DIR, name))
+
+def parse_time(value):
+    # Naive times are taken as UTC, like the frame keys
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble a timelapse video from the stored frames.")
+    parser.add_argument('--since', type=parse_time, help="Only frames captured at or after this time (ISO 8601, UTC if no offset)")
+    parser.add_argument('--until', type=parse_time, help="Only frames captured before this time (ISO 8601, UTC if no offset)")
+    parser.add_argument('--fps', type=int, default=FRAME_RATE, help="Output frame rate")
+    parser.add_argument('--duration', type=int, default=OUTPUT_VIDEO_DURATION, help="Output length in seconds, uses the newest fps*duration frames")
+    parser.add_argument('--step', type=int, default=1, help="Use every Nth frame, covers N times as long at the same length")
+    parser.add_argument('--session', type=int, help="Only frames from this timelapse session (needs timelapse.db)")
+    parser.add_argument('--output', default=TIMELAPSE_VIDEO_PATH.replace('.mp4', '_optimized.mp4'), help="Output video path")
+    parser.add_argument('--mode', choices=['incremental', 'stream', 'download'],
+                        default='incremental' if INCREMENTAL_ASSEMBLY else 'stream' if STREAM_ASSEMBLY else 'download')
+    parser.add_argument('-y', '--yes', action='store_true', help="Don't ask for confirmation")
+    parser.add_argument('--daemon', action='store_true', help="Rebuild the video every --interval seconds")
+    parser.add_argument('--interval', type=int, default=DAEMON_INTERVAL, help="Seconds between rebuilds in daemon mode")
+    return parser.parse_args(argv)
 
-    inputQuestion = f"""
-Filtered out \033[41m{len(filteredOutImages)}\033[0m images that were already downloaded.
-\033[42m{len(images)}\033[0m images to download. \n
+def build_timelapse(args):
+    print(f"Listing images in {storage}...")
+    images = list_images(storage, count=args.fps*args.duration, since=args.since, until=args.until, session_id=args.session, step=args.step)
+    if not images:
+        print(f"No images available in {storage}.")
+        return EXIT_NO_IMAGES
+
+    new_images, cached_images = filter_already_downloaded_images(images, LOCAL_IMAGE_DIR)
+    start_time = images[-1][1].strftime('%Y-%m-%d %H:%M:%S')
+    end_time = images[0][1].strftime('%Y-%m-%d %H:%M:%S')
+
+    if not args.yes:
+        inputQuestion = f"""
+Filtered out \033[41m{len(cached_images)}\033[0m images that were already downloaded.
+\033[42m{len(new_images)}\033[0m images to download. \n
 \033[44m{start_time}\033[0m to \033[44m{end_time}\033[0m \n
 Do you want to continue? (y/n):"""
 
-    user_input = input(inputQuestion)
+        if input(inputQuestion).lower() != "y":
+            print("Timelapse creation cancelled.")
+            return EXIT_CANCELLED
+    else:
+        print(f"{len(images)} images from {start_time} to {end_time}, {len(cached_images)} cached locally")
 
-    if user_input.lower() == "y":
-        print("Downloading images from S3...")
-        download_images(BUCKET_NAME, images, LOCAL_IMAGE_DIR)
+    if args.mode == 'incremental':
+        print("Rendering changed segments and joining them...")
+        render_timelapse_incremental(storage, images, args.output, args.fps)
+    elif args.mode == 'stream':
+        print("Streaming images into ffmpeg...")
+        stream_timelapse_video(storage, images, args.output, args.fps)
+    else:
+        print("Downloading images...")
+        download_images(storage, new_images, LOCAL_IMAGE_DIR)
 
         print("Creating timelapse video...")
-        create_timelapse_video(LOCAL_IMAGE_DIR, images, TIMELAPSE_VIDEO_PATH, FRAME_RATE)
-    else:
-        print("Timelapse creation cancelled.")
+        create_timelapse_video(LOCAL_IMAGE_DIR, images, args.output.replace('_optimized.mp4', '.mp4'), args.fps)
+
+    return EXIT_OK
+
+def run_daemon(args):
+    # The storage client, local cache index and segment cache stay warm between
+    # rebuilds, so each one only pays for the frames that arrived since
+    print(f"Rebuilding {args.output} every {args.interval}s")
+    while True:
+        started = time.monotonic()
+        try:
+            exit_code = build_timelapse(args)
+            print(f"[{datetime.now(timezone.utc).isoformat()}] Rebuild finished with exit code {exit_code}")
+        except Exception as e:
+            print(f"[{datetime.now(timezone.utc).isoformat()}] Rebuild failed: {e}")
+            traceback.print_exc()
+
+        time.sleep(max(0, args.interval - (time.monotonic() - started)))
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.daemon:
+        args.yes = True
+        try:
+            run_daemon(args)
+        except KeyboardInterrupt:
+            print("Daemon stopped.")
+        return EXIT_OK
+
+    try:
+        return build_timelapse(args)
+    except Exception as e:
+        print(f"Timelapse creation failed: {e}")
+        traceback.print_exc()
+        return EXIT_FAILED
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
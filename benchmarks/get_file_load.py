@@ -0,0 +1,146 @@
+# Load test for /get-file: starts a moto S3 server as a local stand-in for the
+# bucket, seeds it with frames, serves the API on a local port and hits it
+# with concurrent clients that mostly ask for the newest frames, like viewers
+# following the live image do. Reports throughput and latency percentiles per
+# concurrency level, and exits 1 if any response failed or came back with the
+# wrong body. Needs moto: pip install "moto[server]"
+#
+#   python benchmarks/get_file_load.py --clients 50 --clients 200 --requests 4000
+import argparse
+import http.client
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time as time_module
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+import boto3
+from moto.server import ThreadedMotoServer
+from werkzeug.serving import make_server
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'website', 'api_server'))
+from s3_layout import frame_key
+
+BUCKET_NAME = 'get-file-benchmark'
+S3_PORT = 5055
+API_PORT = 5056
+
+
+def seed(s3, frames, frame_bytes):
+    # One frame a minute up to now, newest last
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    keys = [frame_key(now - timedelta(minutes=i)) for i in range(frames)][::-1]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=os.urandom(frame_bytes), ContentType='image/jpeg')
+    return keys
+
+
+def pick_key(keys, newest_share):
+    # Most viewers sit on the live frame, the rest scrub through the history
+    if random.random() < newest_share:
+        return keys[-1 - int(random.expovariate(1.0))] if len(keys) > 5 else keys[-1]
+    return random.choice(keys)
+
+
+def run(keys, clients, requests, newest_share, frame_bytes):
+    local = threading.local()
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def fetch(_):
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection('127.0.0.1', API_PORT, timeout=60)
+        started = time_module.perf_counter()
+        try:
+            conn.request('GET', '/get-file?' + urlencode({'file_key': pick_key(keys, newest_share)}))
+            response = conn.getresponse()
+            body = response.read()
+            if response.status != 200 or len(body) != frame_bytes:
+                status = f'bad {response.status}'
+            else:
+                status = response.getheader('X-Cache') or str(response.status)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            local.conn = None
+            status = 'error'
+        elapsed = time_module.perf_counter() - started
+        with lock:
+            statuses[status] += 1
+        return elapsed
+
+    started = time_module.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = sorted(executor.map(fetch, range(requests)))
+    duration = time_module.perf_counter() - started
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(f"{clients:4} clients  {requests / duration:8.1f} req/s  p50 {percentile(0.5):7.1f} ms  "
+          f"p99 {percentile(0.99):7.1f} ms  max {latencies[-1] * 1000:7.1f} ms  {dict(statuses)}")
+    return sum(count for status, count in statuses.items() if status == 'error' or status.startswith('bad'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /get-file against a local S3 stand-in.")
+    parser.add_argument('--clients', type=int, action='append', help="Concurrent clients, repeatable (default 50 and 200)")
+    parser.add_argument('--requests', type=int, default=4000, help="Requests per concurrency level")
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--frame-bytes', type=int, default=400_000)
+    parser.add_argument('--newest-share', type=float, default=0.8, help="Share of requests for the newest few frames")
+    parser.add_argument('--hot-frames', type=int, default=64, help="WEBCAMTIMELAPSE_HOT_FRAMES, 0 turns the memory cache off")
+    args = parser.parse_args()
+
+    # Both servers log every request otherwise
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    s3_server = ThreadedMotoServer(port=S3_PORT, verbose=False)
+    s3_server.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        endpoint = f'http://127.0.0.1:{S3_PORT}'
+        os.environ.update({
+            'WEBCAMTIMELAPSE_STORAGE': 'minio',
+            'WEBCAMTIMELAPSE_BUCKET_NAME': BUCKET_NAME,
+            'WEBCAMTIMELAPSE_STORAGE_ENDPOINT': endpoint,
+            'WEBCAMTIMELAPSE_STORAGE_ACCESS_KEY': 'testing',
+            'WEBCAMTIMELAPSE_STORAGE_SECRET_KEY': 'testing',
+            'WEBCAMTIMELAPSE_CACHE_DIR': os.path.join(tmp, 'cache'),
+            'WEBCAMTIMELAPSE_HOT_FRAMES': str(args.hot_frames),
+            'WEBCAMTIMELAPSE_DB_PATH': os.path.join(tmp, 'missing.db'),
+            'AWS_DEFAULT_REGION': 'us-east-1',
+        })
+        s3 = boto3.client('s3', endpoint_url=endpoint, aws_access_key_id='testing', aws_secret_access_key='testing')
+        s3.create_bucket(Bucket=BUCKET_NAME)
+        keys = seed(s3, args.frames, args.frame_bytes)
+        print(f"Seeded {len(keys)} frames of {args.frame_bytes} bytes")
+
+        # Imported late, the server reads its configuration from the environment
+        import server
+        api_server = make_server('127.0.0.1', API_PORT, server.app, threaded=True)
+        threading.Thread(target=api_server.serve_forever, daemon=True).start()
+        failed = 0
+        try:
+            for clients in args.clients or [50, 200]:
+                failed += run(keys, clients, args.requests, args.newest_share, args.frame_bytes)
+            cache = server.rendition_cache
+            print(f"Disk cache: {cache.hits} hits, {cache.misses} misses, {cache.coalesced} coalesced; "
+                  f"memory cache: {server.hot_cache.hits} hits")
+        finally:
+            api_server.shutdown()
+            s3_server.stop()
+
+    if failed:
+        print(f"{failed} requests failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
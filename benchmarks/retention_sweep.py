@@ -0,0 +1,93 @@
+# Seeds a mocked S3 bucket and a scratch frames table, then times a retention
+# sweep. Needs moto: pip install "moto[s3]". What a sweep deletes is checked
+# by tests/test_retention.py, this only times it.
+#
+#   python benchmarks/retention_sweep.py --objects 100000
+import argparse
+import os
+import sys
+import tempfile
+import time as time_module
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from database import connect, format_utc, initialize_schema
+from retention import delete_expired_frames
+from storage import S3Storage
+
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto < 5
+    from moto import mock_s3 as mock_aws
+
+BUCKET_NAME = 'retention-benchmark'
+
+
+def seed(s3, conn, count, span_hours):
+    # Frames spread evenly over span_hours, newest first
+    now = datetime.now(timezone.utc)
+    step = timedelta(hours=span_hours) / count
+    rows = []
+    for i in range(count):
+        captured = now - step * i
+        key = captured.strftime('%Y_%m_%d_%H_%M_%S_%f') + '.jpg'
+        s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=b'')
+        rows.append((captured.astimezone().replace(tzinfo=None), key, format_utc(captured)))
+
+    conn.executemany('INSERT INTO frames (timestamp, s3_key, captured_utc) VALUES (?, ?, ?)', rows)
+    conn.commit()
+
+
+def count_objects(s3):
+    paginator = s3.get_paginator('list_objects_v2')
+    return sum(page.get('KeyCount', 0) for page in paginator.paginate(Bucket=BUCKET_NAME))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=100000)
+    parser.add_argument('--span-hours', type=float, default=336, help="Age of the oldest seeded frame")
+    parser.add_argument('--retention-hours', type=float, default=168)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'timelapse.db')
+        conn = connect(db_path)
+        initialize_schema(conn)
+
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET_NAME)
+        storage = S3Storage(BUCKET_NAME, client=s3)
+
+        seed_start = time_module.perf_counter()
+        seed(s3, conn, args.objects, args.span_hours)
+        print(f"Seeded {args.objects} objects in {time_module.perf_counter() - seed_start:.1f}s")
+
+        sweep_start = time_module.perf_counter()
+        deleted = delete_expired_frames(storage, args.retention_hours, db_path)
+        sweep_duration = time_module.perf_counter() - sweep_start
+        print(f"First sweep: deleted {deleted} objects in {sweep_duration:.2f}s")
+
+        # A second sweep right after should find nothing and cost next to nothing
+        sweep_start = time_module.perf_counter()
+        deleted_again = delete_expired_frames(storage, args.retention_hours, db_path)
+        print(f"Second sweep: deleted {deleted_again} objects in {time_module.perf_counter() - sweep_start:.4f}s")
+
+        remaining = count_objects(s3)
+        expected = args.objects - deleted
+        print(f"Remaining objects: {remaining} (expected {expected})")
+        conn.close()
+
+        if remaining != expected or deleted_again:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
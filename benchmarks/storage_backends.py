@@ -0,0 +1,68 @@
+# Times the storage operations the pipeline uses (frame PUTs, manifest
+# listing by hour, full and ranged GETs, batch deletes) against a backend.
+# Defaults to a scratch local directory, so it runs offline; set
+# WEBCAMTIMELAPSE_STORAGE (see storage.py) to point it at S3 or MinIO.
+#
+#   python benchmarks/storage_backends.py --frames 2000 --frame-bytes 400000
+import argparse
+import os
+import sys
+import tempfile
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from s3_layout import FRAMES_PREFIX, floor_hour, frame_key
+from storage import LocalStorage, storage_from_env
+
+
+def timed(label, count, run):
+    started = time_module.perf_counter()
+    result = run()
+    elapsed = time_module.perf_counter() - started
+    print(f"{label:28} {elapsed:8.3f}s  {elapsed / max(count, 1) * 1000:8.3f} ms/op  ({count} ops)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a storage backend.")
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--frame-bytes', type=int, default=400_000, help="Size of each fake frame")
+    parser.add_argument('--interval', type=float, default=30, help="Seconds between fake frames")
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if 'WEBCAMTIMELAPSE_STORAGE' in os.environ:
+            storage = storage_from_env(max_pool_connections=args.workers)
+        else:
+            storage = LocalStorage(os.path.join(tmp, 'storage'))
+        print(f"Storage: {storage}")
+
+        start = floor_hour(datetime.now(timezone.utc)) - timedelta(seconds=args.interval * args.frames)
+        keys = [frame_key(start + timedelta(seconds=args.interval * i)) for i in range(args.frames)]
+        body = os.urandom(args.frame_bytes)
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            timed("put", len(keys), lambda: list(executor.map(lambda key: storage.put(key, body, 'image/jpeg'), keys)))
+
+            listed = timed("list_range (all frames)", 1, lambda: list(storage.list_range(FRAMES_PREFIX)))
+            hour_prefix = keys[len(keys) // 2].rsplit('/', 1)[0] + '/'
+            in_hour = timed("list_range (one hour)", 1, lambda: list(storage.list_range(hour_prefix)))
+            timed("list_range (start_after)", 1, lambda: list(storage.list_range(FRAMES_PREFIX, start_after=keys[-10])))
+
+            sample = keys[::max(1, len(keys) // 200)]
+            timed("get", len(sample), lambda: list(executor.map(storage.get, sample)))
+            timed("get (first 64 KiB)", len(sample), lambda: list(executor.map(lambda key: storage.get(key, (0, 65535)), sample)))
+            timed("head", len(sample), lambda: list(executor.map(storage.head, sample)))
+
+            failed = timed("delete_batch", len(keys), lambda: storage.delete_batch(keys))
+
+        print(f"Listed {len(listed)} frames, {len(in_hour)} in {hour_prefix}, {len(failed)} failed deletes")
+        if len(listed) != len(keys) or failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
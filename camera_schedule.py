@@ -0,0 +1,115 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+SECONDS_PER_DAY = 24 * 3600
+
+
+def sun_times(day, latitude, longitude):
+    """Sunrise and sunset (UTC datetimes) for a date, NOAA's approximation.
+
+    Accurate to a couple of minutes and needs no network. When the sun never
+    sets the result is ('day', 'day'), when it never rises ('night', 'night').
+    """
+    gamma = 2 * math.pi / 365 * (day.timetuple().tm_yday - 1)
+
+    # Equation of time (minutes) and solar declination (radians)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+                       - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+    decl = (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma)
+            - 0.006758 * math.cos(2 * gamma) + 0.000907 * math.sin(2 * gamma)
+            - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+
+    # 90.833 degrees accounts for refraction and the size of the solar disc
+    lat = math.radians(latitude)
+    cos_ha = math.cos(math.radians(90.833)) / (math.cos(lat) * math.cos(decl)) - math.tan(lat) * math.tan(decl)
+    if cos_ha > 1:
+        return 'night', 'night'
+    if cos_ha < -1:
+        return 'day', 'day'
+    ha = math.degrees(math.acos(cos_ha))
+
+    midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    sunrise = midnight + timedelta(minutes=720 - 4 * (longitude + ha) - eqtime)
+    sunset = midnight + timedelta(minutes=720 - 4 * (longitude - ha) - eqtime)
+    return sunrise, sunset
+
+
+def seconds_since_midnight(moment):
+    return moment.hour * 3600 + moment.minute * 60 + moment.second
+
+
+def day_weights(sunrise_seconds, sunset_seconds, transition_seconds, resolution):
+    """0 at night, 1 during the day, with sine ramps centred on sunrise/sunset.
+
+    Same curve as the original calculate_brightness: each ramp runs from one
+    transition before to one transition after the event.
+    """
+    seconds = np.arange(0, SECONDS_PER_DAY, resolution, dtype=np.float64)
+
+    def ramp(center):
+        progress = np.clip((seconds - (center - transition_seconds)) / (2 * transition_seconds), 0, 1)
+        return 0.5 * (1 + np.sin(np.pi * (progress - 0.5)))
+
+    return ramp(sunrise_seconds) - ramp(sunset_seconds)
+
+
+class CameraSchedule:
+    """Per-day lookup table of camera property targets.
+
+    `targets` maps a property name (BRIGHTNESS, GAIN, EXPOSURE, ...) to a
+    {'day': value, 'night': value} pair. The table holds one row per
+    `resolution` seconds and is rebuilt only when the configuration changes
+    or the date rolls over, so `lookup` is an index into a NumPy array.
+    """
+
+    def __init__(self, tz, resolution=60):
+        self.tz = tz
+        self.resolution = resolution
+        self._config = None
+        self._built_for = None
+        self._tables = {}
+
+    def configure(self, targets, sunrise=None, sunset=None, latitude=None, longitude=None, transition_seconds=3600):
+        # Hashable snapshot so an unchanged config doesn't trigger a rebuild
+        self._config = (
+            tuple(sorted((name, value['day'], value['night']) for name, value in targets.items())),
+            sunrise, sunset, latitude, longitude, transition_seconds,
+        )
+
+    def _sun_seconds(self, day):
+        _, sunrise, sunset, latitude, longitude, _ = self._config
+        if latitude is None or longitude is None:
+            return seconds_since_midnight(sunrise), seconds_since_midnight(sunset)
+
+        sunrise_utc, sunset_utc = sun_times(day, latitude, longitude)
+        if sunrise_utc in ('day', 'night'):
+            return sunrise_utc, sunset_utc
+        return (seconds_since_midnight(sunrise_utc.astimezone(self.tz)),
+                seconds_since_midnight(sunset_utc.astimezone(self.tz)))
+
+    def _build(self, day):
+        targets, _, _, _, _, transition_seconds = self._config
+        sunrise_seconds, sunset_seconds = self._sun_seconds(day)
+
+        if sunrise_seconds == 'day':
+            weights = np.ones(SECONDS_PER_DAY // self.resolution)
+        elif sunrise_seconds == 'night':
+            weights = np.zeros(SECONDS_PER_DAY // self.resolution)
+        else:
+            weights = day_weights(sunrise_seconds, sunset_seconds, transition_seconds, self.resolution)
+
+        self._tables = {name: night + (day_value - night) * weights for name, day_value, night in targets}
+        self._built_for = (self._config, day)
+
+    def lookup(self, now):
+        """Targets for `now` (aware, or naive in the schedule's time zone)."""
+        if now.tzinfo is not None:
+            now = now.astimezone(self.tz)
+
+        if self._built_for != (self._config, now.date()):
+            self._build(now.date())
+
+        index = seconds_since_midnight(now) // self.resolution
+        return {name: float(table[index]) for name, table in self._tables.items()}
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time as time_module
+import traceback
+from dataclasses import dataclass
+from datetime import datetime
+
+from assemble_timelapse import stream_timelapse_video
+
+# Timelapse clips rendered on request by the web API. Jobs wait in a bounded
+# queue for a small pool of render threads; each job streams its frames
+# through the assembler's fetch/decode/ffmpeg pipeline into a DiskCache, keyed
+# by a hash of the parameters and the exact frames, so asking again for the
+# same clip (while it renders or after) never renders it twice.
+#
+# API workers are separate processes sharing the cache directory. Each job's
+# state is also written to jobs/<id>.json in it, so whichever worker a poll
+# lands on can answer it and serve the finished clip. The worker that renders
+# a clip first claims it by creating jobs/<id>.claim, which only one can do;
+# the others hand out that worker's job.
+
+# extension, content type, ffmpeg encoder arguments
+CLIP_FORMATS = {
+    'mp4': ('.mp4', 'video/mp4', ['-c:v', 'libx264', '-crf', '23', '-preset', 'fast', '-pix_fmt', 'yuv420p']),
+    'webm': ('.webm', 'video/webm', ['-c:v', 'libvpx-vp9', '-crf', '33', '-b:v', '0', '-deadline', 'realtime', '-cpu-used', '8',
+                                     '-row-mt', '1', '-pix_fmt', 'yuv420p']),
+}
+MAX_CLIP_FRAMES = 10000
+# Finished jobs are forgotten after this, their clips stay in the cache
+JOB_TTL = 3600
+# Seconds between writes of a running job's progress to its state file
+PROGRESS_INTERVAL = 1
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+@dataclass(frozen=True)
+class ClipParams:
+    since: datetime
+    until: datetime
+    fps: int = 30
+    width: int = 1280
+    video_format: str = 'mp4'
+    step: int = 1
+    session_id: int = None
+
+
+def clip_id(params, keys):
+    # Everything that changes the output; a range that's still filling up gets a new id per new frame
+    digest = hashlib.sha1()
+    digest.update(f"{params}|{' '.join(CLIP_FORMATS[params.video_format][2])}".encode())
+    for key in keys:
+        digest.update(b'\n' + key.encode())
+    return digest.hexdigest()
+
+
+@dataclass
+class ClipJob:
+    id: str
+    video_format: str
+    # None for jobs of another worker, read back from their state file
+    params: ClipParams
+    keys: list
+    frames: int
+    status: str = QUEUED
+    written: int = 0
+    error: str = None
+    finished_at: float = None
+
+    @property
+    def name(self):
+        return self.id + CLIP_FORMATS[self.video_format][0]
+
+    @property
+    def content_type(self):
+        return CLIP_FORMATS[self.video_format][1]
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'format': self.video_format,
+            'frames': self.frames,
+            'written': self.written,
+            'error': self.error,
+        }
+
+
+class ClipRenderer:
+    """Renders clips on `workers` threads into `cache`, a DiskCache.
+
+    `submit` returns the job for a clip: the one already queued or running
+    for the same parameters and frames, a finished one straight from the
+    cache, or a new one. At most `max_queued` jobs wait, past that `submit`
+    raises queue.Full. `decode(key, width)` returns a BGR frame.
+    """
+
+    def __init__(self, cache, decode, workers=2, max_queued=8):
+        self.cache = cache
+        self.decode = decode
+        self.workers = workers
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        # id -> ClipJob
+        self._jobs = {}
+        self._started = False
+        self._jobs_dir = os.path.join(cache.directory, 'jobs')
+        os.makedirs(self._jobs_dir, exist_ok=True)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"clip-render-{i}", daemon=True).start()
+        return self
+
+    def submit(self, params, keys):
+        job_id = clip_id(params, keys)
+        with self._lock:
+            self._forget_finished()
+            job = self._jobs.get(job_id)
+            if job is not None and job.status in (QUEUED, RUNNING):
+                return job
+
+            job = ClipJob(job_id, params.video_format, params, keys, len(keys))
+            if self._cached(job.name) is not None:
+                job.status = DONE
+                job.written = job.frames
+                job.keys = None
+                job.finished_at = time_module.monotonic()
+                self._jobs[job_id] = job
+                self._save(job)
+                return job
+
+            # Queued or rendering in another worker
+            other = self._load(job_id)
+            if other is not None and other.status in (QUEUED, RUNNING):
+                return other
+            if self._queue.full():
+                raise queue.Full
+            if not self._claim(job_id):
+                # Another worker claimed it since, its state file may not be written yet
+                return self._load(job_id) or ClipJob(job_id, params.video_format, None, None, len(keys))
+
+            # Saved before a render thread can pick it up and mark it running
+            self._save(job)
+            self._jobs[job_id] = job
+            # Only submit adds to the queue, under this lock, so there's room
+            self._queue.put_nowait(job)
+            return job
+
+    def get(self, job_id):
+        """The job `job_id` of this or any other worker sharing the cache, or None."""
+        if not re.fullmatch('[0-9a-f]{40}', job_id):
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+
+        job = self._load(job_id)
+        if job is not None:
+            return job
+        # State files are pruned after JOB_TTL, the clip itself may still be cached
+        for video_format, (extension, _, _) in CLIP_FORMATS.items():
+            if self._cached(job_id + extension) is not None:
+                return ClipJob(job_id, video_format, None, None, None, DONE)
+        return None
+
+    def video(self, job):
+        """(path, etag) of a finished job's clip, None if it isn't (or no longer) in the cache."""
+        return self._cached(job.name) if job.status == DONE else None
+
+    def _cached(self, name):
+        # Also finds clips another worker rendered, DiskCache.get checks the directory
+        return self.cache.get(name)
+
+    def _state_path(self, job_id):
+        return os.path.join(self._jobs_dir, job_id + '.json')
+
+    def _claim_path(self, job_id):
+        return os.path.join(self._jobs_dir, job_id + '.claim')
+
+    def _claim(self, job_id):
+        # O_EXCL, so of all the workers asking at once exactly one gets it
+        try:
+            os.close(os.open(self._claim_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _load(self, job_id):
+        # A job as last saved by whichever worker has it
+        try:
+            with open(self._state_path(job_id)) as f:
+                state = json.load(f)
+            return ClipJob(job_id, state['format'], None, None, state['frames'], state['status'], state['written'], state['error'])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _save(self, job):
+        # Written whole and moved in, readers never see half a file
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=self._jobs_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(job.as_dict(), f)
+            os.replace(temp_path, self._state_path(job.id))
+        except OSError as e:
+            print(f"Failed to save the state of clip {job.id}: {e}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def _forget_finished(self):
+        cutoff = time_module.monotonic() - JOB_TTL
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+        # Every worker's state and claim files by age, which also frees the
+        # claims of a worker that died mid-render
+        cutoff = time_module.time() - JOB_TTL
+        for entry in os.scandir(self._jobs_dir):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.status = RUNNING
+            self._save(job)
+            extension, _, encoder_args = CLIP_FORMATS[job.video_format]
+            # A dotfile, the cache skips it until it's moved in under its name
+            temp_path = os.path.join(self.cache.directory, f".{job.id}{extension}")
+
+            last_saved = time_module.monotonic()
+
+            def progress(written):
+                nonlocal last_saved
+                job.written = written
+                if time_module.monotonic() - last_saved >= PROGRESS_INTERVAL:
+                    last_saved = time_module.monotonic()
+                    self._save(job)
+
+            try:
+                # Keys are already in order, their position stands in for the timestamp
+                stream_timelapse_video(None, [(key, i) for i, key in enumerate(job.keys)], temp_path, job.params.fps,
+                                       decode=lambda key: self.decode(key, job.params.width), width=job.params.width,
+                                       encoder_args=encoder_args, on_frame=progress)
+                self.cache.put_file(job.name, temp_path)
+                job.status = DONE
+            except Exception as e:
+                print(f"Clip {job.id} failed: {e}")
+                traceback.print_exc()
+                job.status = FAILED
+                job.error = str(e)
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            finally:
+                job.keys = None
+                job.finished_at = time_module.monotonic()
+                self._save(job)
+                # A failed clip may be asked for again, by any worker
+                try:
+                    os.unlink(self._claim_path(job.id))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,240 @@
+import os
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, time
+
+import cv2
+import yaml
+
+from renditions import RENDITIONS
+from scheduler import OVERRUN_POLICIES, SKIP, build_curve
+
+SETTINGS_PATH = 'settings.yaml'
+
+# Corner of the frame each debug overlay panel is drawn in
+DEFAULT_OVERLAY_LAYOUT = {'timestamp': 'bottom-left', 'camera_settings': 'bottom-right', 'timing': 'top-right'}
+OVERLAY_POSITIONS = ('top-left', 'top-right', 'bottom-left', 'bottom-right')
+
+IMAGE_FORMATS = ('jpg', 'webp', 'avif')
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Settings:
+    max_runtime_hours: float
+    image_retention_hours: float
+    frequency: float
+    sunrise_time: time
+    sunset_time: time
+    night_brightness: float
+    day_brightness: float
+    enabled: bool
+    capture_buffer_size: int = 1
+    settle_frames: int = 2
+    overrun_policy: str = SKIP
+    latitude: float = None
+    longitude: float = None
+    transition_minutes: float = 60
+
+    show_camera_settings: bool = False
+    show_timestamp: bool = False
+    show_timing: bool = False
+    save_local_latest_img: bool = False
+    save_s3: bool = False
+    save_sqlite: bool = False
+    save_timings: bool = False
+    metrics_port: int = None
+    local_archive_dir: str = None
+
+    image_format: str = 'jpg'
+    image_quality: int = 95
+    jpeg_progressive: bool = False
+    jpeg_optimize: bool = False
+    renditions: tuple = ('thumb',)
+    strip_size: str = None
+
+    camera_schedule: dict = field(default_factory=dict)
+    overlay_layout: dict = field(default_factory=lambda: dict(DEFAULT_OVERLAY_LAYOUT))
+    time_dilation: dict = field(default_factory=dict)
+
+
+def _require(section, key, types, name):
+    if key not in section:
+        raise ConfigError(f"{name}.{key} is missing")
+    return _check(section[key], types, f"{name}.{key}")
+
+
+def _check(value, types, name):
+    # bool is an int subclass, don't let True pass as a number
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        raise ConfigError(f"{name} must be {' or '.join(t.__name__ for t in types)}, got {value!r}")
+    return value
+
+
+def _parse_time(value, name):
+    # YAML 1.1 reads an unquoted 6:30 as the base 60 integer 390
+    if isinstance(value, int) and not isinstance(value, bool):
+        value = f"{value // 60}:{value % 60:02d}"
+    try:
+        return datetime.strptime(str(value), '%H:%M').time()
+    except ValueError:
+        raise ConfigError(f"{name} must be HH:MM, got {value!r}")
+
+
+def parse_settings(config):
+    """Validate the parsed settings.yaml and build a Settings, raises ConfigError."""
+    if not isinstance(config, dict):
+        raise ConfigError("settings file is empty or not a mapping")
+
+    number = (int, float)
+    settings = _check(config.get('settings'), (dict,), 'settings')
+    debug = _check(config.get('debug', {}), (dict,), 'debug')
+    time_dilation = _check((config.get('fun_stuff') or {}).get('time_dilation') or {}, (dict,), 'fun_stuff.time_dilation')
+
+    frequency = _require(settings, 'FREQUENCY', number, 'settings')
+    if frequency <= 0:
+        raise ConfigError(f"settings.FREQUENCY must be positive, got {frequency}")
+
+    try:
+        build_curve(time_dilation, frequency)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ConfigError(f"fun_stuff.time_dilation is invalid: {e!r}")
+
+    overrun_policy = _check(settings.get('OVERRUN_POLICY', SKIP), (str,), 'settings.OVERRUN_POLICY')
+    if overrun_policy not in OVERRUN_POLICIES:
+        raise ConfigError(f"settings.OVERRUN_POLICY must be one of {', '.join(OVERRUN_POLICIES)}, got {overrun_policy!r}")
+
+    camera_schedule = _check(config.get('camera_schedule') or {}, (dict,), 'camera_schedule')
+    for name, targets in camera_schedule.items():
+        # Set with cap.set(cv2.CAP_PROP_<name>) on every capture
+        if not hasattr(cv2, f'CAP_PROP_{name}'):
+            raise ConfigError(f"camera_schedule.{name} is not a camera property, expected a cv2.CAP_PROP_* name like BRIGHTNESS")
+        _check(targets, (dict,), f"camera_schedule.{name}")
+        _require(targets, 'day', number, f"camera_schedule.{name}")
+        _require(targets, 'night', number, f"camera_schedule.{name}")
+
+    encoding = _check(config.get('encoding') or {}, (dict,), 'encoding')
+    image_format = _check(encoding.get('format', 'jpg'), (str,), 'encoding.format')
+    if image_format not in IMAGE_FORMATS:
+        raise ConfigError(f"encoding.format must be one of {', '.join(IMAGE_FORMATS)}, got {image_format!r}")
+    if image_format == 'avif' and not hasattr(cv2, 'IMWRITE_AVIF_QUALITY'):
+        raise ConfigError(f"encoding.format avif needs an OpenCV build with AVIF support (cv2.IMWRITE_AVIF_QUALITY), this is {cv2.__version__}")
+    image_quality = _check(encoding.get('quality', 95), (int,), 'encoding.quality')
+    if not 1 <= image_quality <= 100:
+        raise ConfigError(f"encoding.quality must be between 1 and 100, got {image_quality}")
+    renditions = _check(encoding.get('renditions', ['thumb']), (list, type(None)), 'encoding.renditions') or []
+    for size in renditions:
+        if size not in RENDITIONS:
+            raise ConfigError(f"encoding.renditions must only contain {', '.join(RENDITIONS)}, got {size!r}")
+    # Strips are packed from renditions made for upload anyway
+    strip_size = _check(encoding.get('strip_size'), (str, type(None)), 'encoding.strip_size')
+    if strip_size is not None and strip_size not in renditions:
+        raise ConfigError(f"encoding.strip_size must be one of encoding.renditions ({', '.join(renditions) or 'none'}), got {strip_size!r}")
+
+    overlay_layout = dict(DEFAULT_OVERLAY_LAYOUT)
+    overlay_layout.update(_check(config.get('overlay') or {}, (dict,), 'overlay'))
+    for panel, position in overlay_layout.items():
+        if panel not in DEFAULT_OVERLAY_LAYOUT:
+            raise ConfigError(f"overlay.{panel} is not a panel, expected one of {', '.join(DEFAULT_OVERLAY_LAYOUT)}")
+        if position not in OVERLAY_POSITIONS:
+            raise ConfigError(f"overlay.{panel} must be one of {', '.join(OVERLAY_POSITIONS)}, got {position!r}")
+
+    return Settings(
+        max_runtime_hours=_require(settings, 'MAX_RUNTIME_HOURS', number, 'settings'),
+        image_retention_hours=_require(settings, 'IMAGE_RETENTION_HOURS', number, 'settings'),
+        frequency=frequency,
+        sunrise_time=_parse_time(_require(settings, 'SUNRISE_TIME', (str, int), 'settings'), 'settings.SUNRISE_TIME'),
+        sunset_time=_parse_time(_require(settings, 'SUNSET_TIME', (str, int), 'settings'), 'settings.SUNSET_TIME'),
+        night_brightness=_require(settings, 'NIGHT_BRIGHTNESS', number, 'settings'),
+        day_brightness=_require(settings, 'DAY_BRIGHTNESS', number, 'settings'),
+        enabled=_require(settings, 'ENABLED', (bool,), 'settings'),
+        capture_buffer_size=_check(settings.get('CAPTURE_BUFFER_SIZE', 1), (int,), 'settings.CAPTURE_BUFFER_SIZE'),
+        settle_frames=_check(settings.get('SETTLE_FRAMES', 2), (int,), 'settings.SETTLE_FRAMES'),
+        overrun_policy=overrun_policy,
+        latitude=_check(settings.get('LATITUDE'), (int, float, type(None)), 'settings.LATITUDE'),
+        longitude=_check(settings.get('LONGITUDE'), (int, float, type(None)), 'settings.LONGITUDE'),
+        transition_minutes=_check(settings.get('TRANSITION_MINUTES', 60), number, 'settings.TRANSITION_MINUTES'),
+        show_camera_settings=_check(debug.get('SHOW_CAMERA_SETTINGS', False), (bool,), 'debug.SHOW_CAMERA_SETTINGS'),
+        show_timestamp=_check(debug.get('SHOW_TIMESTAMP', False), (bool,), 'debug.SHOW_TIMESTAMP'),
+        show_timing=_check(debug.get('SHOW_TIMING', False), (bool,), 'debug.SHOW_TIMING'),
+        save_local_latest_img=_check(debug.get('SAVE_LOCAL_LATEST_IMG', False), (bool,), 'debug.SAVE_LOCAL_LATEST_IMG'),
+        save_s3=_check(debug.get('SAVE_S3', False), (bool,), 'debug.SAVE_S3'),
+        save_sqlite=_check(debug.get('SAVE_SQLITE', False), (bool,), 'debug.SAVE_SQLITE'),
+        save_timings=_check(debug.get('SAVE_TIMINGS', False), (bool,), 'debug.SAVE_TIMINGS'),
+        metrics_port=_check(debug.get('METRICS_PORT'), (int, type(None)), 'debug.METRICS_PORT'),
+        local_archive_dir=_check(debug.get('LOCAL_ARCHIVE_DIR'), (str, type(None)), 'debug.LOCAL_ARCHIVE_DIR'),
+        image_format=image_format,
+        image_quality=image_quality,
+        jpeg_progressive=_check(encoding.get('progressive', False), (bool,), 'encoding.progressive'),
+        jpeg_optimize=_check(encoding.get('optimize', False), (bool,), 'encoding.optimize'),
+        renditions=tuple(dict.fromkeys(renditions)),
+        strip_size=strip_size,
+        camera_schedule=camera_schedule,
+        overlay_layout=overlay_layout,
+        time_dilation=time_dilation,
+    )
+
+
+def read_settings_file(path=SETTINGS_PATH):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+class SettingsWatcher:
+    """Re-reads the settings file only when it changes on disk.
+
+    `current()` costs one stat() when nothing changed. A new file is parsed
+    and validated before it is swapped in, so a bad edit keeps the last good
+    Settings (and is reported once) instead of taking the camera down. So
+    does a file that is briefly missing or unreadable, e.g. while an editor
+    deletes and recreates it.
+    """
+
+    def __init__(self, path=SETTINGS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._settings = None
+        self._unreadable = False
+
+    def _stat_signature(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _keep_previous(self, e):
+        # Checked again on the next call, reported once until it's readable
+        if self._settings is None:
+            raise e
+        if not self._unreadable:
+            print(f"Can't read {self.path}, keeping previous settings: {e}")
+            self._unreadable = True
+        return self._settings
+
+    def current(self):
+        try:
+            signature = self._stat_signature()
+        except OSError as e:
+            return self._keep_previous(e)
+        if signature == self._signature:
+            return self._settings
+
+        with self._lock:
+            if signature == self._signature:
+                return self._settings
+            try:
+                settings = parse_settings(read_settings_file(self.path))
+            except OSError as e:
+                return self._keep_previous(e)
+            except (ConfigError, yaml.YAMLError) as e:
+                if self._settings is None:
+                    raise
+                print(f"Ignoring invalid {self.path}, keeping previous settings: {e}")
+                settings = self._settings
+
+            self._settings = settings
+            self._signature = signature
+            self._unreadable = False
+            return settings
@@ -0,0 +1,236 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time as time_module
+import traceback
+from datetime import datetime, timezone
+
+from s3_layout import parse_frame_time
+
+DB_PATH = 'timelapse.db'
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS frames (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp DATETIME,
+        file_name TEXT,
+        brightness INTEGER,
+        contrast INTEGER,
+        saturation INTEGER,
+        gain INTEGER,
+        white_balance_temperature INTEGER,
+        frequency INTEGER,
+        timelapse_session TEXT,
+        s3_key TEXT,
+        deleted_at DATETIME,
+        timings TEXT,
+        image_size INTEGER,
+        captured_utc DATETIME,
+        FOREIGN KEY (timelapse_session) REFERENCES timelapse_sessions(session_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS timelapse_sessions (
+        session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start_time DATETIME,
+        end_time DATETIME
+    )
+    ''',
+]
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_frames_timestamp ON frames(timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_frames_session ON frames(timelapse_session)',
+    # Only frames still in storage, so listing and retention never walk
+    # deleted history (see frame_index.py)
+    'CREATE INDEX IF NOT EXISTS idx_frames_live ON frames(captured_utc) WHERE s3_key IS NOT NULL AND deleted_at IS NULL',
+    'CREATE INDEX IF NOT EXISTS idx_frames_live_session ON frames(timelapse_session, captured_utc) WHERE s3_key IS NOT NULL AND deleted_at IS NULL',
+]
+
+
+def format_utc(moment):
+    """How captured_utc is stored: naive UTC text that sorts in time order. Naive input is taken as UTC."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def backfill_captured_utc(conn):
+    # From the storage key, which is what listings need to agree with; rows
+    # with an unparsable key fall back to the local capture time
+    rows = conn.execute('SELECT id, s3_key, timestamp FROM frames WHERE captured_utc IS NULL').fetchall()
+    updates = []
+    for frame_id, key, timestamp in rows:
+        captured = parse_frame_time(key) if key else None
+        if captured is None and timestamp:
+            captured = datetime.fromisoformat(timestamp).astimezone(timezone.utc)
+        if captured is not None:
+            updates.append((format_utc(captured), frame_id))
+    conn.executemany('UPDATE frames SET captured_utc = ? WHERE id = ?', updates)
+
+
+# Columns added after the first release: (name, type, backfill statement or function)
+MIGRATIONS = [
+    ('s3_key', 'TEXT', '''
+        UPDATE frames
+        SET s3_key = replace(replace(file_name, ':', ''), ' ', '_') || '.jpg'
+        WHERE file_name IS NOT NULL
+    '''),
+    ('deleted_at', 'DATETIME', None),
+    # JSON {step: seconds} of the capture loop and pipeline, see debug.SAVE_TIMINGS
+    ('timings', 'TEXT', None),
+    ('image_size', 'INTEGER', None),
+    ('captured_utc', 'DATETIME', backfill_captured_utc),
+]
+
+FRAME_COLUMNS = ('timestamp', 'brightness', 'contrast', 'saturation', 'gain', 'white_balance_temperature', 'file_name', 'frequency', 'timelapse_session', 's3_key', 'timings', 'image_size', 'captured_utc')
+
+
+def connect(db_path=DB_PATH, check_same_thread=True):
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread, timeout=30)
+    # WAL lets readers (the web API, the assembler) query while we write, and
+    # NORMAL only fsyncs at checkpoints which is safe under WAL
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def initialize_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+    # Bring databases created by older versions up to date
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(frames)')}
+    for name, column_type, backfill in MIGRATIONS:
+        if name not in columns:
+            conn.execute(f'ALTER TABLE frames ADD COLUMN {name} {column_type}')
+            if callable(backfill):
+                backfill(conn)
+            elif backfill:
+                conn.execute(backfill)
+
+    for statement in INDEXES:
+        conn.execute(statement)
+    conn.commit()
+
+
+class DatabaseWriter:
+    """Single long-lived connection that batches frame inserts.
+
+    Frames are queued by `insert_frame` and written by a background thread
+    with `executemany`, committing every `batch_size` rows or every
+    `commit_interval` seconds, whichever comes first. Session rows are written
+    straight away since the caller needs the session id back.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=50, commit_interval=5.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._conn = connect(self.db_path, check_same_thread=False)
+        initialize_schema(self._conn)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+        # Still flush what's queued if the process exits without calling close()
+        atexit.register(self.close)
+        return self
+
+    def start_session(self):
+        with self._lock:
+            cursor = self._conn.execute('''
+                INSERT INTO timelapse_sessions (start_time)
+                VALUES (?)
+            ''', (datetime.now(),))
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def close_session(self, session_id):
+        self.flush()
+        with self._lock:
+            self._conn.execute('''
+                UPDATE timelapse_sessions
+                SET end_time = ?
+                WHERE session_id = ?
+            ''', (datetime.now(), session_id))
+            self._conn.commit()
+
+    def insert_frame(self, timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, session_id, s3_key=None, timings=None, image_size=None, captured_utc=None):
+        captured_utc = format_utc(captured_utc) if captured_utc is not None else None
+        self._queue.put((timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, session_id, s3_key, timings, image_size, captured_utc))
+
+    def _drain(self, limit=None):
+        rows = []
+        while limit is None or len(rows) < limit:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(f'''
+                INSERT INTO frames ({', '.join(FRAME_COLUMNS)})
+                VALUES ({', '.join('?' * len(FRAME_COLUMNS))})
+            ''', rows)
+            self._conn.commit()
+
+    def flush(self):
+        self._write(self._drain())
+
+    def _run(self):
+        rows = []
+        last_commit = time_module.monotonic()
+
+        while self._running:
+            timeout = max(0, self.commit_interval - (time_module.monotonic() - last_commit))
+            try:
+                rows.append(self._queue.get(timeout=timeout))
+                rows.extend(self._drain(self.batch_size - len(rows)))
+            except queue.Empty:
+                pass
+
+            if rows and (len(rows) >= self.batch_size or time_module.monotonic() - last_commit >= self.commit_interval):
+                try:
+                    self._write(rows)
+                except sqlite3.Error as e:
+                    # Keep the rows and retry on the next pass rather than lose them
+                    print(f"[db-writer] Failed to write {len(rows)} frames: {e}")
+                    traceback.print_exc()
+                else:
+                    rows = []
+                last_commit = time_module.monotonic()
+
+        # Hand anything still pending back to the queue for close() to flush
+        for row in rows:
+            self._queue.put(row)
+
+    def close(self):
+        if self._conn is None:
+            return
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+        atexit.unregister(self.close)
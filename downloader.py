@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import threading
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+CACHE_INDEX_NAME = '.cache_index.db'
+
+
+class CacheIndex:
+    """Records which keys are fully downloaded into a local directory.
+
+    Rows are only written after a download has been verified, so a key in the
+    index means the file is complete. The whole index is loaded up front and
+    lookups are dictionary hits, no filesystem stats.
+    """
+
+    def __init__(self, local_dir):
+        self.local_dir = local_dir
+        os.makedirs(local_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(local_dir, CACHE_INDEX_NAME), check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS cached_files (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                etag TEXT,
+                downloaded_at DATETIME
+            )
+        ''')
+        self._conn.commit()
+        self._entries = {key: (size, etag) for key, size, etag in self._conn.execute('SELECT key, size, etag FROM cached_files')}
+
+    def path_for(self, key):
+        return os.path.join(self.local_dir, os.path.basename(key))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, size, etag):
+        with self._lock:
+            self._entries[key] = (size, etag)
+            self._conn.execute('INSERT OR REPLACE INTO cached_files (key, size, etag, downloaded_at) VALUES (?, ?, ?, ?)', (key, size, etag, datetime.now()))
+            self._conn.commit()
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._conn.execute('DELETE FROM cached_files WHERE key = ?', (key,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Downloader:
+    """Parallel downloader from a storage backend, backed by a CacheIndex.
+
+    The storage's connection pool should be at least `concurrency` so threads
+    never queue for a connection. How each object is fetched and verified is
+    up to the backend (see storage.S3Storage.download).
+    """
+
+    def __init__(self, storage, local_dir, concurrency=16, max_attempts=5):
+        self.storage = storage
+        self.cache = CacheIndex(local_dir)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+    def filter_cached(self, images):
+        new_images = [image for image in images if image[0] not in self.cache]
+        old_images = [image for image in images if image[0] in self.cache]
+        return new_images, old_images
+
+    def _download_once(self, key, path):
+        partial_path = path + '.part'
+        info = self.storage.download(key, partial_path)
+        os.replace(partial_path, path)
+        self.cache.add(key, info.size, info.etag)
+
+    def download(self, key):
+        path = self.cache.path_for(key)
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self._download_once(key, path)
+                return path
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay = 0.5 * 2 ** (attempt - 1)
+                print(f"Download of {key} failed ({e}), retrying in {delay:.1f}s")
+                time_module.sleep(delay)
+
+    def download_all(self, images):
+        images, _ = self.filter_cached(images)
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.download, key): key for key, _ in images}
+            for i, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    print(f"Failed to download {futures[future]}: {e}")
+                if i % 500 == 0 or i == len(futures):
+                    print(f"Downloaded {i}/{len(futures)} images")
+        return failed
@@ -0,0 +1,119 @@
+import cv2
+import threading
+import time as time_module
+
+
+class FrameGrabber:
+    """Keeps only the newest camera frame without decoding the ones in between.
+
+    A background thread calls `cap.grab()` in a loop so the driver buffer never
+    holds stale frames; `read()` decodes just the latest grab with `retrieve()`.
+    `get`/`set` mirror cv2.VideoCapture so camera properties go through the
+    same lock as the grab loop.
+    """
+
+    def __init__(self, cap, buffer_size=1, settle_frames=2, timeout=5.0):
+        self.cap = cap
+        self.settle_frames = settle_frames
+        self.timeout = timeout
+
+        # Not every backend honours this, V4L2 does
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+
+        self._cap_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self._grab_seq = 0           # number of successful grabs so far
+        self._grab_time = None       # monotonic time of the newest grab
+        self._retrieved_seq = 0      # grab_seq handed out by the last read()
+        self._settings_seq = 0       # grab_seq at the last property change
+        self._error = None
+        self._props = {}             # last value set per property
+
+        self.dropped = 0             # grabbed frames that were never read
+        self.last_latency = None     # seconds read() waited for a frame
+        self.last_age = None         # seconds between grab and retrieve
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(self.timeout)
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            with self._cap_lock:
+                ok = self.cap.grab()
+
+            with self._cond:
+                if ok:
+                    self._grab_seq += 1
+                    self._grab_time = time_module.monotonic()
+                    self._error = None
+                else:
+                    self._error = "Failed to grab frame"
+                self._cond.notify_all()
+
+            if not ok:
+                # Don't spin on a camera that has gone away
+                time_module.sleep(0.1)
+
+    def get(self, prop):
+        with self._cap_lock:
+            return self.cap.get(prop)
+
+    def set(self, prop, value):
+        # Compare against what we last asked for, drivers round the value they report
+        changed = self._props.get(prop) != value
+        with self._cap_lock:
+            result = self.cap.set(prop, value)
+        self._props[prop] = value
+
+        # Frames grabbed before the change still show the old settings
+        if changed:
+            with self._cond:
+                self._settings_seq = self._grab_seq
+        return result
+
+    def read(self, wait_for_settings=True):
+        read_start = time_module.monotonic()
+
+        with self._cond:
+            # Need a frame we haven't handed out yet, and if a property was
+            # changed, one grabbed a few frames after the change
+            target_seq = self._retrieved_seq + 1
+            if wait_for_settings:
+                target_seq = max(target_seq, self._settings_seq + self.settle_frames)
+
+            if not self._cond.wait_for(lambda: self._grab_seq >= target_seq, self.timeout):
+                raise IOError(self._error or "Timed out waiting for a frame")
+
+        # Holding the cap lock keeps the grab loop from replacing the frame
+        # between reading its sequence number and decoding it
+        with self._cap_lock:
+            with self._cond:
+                grab_seq = self._grab_seq
+                grab_time = self._grab_time
+            ret, frame = self.cap.retrieve()
+        if not ret:
+            raise IOError("Failed to retrieve frame")
+
+        now = time_module.monotonic()
+        self.dropped += max(0, grab_seq - self._retrieved_seq - 1)
+        self._retrieved_seq = grab_seq
+        self.last_latency = now - read_start
+        self.last_age = now - grab_time
+
+        return frame
+
+    def release(self):
+        self.stop()
+        self.cap.release()
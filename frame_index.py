@@ -0,0 +1,127 @@
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from database import DB_PATH, connect, format_utc, initialize_schema
+
+# Listing frames from timelapse.db instead of storage. Every uploaded frame has
+# a row with its storage key and UTC capture time, and idx_frames_live covers
+# the rows still in storage, so a time range, a session or the newest N frames
+# is an indexed local query rather than a scan of the bucket or its manifests.
+
+# Rows still in storage, matches the WHERE of the partial indexes so they get used
+LIVE = 's3_key IS NOT NULL AND deleted_at IS NULL AND captured_utc IS NOT NULL'
+
+
+@dataclass(frozen=True)
+class IndexedFrame:
+    id: int
+    key: str
+    captured_utc: datetime
+    session_id: int
+    size: int
+
+
+def _where(since, until, session_id):
+    where = [LIVE]
+    params = []
+    if since is not None:
+        where.append('captured_utc >= ?')
+        params.append(format_utc(since))
+    if until is not None:
+        where.append('captured_utc < ?')
+        params.append(format_utc(until))
+    if session_id is not None:
+        where.append('timelapse_session = ?')
+        params.append(session_id)
+    return ' AND '.join(where), params
+
+
+def _frame(row):
+    frame_id, key, captured, session_id, size = row
+    # timelapse_session is a TEXT column, the ids are integers
+    session_id = int(session_id) if session_id is not None else None
+    return IndexedFrame(frame_id, key, datetime.fromisoformat(captured).replace(tzinfo=timezone.utc), session_id, size)
+
+
+class FrameIndex:
+    """Range, session, step and latest-N queries over the frames table.
+
+    Results are oldest first. `step` keeps every Nth matching frame, counted
+    from the oldest for `range` and from the newest for `latest`, so the
+    newest frame is always part of a stepped `latest`. Connections are per
+    thread, the web API queries from several at once.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.db_path)
+            with self._schema_lock:
+                # Older databases get captured_utc and the indexes on first use
+                if not self._schema_ready:
+                    initialize_schema(conn)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _select(self, since, until, session_id, step, newest_first, limit):
+        where, params = _where(since, until, session_id)
+        order = 'DESC' if newest_first else 'ASC'
+
+        query = f'SELECT id, s3_key, captured_utc, timelapse_session, image_size FROM frames WHERE {where} ORDER BY captured_utc {order}'
+        if step > 1:
+            # Numbered in the same direction as the result, so the first frame is always kept
+            query = f'''
+                SELECT id, s3_key, captured_utc, timelapse_session, image_size FROM (
+                    SELECT *, row_number() OVER (ORDER BY captured_utc {order}) - 1 AS position
+                    FROM frames WHERE {where}
+                ) WHERE position % ? = 0 ORDER BY captured_utc {order}
+            '''
+            params.append(step)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [_frame(row) for row in self._conn().execute(query, params)]
+
+    def range(self, since=None, until=None, session_id=None, step=1, limit=None):
+        """Frames captured in [since, until), the first `limit` of them."""
+        return self._select(since, until, session_id, step, False, limit)
+
+    def latest(self, count, since=None, until=None, session_id=None, step=1):
+        """The newest `count` frames in [since, until)."""
+        return self._select(since, until, session_id, step, True, count)[::-1]
+
+    def count(self, since=None, until=None, session_id=None):
+        where, params = _where(since, until, session_id)
+        return self._conn().execute(f'SELECT count(*) FROM frames WHERE {where}', params).fetchone()[0]
+
+    def mark_deleted(self, frame_ids):
+        conn = self._conn()
+        conn.executemany('UPDATE frames SET deleted_at = ? WHERE id = ?', [(datetime.now(), frame_id) for frame_id in frame_ids])
+        conn.commit()
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def frame_index_from_env(default_path=DB_PATH):
+    """FrameIndex over WEBCAMTIMELAPSE_DB_PATH (or `default_path`), None if there's no database there.
+
+    The web API and the assembler can run away from the camera, where there's
+    no timelapse.db; they fall back to the storage manifests then.
+    """
+    db_path = os.getenv('WEBCAMTIMELAPSE_DB_PATH', default_path)
+    if not os.path.exists(db_path):
+        return None
+    return FrameIndex(db_path)
@@ -0,0 +1,102 @@
+import argparse
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from database import DB_PATH, connect, initialize_schema
+from s3_layout import (FRAMES_PREFIX, day_manifest_key, floor_day, floor_hour, frame_key, hour_manifest_key,
+                       is_frame_key, merge_frames, parse_frame_time, read_manifest, write_manifest)
+from storage import storage_from_env
+
+# Re-keys flat frame objects (2024_08_06_12_00_00.jpg) into the partitioned
+# frames/YYYY/MM/DD/HH/ layout and writes the hour/day manifests for them.
+
+
+def list_legacy_frames(storage):
+    return [(obj.key, obj.size) for obj in storage.list_range()
+            if is_frame_key(obj.key) and not obj.key.startswith(FRAMES_PREFIX)]
+
+
+def copy_frame(storage, old_key):
+    new_key = frame_key(parse_frame_time(old_key))
+    storage.copy(old_key, new_key)
+    return new_key
+
+
+def write_manifests(storage, entries):
+    by_hour = defaultdict(list)
+    for entry in entries:
+        by_hour[floor_hour(parse_frame_time(entry['key']))].append(entry)
+
+    by_day = defaultdict(list)
+    for hour, hour_entries in sorted(by_hour.items()):
+        existing = read_manifest(storage, hour_manifest_key(hour))
+        frames = merge_frames(existing['frames'] if existing else [], hour_entries)
+        write_manifest(storage, hour_manifest_key(hour), {'hour': hour.isoformat(), 'frames': frames})
+        by_day[floor_day(hour)].append((hour, frames))
+
+    for day, hours in sorted(by_day.items()):
+        manifest = read_manifest(storage, day_manifest_key(day)) or {'day': day.isoformat(), 'hours': [], 'frames': []}
+        for hour, frames in hours:
+            manifest['frames'] = merge_frames(manifest['frames'], frames)
+            if hour.isoformat() not in manifest['hours']:
+                manifest['hours'].append(hour.isoformat())
+        manifest['hours'].sort()
+        write_manifest(storage, day_manifest_key(day), manifest)
+
+    return len(by_hour), len(by_day)
+
+
+def update_database(db_path, renamed):
+    if not os.path.exists(db_path):
+        return
+    conn = connect(db_path)
+    initialize_schema(conn)
+    conn.executemany('UPDATE frames SET s3_key = ? WHERE s3_key = ?', [(new, old) for old, new in renamed])
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move flat frame keys into the date/hour partitioned layout.")
+    parser.add_argument('--workers', type=int, default=32, help="Parallel copy requests")
+    parser.add_argument('--db', default=DB_PATH, help="timelapse.db to update with the new keys")
+    parser.add_argument('--keep-old', action='store_true', help="Don't delete the flat keys after copying")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be moved")
+    args = parser.parse_args()
+
+    storage = storage_from_env(max_pool_connections=args.workers)
+
+    legacy = list_legacy_frames(storage)
+    print(f"Found {len(legacy)} frames in the flat layout")
+    if args.dry_run or not legacy:
+        return
+
+    sizes = dict(legacy)
+    renamed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(copy_frame, storage, key): key for key, _ in legacy}
+        for i, future in enumerate(as_completed(futures), 1):
+            old_key = futures[future]
+            try:
+                renamed.append((old_key, future.result()))
+            except Exception as e:
+                print(f"Failed to copy {old_key}: {e}")
+            if i % 1000 == 0:
+                print(f"Copied {i}/{len(legacy)}")
+
+    entries = [{'key': new, 'timestamp': parse_frame_time(new).isoformat(), 'size': sizes[old]} for old, new in renamed]
+    hours, days = write_manifests(storage, entries)
+    print(f"Wrote {hours} hour and {days} day manifests")
+
+    update_database(args.db, renamed)
+
+    if not args.keep_old:
+        failed = storage.delete_batch([old for old, _ in renamed])
+        print(f"Deleted {len(renamed) - len(failed)} flat keys")
+
+    print(f"Migrated {len(renamed)}/{len(legacy)} frames")
+
+
+if __name__ == "__main__":
+    main()
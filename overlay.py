@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+# Text panels drawn onto frames. Each panel is rendered once into a small
+# sprite (BGR plus alpha), cached by its text and style, and blended into the
+# frame with NumPy.
+# Re-rendering only happens when the text changes, e.g. once a minute for the
+# timestamp.
+
+POSITIONS = ('top-left', 'top-right', 'bottom-left', 'bottom-right')
+
+
+@dataclass(frozen=True)
+class TextStyle:
+    font: int = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale: float = 0.4
+    thickness: int = 1
+    margin: int = 5
+    text_color: tuple = (255, 255, 255)
+    background_color: tuple = (0, 0, 0)
+    background_alpha: float = 1.0
+    line_type: int = cv2.LINE_AA
+
+
+def render_sprite(lines, style):
+    """(bgr, alpha) sprite of a text panel, laid out like the original cv2 overlays.
+
+    Lines are spaced by the height of the last line (as the old code did) and
+    the panel gets `margin` pixels of background on every side. `alpha` is
+    None for an opaque background, the common case, which is then a plain copy.
+    """
+    sizes = [cv2.getTextSize(line, style.font, style.font_scale, style.thickness)[0] for line in lines]
+    line_height = sizes[-1][1]
+    width = max(size[0] for size in sizes) + 2 * style.margin
+    height = line_height * len(lines) + 2 * style.margin
+
+    def draw(canvas, color):
+        for i, line in enumerate(lines):
+            baseline = style.margin + line_height * (i + 1)
+            cv2.putText(canvas, line, (style.margin, baseline), style.font, style.font_scale, color, style.thickness, style.line_type)
+        return canvas
+
+    if style.background_alpha >= 1:
+        # cv2 fills much faster than NumPy broadcasting a 3-channel colour
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        if any(style.background_color):
+            cv2.rectangle(canvas, (0, 0), (width - 1, height - 1), style.background_color, cv2.FILLED)
+        return draw(canvas, style.text_color), None
+
+    # Translucent background: text coverage becomes part of the alpha so the
+    # glyphs stay solid while the box lets the frame show through
+    coverage = draw(np.zeros((height, width), dtype=np.uint8), 255).astype(np.float32)[..., None] / 255
+    background = np.array(style.background_color, dtype=np.float32)
+    text = np.array(style.text_color, dtype=np.float32)
+    background_alpha = style.background_alpha * 255
+
+    bgr = np.rint(background + (text - background) * coverage).astype(np.uint8)
+    alpha = np.rint(background_alpha + (255 - background_alpha) * coverage).astype(np.uint16)
+    return bgr, alpha
+
+
+def blend(frame, sprite, x, y):
+    """Alpha-blend a (bgr, alpha) sprite onto a BGR frame in place, clipped to the frame."""
+    bgr, alpha = sprite
+    frame_height, frame_width = frame.shape[:2]
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + bgr.shape[1], frame_width), min(y + bgr.shape[0], frame_height)
+    if left >= right or top >= bottom:
+        return frame
+
+    region = frame[top:bottom, left:right]
+    bgr = bgr[top - y:bottom - y, left - x:right - x]
+    if alpha is None:
+        # Opaque panel, nothing underneath shows through
+        region[...] = bgr
+    else:
+        alpha = alpha[top - y:bottom - y, left - x:right - x]
+        region[...] = (bgr * alpha + region * (255 - alpha) + 127) // 255
+    return frame
+
+
+class OverlayCompositor:
+    """Draws text panels onto frames from an LRU cache of rendered sprites.
+
+    `compose(frame, panels)` takes (lines, style, position) tuples. Panels
+    sharing a corner are stacked away from it in the order given; pass the
+    same `offsets` dict to several calls to keep stacking across them.
+    """
+
+    def __init__(self, max_sprites=64):
+        self.max_sprites = max_sprites
+        self.hits = 0
+        self.misses = 0
+        self._sprites = OrderedDict()
+
+    def sprite(self, lines, style):
+        key = (tuple(lines), style)
+        sprite = self._sprites.get(key)
+        if sprite is not None:
+            self._sprites.move_to_end(key)
+            self.hits += 1
+            return sprite
+
+        self.misses += 1
+        sprite = render_sprite(lines, style)
+        self._sprites[key] = sprite
+        if len(self._sprites) > self.max_sprites:
+            self._sprites.popitem(last=False)
+        return sprite
+
+    def compose(self, frame, panels, offsets=None):
+        frame_height, frame_width = frame.shape[:2]
+        if offsets is None:
+            offsets = {}
+
+        for lines, style, position in panels:
+            if position not in POSITIONS:
+                raise ValueError(f"Invalid position {position!r}. Choose from {', '.join(POSITIONS)}.")
+            sprite = self.sprite(lines, style)
+            height, width = sprite[0].shape[:2]
+
+            x = 0 if position.endswith('left') else frame_width - width
+            offset = offsets.get(position, 0)
+            y = offset if position.startswith('top') else frame_height - height - offset
+            offsets[position] = offset + height + style.margin
+
+            blend(frame, sprite, x, y)
+        return frame
@@ -0,0 +1,183 @@
+import queue
+import threading
+import time as time_module
+import traceback
+
+from metrics import REGISTRY
+
+# Drop policies for a full stage queue
+BLOCK = 'block'              # wait for room (backpressure on the producer)
+DROP_NEWEST = 'drop_newest'  # reject the incoming job
+DROP_OLDEST = 'drop_oldest'  # evict the oldest queued job to make room
+
+# Sentinel that tells a stage worker to finish and exit
+_STOP = object()
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('pipeline_queue_wait_seconds', 'Time a job waited in a stage queue', labels=('stage',))
+STAGE_SECONDS = REGISTRY.histogram('pipeline_stage_duration_seconds', 'Time a stage spent on one job', labels=('stage',))
+QUEUE_DEPTH = REGISTRY.gauge('pipeline_queue_depth', 'Jobs waiting in a stage queue', labels=('stage',))
+DROPPED_JOBS = REGISTRY.counter('pipeline_dropped_jobs', 'Jobs dropped because a stage queue was full', labels=('stage',))
+FAILED_JOBS = REGISTRY.counter('pipeline_failed_jobs', 'Jobs whose stage function raised', labels=('stage',))
+
+
+class Stage:
+    """A worker thread fed by a bounded queue.
+
+    `func(job)` gets the job dict and returns it (possibly modified) to pass it
+    on to the next stage, or None to stop it here.
+    """
+
+    def __init__(self, name, func, maxsize=2, drop_policy=BLOCK, block_timeout=None):
+        if drop_policy not in (BLOCK, DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"Invalid drop policy: {drop_policy}")
+
+        self.name = name
+        self.func = func
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self.next_stage = None
+        self.on_complete = None
+
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_wait = None
+        self.last_duration = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"stage-{self.name}", daemon=True)
+        self._thread.start()
+
+    def put(self, job):
+        job['_enqueued'] = time_module.monotonic()
+
+        if self.drop_policy == BLOCK:
+            try:
+                self.queue.put(job, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                self._count_drop()
+                return False
+
+        if self.drop_policy == DROP_NEWEST:
+            try:
+                self.queue.put_nowait(job)
+                return True
+            except queue.Full:
+                self._count_drop()
+                return False
+
+        # DROP_OLDEST: make room by discarding whatever has waited the longest
+        while True:
+            try:
+                self.queue.put_nowait(job)
+                return True
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self._count_drop()
+                except queue.Empty:
+                    pass
+
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+        # The sentinel always waits for room so queued jobs are drained first
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _count_drop(self):
+        with self._lock:
+            self.dropped += 1
+        DROPPED_JOBS.inc(stage=self.name)
+        print(f"[{self.name}] Queue full, dropped a job ({self.drop_policy})")
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                break
+
+            started = time_module.monotonic()
+            wait = started - job.pop('_enqueued', started)
+            QUEUE_WAIT_SECONDS.observe(wait, stage=self.name)
+            QUEUE_DEPTH.set(self.queue.qsize(), stage=self.name)
+            try:
+                result = self.func(job)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                FAILED_JOBS.inc(stage=self.name)
+                print(f"[{self.name}] Stage failed: {e}")
+                traceback.print_exc()
+                continue
+            duration = time_module.monotonic() - started
+            STAGE_SECONDS.observe(duration, stage=self.name)
+
+            with self._lock:
+                self.processed += 1
+                self.last_wait = wait
+                self.last_duration = duration
+
+            if result is None:
+                continue
+            if self.next_stage is not None:
+                self.next_stage.put(result)
+            elif self.on_complete is not None:
+                self.on_complete(result)
+
+    def stats(self):
+        QUEUE_DEPTH.set(self.queue.qsize(), stage=self.name)
+        with self._lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'last_wait': self.last_wait,
+                'last_duration': self.last_duration,
+            }
+
+    def stats_rows(self):
+        stats = self.stats()
+        return [
+            [f"{self.name} queue depth", stats['queue_depth']],
+            [f"{self.name} wait", stats['last_wait']],
+            [f"{self.name} latency", stats['last_duration']],
+            [f"{self.name} dropped", stats['dropped']],
+        ]
+
+
+class Pipeline:
+    """Chains stages so each one's output feeds the next one's queue."""
+
+    def __init__(self, stages, on_complete=None):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+        # Tail stage hands finished jobs back to the caller
+        stages[-1].on_complete = on_complete
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def submit(self, job):
+        return self.stages[0].put(job)
+
+    def stop(self, timeout=None):
+        # Stop front to back so every stage flushes into the next before it exits
+        for stage in self.stages:
+            stage.stop(timeout)
+
+    def stats_rows(self):
+        rows = []
+        for stage in self.stages:
+            rows.extend(stage.stats_rows())
+        return rows
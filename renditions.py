@@ -0,0 +1,482 @@
+import argparse
+import hashlib
+import os
+import tempfile
+import threading
+import time as time_module
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import numpy as np
+
+from s3_layout import list_frames, rendition_key
+
+# Downscaled JPEG copies of frames for the web UI. The capture loop uploads
+# the sizes in encoding.renditions next to every frame (from the frame it
+# already has in memory), the API serves them from a local disk cache and
+# renders anything else on demand.
+
+# Width in pixels of each named size, the height follows the aspect ratio
+RENDITIONS = {'thumb': 320, 'small': 640, 'medium': 1280}
+RENDITION_QUALITY = 80
+
+REDUCED_DECODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def jpeg_size(data):
+    """(width, height) from a JPEG's frame header without decoding it, None for anything else."""
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC) which share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big')
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def decode_image(data, width=None):
+    """BGR frame from encoded bytes, for a rendition `width` pixels wide (None for full size).
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale when that is still at least
+    `width` wide; libjpeg skips most of the work then, which is several
+    times faster than a full decode of a 4K frame followed by a resize.
+    """
+    flags = cv2.IMREAD_COLOR
+    size = jpeg_size(data) if width else None
+    if size is not None:
+        for factor, reduced in REDUCED_DECODES:
+            if size[0] // factor >= width:
+                flags = reduced
+                break
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if frame is None:
+        raise ValueError("Not a decodable image")
+    return frame
+
+
+def render_rendition(frame, width, quality=RENDITION_QUALITY):
+    """JPEG bytes of `frame` scaled down to `width` (never up)."""
+    if width is not None and frame.shape[1] > width:
+        height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("Failed to encode rendition")
+    return buffer.tobytes()
+
+
+def file_sha1(path):
+    # In chunks, cached clips can be far larger than a frame
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class DiskCache:
+    """Files under `directory`, the least recently used evicted past `max_bytes`.
+
+    Entries are immutable once written; `put` writes through a hidden temp
+    file and os.replace. Each entry has a strong ETag, the SHA-1 of its
+    bytes. Recency survives restarts through the files' mtimes. `fetch`
+    fills a missing entry once however many threads ask for it at the same
+    time; the others wait for that fill and share its result.
+
+    API worker processes share the directory. Every `sync_interval` seconds
+    eviction re-reads it, so `max_bytes` caps the files of all of them
+    together, and recency across them is the mtime `get` touches.
+    """
+
+    def __init__(self, directory, max_bytes, sync_interval=30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.total_bytes = 0
+
+        self._lock = threading.Lock()
+        # name -> [size, etag or None until first read]
+        self._entries = OrderedDict()
+        # name -> Future of (path, etag), for fills in progress
+        self._filling = {}
+
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.name.startswith('.'):
+                # Temp file of a write that never finished. Recent ones may be
+                # another API worker's write in progress, they share the directory.
+                try:
+                    if entry.stat().st_mtime < time_module.time() - 3600:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._sync()
+            self._evict()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """(path, etag) of a cached entry, or None."""
+        path = self.path(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                # Maybe put there by another process since the last sync
+                try:
+                    entry = self._entries[name] = [os.path.getsize(path), None]
+                    self.total_bytes += entry[0]
+                except FileNotFoundError:
+                    self.misses += 1
+                    return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+        try:
+            if entry[1] is None:
+                entry[1] = file_sha1(path)
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted (or removed by hand) since the lookup
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+                if self._entries.pop(name, None) is not None:
+                    self.total_bytes -= entry[0]
+            return None
+        return path, entry[1]
+
+    def put(self, name, data):
+        """Store `data` under `name`, returns (path, etag)."""
+        return self.put_stream(name, [data])
+
+    def put_stream(self, name, chunks):
+        """Store the bytes of `chunks` under `name` a chunk at a time, returns (path, etag)."""
+        path = self.path(name)
+        sha1 = hashlib.sha1()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    sha1.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        etag = sha1.hexdigest()
+
+        self._add(name, size, etag)
+        return path, etag
+
+    def put_file(self, name, source_path):
+        """Move the file at `source_path` in as `name`, returns (path, etag). Same filesystem only."""
+        etag = file_sha1(source_path)
+        size = os.path.getsize(source_path)
+        path = self.path(name)
+        os.replace(source_path, path)
+
+        self._add(name, size, etag)
+        return path, etag
+
+    def _add(self, name, size, etag):
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.total_bytes -= previous[0]
+            self._entries[name] = [size, etag]
+            self.total_bytes += size
+            self._evict(keep=name)
+
+    def fetch(self, name, load):
+        """(path, etag, status) of `name`, filled from the chunks `load()` returns on a miss.
+
+        `status` is 'HIT', 'MISS' for the thread that ran `load`, or
+        'COALESCED' for one that waited on another thread's fill. An
+        exception from `load` is raised in every waiting thread.
+        """
+        cached = self.get(name)
+        if cached is not None:
+            return cached + ('HIT',)
+
+        with self._lock:
+            future = self._filling.get(name)
+            leader = future is None
+            if leader:
+                future = self._filling[name] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result() + ('COALESCED',)
+
+        try:
+            result = self.put_stream(name, load())
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._filling[name]
+        return result + ('MISS',)
+
+    def stream(self, name, load, keep_bytes=0, on_complete=None):
+        """Like `fetch`, but the thread filling `name` gets its chunks as they're written.
+
+        Returns (status, value): (path, etag) for 'HIT' and 'COALESCED', a
+        CacheFill to iterate for 'MISS'. The entry is complete, and threads
+        waiting on it get it, once the fill has been iterated to the end or
+        closed. `on_complete(path, etag, data)` is called then, with the bytes
+        when there are at most `keep_bytes` of them, else None.
+        """
+        cached = self.get(name)
+        if cached is not None:
+            return 'HIT', cached
+
+        with self._lock:
+            future = self._filling.get(name)
+            leader = future is None
+            if leader:
+                future = self._filling[name] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return 'COALESCED', future.result()
+
+        try:
+            return 'MISS', CacheFill(self, name, load(), future, keep_bytes, on_complete)
+        except BaseException as e:
+            self._end_fill(name, future, exception=e)
+            raise
+
+    def _end_fill(self, name, future, result=None, exception=None):
+        with self._lock:
+            del self._filling[name]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def _sync(self):
+        # The index rebuilt from the directory, with what other processes
+        # added and without what they evicted, oldest use first
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                pass
+
+        entries = OrderedDict()
+        total_bytes = 0
+        for _, name, size in sorted(files):
+            known = self._entries.get(name)
+            entries[name] = [size, known[1] if known is not None and known[0] == size else None]
+            total_bytes += size
+        self._entries = entries
+        self.total_bytes = total_bytes
+        self._synced = time_module.monotonic()
+
+    def _evict(self, keep=None):
+        if time_module.monotonic() - self._synced >= self.sync_interval:
+            self._sync()
+        while self.total_bytes > self.max_bytes and self._entries:
+            name, (size, _) = next(iter(self._entries.items()))
+            if name == keep:
+                break
+            del self._entries[name]
+            self.total_bytes -= size
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+
+
+class CacheFill:
+    """The chunks of a DiskCache miss, written to the cache as they're iterated.
+
+    Meant as a WSGI response body: the client gets each chunk as soon as it
+    arrives from storage. The server always calls `close`, which reads in
+    whatever the client didn't take (it disconnected, or it was a HEAD), so
+    the entry is complete for the threads waiting on it either way.
+    """
+
+    def __init__(self, cache, name, chunks, future, keep_bytes, on_complete):
+        self.cache = cache
+        self.name = name
+        self._chunks = iter(chunks)
+        self._future = future
+        self._keep_bytes = keep_bytes
+        self._on_complete = on_complete
+        self._kept = []
+        self._sha1 = hashlib.sha1()
+        self._size = 0
+        self._done = False
+        fd, self._temp_path = tempfile.mkstemp(prefix='.', dir=cache.directory)
+        self._file = os.fdopen(fd, 'wb')
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                self._write(chunk)
+                yield chunk
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            self._fail(e)
+            raise
+        self._finish()
+
+    def close(self):
+        if self._done:
+            return
+        try:
+            for chunk in self._chunks:
+                self._write(chunk)
+        except BaseException as e:
+            self._fail(e)
+            raise
+        self._finish()
+
+    def _write(self, chunk):
+        self._sha1.update(chunk)
+        self._file.write(chunk)
+        self._size += len(chunk)
+        if self._kept is not None:
+            self._kept.append(chunk)
+            if self._size > self._keep_bytes:
+                self._kept = None
+
+    def _finish(self):
+        if self._done:
+            return
+        self._done = True
+        try:
+            self._file.close()
+            path = self.cache.path(self.name)
+            os.replace(self._temp_path, path)
+        except BaseException as e:
+            self._done = False
+            self._fail(e)
+            raise
+        etag = self._sha1.hexdigest()
+        self.cache._add(self.name, self._size, etag)
+        self.cache._end_fill(self.name, self._future, result=(path, etag))
+        if self._on_complete is not None:
+            self._on_complete(path, etag, b''.join(self._kept) if self._kept is not None else None)
+
+    def _fail(self, exception):
+        if self._done:
+            return
+        self._done = True
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.unlink(self._temp_path)
+        self.cache._end_fill(self.name, self._future, exception=exception)
+
+
+class MemoryCache:
+    """The last `max_items` entries served, as bytes, within `max_bytes` in total.
+
+    Sits in front of DiskCache for what every viewer asks for at once, the
+    newest frames. Entries over `max_item_bytes` are never kept.
+    """
+
+    def __init__(self, max_items, max_bytes, max_item_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes or max_bytes // 8
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+
+        self._lock = threading.Lock()
+        # name -> (data, etag)
+        self._entries = OrderedDict()
+
+    def get(self, name):
+        """(data, etag), or None."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry
+
+    def put(self, name, data, etag):
+        if len(data) > self.max_item_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.total_bytes -= len(previous[0])
+            self._entries[name] = (data, etag)
+            self.total_bytes += len(data)
+            while len(self._entries) > self.max_items or self.total_bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+
+def upload_missing_renditions(storage, keys, sizes, workers=8):
+    """Render and upload the `sizes` renditions that aren't in storage yet, returns how many were made."""
+
+    def process(key):
+        missing = [size for size in sizes if storage.head(rendition_key(key, size)) is None]
+        if not missing:
+            return 0
+        frame = decode_image(storage.get(key).data, max(RENDITIONS[size] for size in missing))
+        for size in missing:
+            storage.put(rendition_key(key, size), render_rendition(frame, RENDITIONS[size]), 'image/jpeg')
+        return len(missing)
+
+    made = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, count in enumerate(executor.map(process, keys), 1):
+            made += count
+            if i % 500 == 0:
+                print(f"Checked {i}/{len(keys)} frames, {made} renditions made")
+    return made
+
+
+def main():
+    # Backfill for frames uploaded before renditions existed
+    from storage import storage_from_env
+
+    parser = argparse.ArgumentParser(description="Upload the missing renditions of recent frames.")
+    parser.add_argument('--hours', type=float, default=168, help="How far back to go")
+    parser.add_argument('--size', action='append', choices=sorted(RENDITIONS), help="Sizes to make, repeatable (default thumb)")
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    storage = storage_from_env(max_pool_connections=args.workers)
+    now = datetime.now(timezone.utc)
+    keys = [frame['key'] for frame in list_frames(storage, now - timedelta(hours=args.hours), now + timedelta(hours=1))]
+    made = upload_missing_renditions(storage, keys, args.size or ['thumb'], args.workers)
+    print(f"Made {made} renditions for {len(keys)} frames in {storage}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from database import DB_PATH
+from frame_index import FrameIndex
+from renditions import RENDITIONS
+from s3_layout import expired_manifest_keys, expired_strip_keys, rendition_key
+from storage import DELETE_BATCH_SIZE, storage_from_env
+
+
+def delete_expired_frames(storage, retention_hours, db_path=DB_PATH):
+    """Delete frames older than the retention window using the frame index.
+
+    Only frames that are past the cutoff and still in storage are read (see
+    idx_frames_live), so the cost follows the number of expired frames, not
+    the size of the bucket.
+    """
+    cutoff_utc = datetime.now(timezone.utc) - timedelta(hours=retention_hours)
+    frame_index = FrameIndex(db_path)
+
+    deleted_keys = []
+    try:
+        while True:
+            frames = frame_index.range(until=cutoff_utc, limit=DELETE_BATCH_SIZE)
+            if not frames:
+                break
+
+            # Every size is asked for, whether or not it was ever made; deleting a missing key is a no-op
+            keys = [frame.key for frame in frames]
+            failed = storage.delete_batch(keys + [rendition_key(key, size) for key in keys for size in RENDITIONS])
+            done = [frame for frame in frames if frame.key not in failed]
+            frame_index.mark_deleted([frame.id for frame in done])
+            deleted_keys.extend(frame.key for frame in done)
+
+            # Failed keys would be selected again straight away, retry next sweep
+            if failed:
+                break
+    finally:
+        frame_index.close()
+
+    # Manifests and strips of hours and days that have fully expired go with their frames
+    storage.delete_batch(expired_manifest_keys(deleted_keys, cutoff_utc) + expired_strip_keys(deleted_keys, cutoff_utc, RENDITIONS))
+
+    return len(deleted_keys)
+
+
+def delete_expired_objects(storage, retention_hours):
+    """Full scan by last modified time, for objects the frames table doesn't know about."""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=retention_hours)
+    expired = [obj.key for obj in storage.list_range() if obj.last_modified < cutoff]
+    failed = storage.delete_batch(expired)
+    return len(expired) - len(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete timelapse frames older than the retention window.")
+    parser.add_argument('--hours', type=float, required=True, help="Retention window in hours")
+    parser.add_argument('--db', default=DB_PATH, help="Path to timelapse.db")
+    parser.add_argument('--full-scan', action='store_true', help="List the whole bucket instead of using the frames table")
+    args = parser.parse_args()
+
+    storage = storage_from_env()
+    if args.full_scan:
+        deleted = delete_expired_objects(storage, args.hours)
+    else:
+        deleted = delete_expired_frames(storage, args.hours, args.db)
+    print(f"Deleted {deleted} expired images from {storage}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import threading
+
+import boto3
+from botocore.config import Config
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def get_client(max_pool_connections=10, max_attempts=3, retry_mode='standard', endpoint_url=None,
+               access_key=None, secret_key=None, path_style=False):
+    """Shared S3 client for a pool size and endpoint, created on first use.
+
+    boto3 clients are thread-safe, so every caller reuses one client and with
+    it the resolved credentials, the endpoint and the pooled TLS connections,
+    instead of paying for all of that on every frame. `endpoint_url` and
+    `path_style` point it at an S3-compatible server such as MinIO.
+    """
+    key = (max_pool_connections, max_attempts, retry_mode, endpoint_url, access_key, secret_key, path_style)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            options = {}
+            if path_style:
+                # Self-hosted servers rarely have wildcard DNS for bucket subdomains.
+                # They also tend to reject the CRC checksums newer botocore adds
+                # to every PUT by default.
+                options = {'s3': {'addressing_style': 'path'}, 'request_checksum_calculation': 'when_required'}
+            # A session per client, the default session isn't thread-safe to create clients from
+            client = boto3.session.Session().client('s3', endpoint_url=endpoint_url, aws_access_key_id=access_key,
+                                                    aws_secret_access_key=secret_key, config=Config(
+                max_pool_connections=max_pool_connections,
+                retries={'max_attempts': max_attempts, 'mode': retry_mode},
+                **options,
+            ))
+            _clients[key] = client
+        return client
@@ -0,0 +1,214 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from storage import ObjectNotFound
+
+# Frames live under frames/YYYY/MM/DD/HH/<timestamp>.<jpg|webp|avif> (UTC). Every hour and
+# day also gets a JSON manifest listing its frames, so readers fetch one small
+# object per hour/day instead of paginating through the whole bucket.
+FRAMES_PREFIX = 'frames/'
+MANIFESTS_PREFIX = 'manifests/'
+# Downscaled copies, renditions/<size>/YYYY/MM/DD/HH/<timestamp>.jpg (see renditions.py)
+RENDITIONS_PREFIX = 'renditions/'
+# An hour of one rendition size in a single object, strips/<size>/YYYY/MM/DD/HH.strip (see strips.py)
+STRIPS_PREFIX = 'strips/'
+FRAME_NAME_FORMAT = '%Y_%m_%d_%H_%M_%S'
+
+
+def frame_key(captured_utc, extension='.jpg'):
+    return f"{FRAMES_PREFIX}{captured_utc:%Y/%m/%d/%H}/{captured_utc.strftime(FRAME_NAME_FORMAT)}{extension}"
+
+
+def rendition_key(key, size):
+    """Key of the `size` rendition of the frame at `key`, always a JPEG."""
+    name = os.path.splitext(key)[0]
+    if name.startswith(FRAMES_PREFIX):
+        name = name[len(FRAMES_PREFIX):]
+    return f"{RENDITIONS_PREFIX}{size}/{name}.jpg"
+
+
+def strip_key(size, hour):
+    return f"{STRIPS_PREFIX}{size}/{hour:%Y/%m/%d/%H}.strip"
+
+
+def parse_frame_time(key):
+    """UTC capture time from a frame key (partitioned or legacy flat), or None."""
+    # Some early uploads kept the spaces of the capture timestamp
+    name = os.path.splitext(os.path.basename(key))[0].replace(' ', '_')
+    try:
+        return datetime.strptime(name, FRAME_NAME_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def is_frame_key(key):
+    return not key.startswith((MANIFESTS_PREFIX, RENDITIONS_PREFIX, STRIPS_PREFIX)) and parse_frame_time(key) is not None
+
+
+def hour_manifest_key(hour):
+    return f"{MANIFESTS_PREFIX}hourly/{hour:%Y/%m/%d/%H}.json"
+
+
+def day_manifest_key(day):
+    return f"{MANIFESTS_PREFIX}daily/{day:%Y/%m/%d}.json"
+
+
+def floor_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def read_manifest(storage, key):
+    try:
+        return json.loads(storage.get(key).data)
+    except ObjectNotFound:
+        return None
+
+
+def write_manifest(storage, key, manifest):
+    storage.put(key, json.dumps(manifest, separators=(',', ':')).encode('utf-8'), 'application/json')
+
+
+def merge_frames(*frame_lists):
+    # Later lists win when the same key shows up twice
+    frames = {}
+    for frame_list in frame_lists:
+        for frame in frame_list:
+            frames[frame['key']] = frame
+    return sorted(frames.values(), key=lambda frame: frame['timestamp'])
+
+
+class ManifestWriter:
+    """Maintains the rolling manifests for the hour and day being captured.
+
+    The hour manifest is rewritten on every frame. The day manifest is
+    rewritten when an hour closes (and on flush), and records which hours it
+    already covers so readers know which hour manifests they still need.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._hour = None
+        self._hour_frames = []
+        self._day = None
+        self._day_manifest = None
+
+    def add_frame(self, key, captured_utc, **metadata):
+        hour = floor_hour(captured_utc)
+        if hour != self._hour:
+            self._close_hour()
+            self._open_hour(hour)
+
+        self._hour_frames.append(dict(metadata, key=key, timestamp=captured_utc.isoformat()))
+        write_manifest(self.storage, hour_manifest_key(hour), {
+            'hour': hour.isoformat(),
+            'frames': self._hour_frames,
+        })
+
+    def _open_hour(self, hour):
+        day = floor_day(hour)
+        if day != self._day:
+            self._day = day
+            self._day_manifest = read_manifest(self.storage, day_manifest_key(day)) or {
+                'day': day.isoformat(),
+                'hours': [],
+                'frames': [],
+            }
+
+        # After a crash the last hour never got folded into its day manifest
+        if self._hour is None:
+            previous = read_manifest(self.storage, hour_manifest_key(hour - timedelta(hours=1)))
+            if previous and floor_day(hour - timedelta(hours=1)) == day:
+                self._hour = hour - timedelta(hours=1)
+                self._hour_frames = previous['frames']
+                self._close_hour()
+
+        # Pick up frames written before a restart within the same hour
+        existing = read_manifest(self.storage, hour_manifest_key(hour))
+        self._hour = hour
+        self._hour_frames = existing['frames'] if existing else []
+
+    def _close_hour(self):
+        if self._hour is None or not self._hour_frames:
+            return
+
+        manifest = self._day_manifest
+        manifest['frames'] = merge_frames(manifest['frames'], self._hour_frames)
+        hour = self._hour.isoformat()
+        if hour not in manifest['hours']:
+            manifest['hours'].append(hour)
+            manifest['hours'].sort()
+        write_manifest(self.storage, day_manifest_key(self._day), manifest)
+
+    def flush(self):
+        self._close_hour()
+
+
+def expired_manifest_keys(frame_keys, cutoff_utc):
+    """Manifests whose whole hour/day is older than the cutoff, for frames just deleted."""
+    keys = set()
+    for key in frame_keys:
+        captured = parse_frame_time(key)
+        if captured is None:
+            continue
+        if floor_hour(captured) + timedelta(hours=1) <= cutoff_utc:
+            keys.add(hour_manifest_key(floor_hour(captured)))
+        if floor_day(captured) + timedelta(days=1) <= cutoff_utc:
+            keys.add(day_manifest_key(floor_day(captured)))
+    return sorted(keys)
+
+
+def expired_strip_keys(frame_keys, cutoff_utc, sizes):
+    """Strips of every size whose whole hour is older than the cutoff, for frames just deleted."""
+    hours = {floor_hour(captured) for captured in map(parse_frame_time, frame_keys) if captured is not None}
+    return sorted(strip_key(size, hour) for hour in hours if hour + timedelta(hours=1) <= cutoff_utc for size in sizes)
+
+
+def list_frames(storage, since, until):
+    """Frames captured in [since, until) from the manifests, oldest first."""
+    today = floor_day(datetime.now(timezone.utc))
+    frames = []
+    day = floor_day(since)
+    while day < until:
+        manifest = read_manifest(storage, day_manifest_key(day))
+        day_frames = manifest['frames'] if manifest else []
+
+        # Hours after the last one the day manifest covers may only have an
+        # hour manifest, typically the open hour. Past days without any day
+        # manifest had no closed hours, so only recent ones are worth probing.
+        if manifest and manifest['hours']:
+            hour = datetime.fromisoformat(max(manifest['hours'])) + timedelta(hours=1)
+        elif day >= today - timedelta(days=1):
+            hour = day
+        else:
+            hour = None
+
+        day_end = min(day + timedelta(days=1), until, floor_hour(datetime.now(timezone.utc)) + timedelta(hours=1))
+        while hour is not None and hour < day_end:
+            if hour >= floor_hour(since):
+                hour_manifest = read_manifest(storage, hour_manifest_key(hour))
+                if hour_manifest:
+                    day_frames = merge_frames(day_frames, hour_manifest['frames'])
+            hour += timedelta(hours=1)
+
+        frames.extend(frame for frame in day_frames if since <= datetime.fromisoformat(frame['timestamp']) < until)
+        day += timedelta(days=1)
+
+    return frames
+
+
+def latest_frames(storage, count, max_days=30, until=None):
+    """The newest `count` frames before `until`, walking back a day at a time, oldest first."""
+    until = until or datetime.now(timezone.utc) + timedelta(hours=1)
+    day = floor_day(until)
+    frames = []
+    for _ in range(max_days):
+        frames = list_frames(storage, day, min(day + timedelta(days=1), until)) + frames
+        if len(frames) >= count:
+            break
+        day -= timedelta(days=1)
+    return frames[-count:]
@@ -0,0 +1,307 @@
+import math
+import time as time_module
+from collections import deque
+from datetime import datetime, timedelta
+
+# Capture interval curves. Each one answers "how long until the frame after
+# frame `index`, which is taken at wall clock time `when`?" and the
+# IntervalScheduler turns those answers into monotonic-clock deadlines.
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# What to do with deadlines that have already passed when a loop overruns.
+# SKIP drops them and waits for the next slot on the grid, CATCH_UP takes up
+# to `max_catch_up` of them back to back.
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+OVERRUN_POLICIES = (SKIP, CATCH_UP)
+
+
+def parse_clock(value):
+    """'HH:MM' (or YAML's base 60 integer for an unquoted H:MM) to seconds since midnight."""
+    if isinstance(value, int):
+        return value * 60
+    hours, minutes = str(value).split(':')
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+def seconds_of_day(when):
+    return when.hour * 3600 + when.minute * 60 + when.second + when.microsecond / 1e6
+
+
+class ConstantCurve:
+    def __init__(self, frequency):
+        self.frequency = frequency
+
+    def interval(self, index, when):
+        return self.frequency
+
+
+class LinearCurve:
+    """Triangle wave: `step` seconds longer each frame up to max, then back down."""
+
+    def __init__(self, min_frequency, max_frequency, step):
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.step = step
+
+    def interval(self, index, when):
+        span = self.max_frequency - self.min_frequency
+        if span <= 0:
+            return self.min_frequency
+        position = (index * self.step) % (2 * span)
+        return self.min_frequency + (position if position <= span else 2 * span - position)
+
+
+class SineCurve:
+    """The old time_dialation sine mode, advancing `step` radians per frame."""
+
+    def __init__(self, min_frequency, max_frequency, step):
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.step = step
+
+    def interval(self, index, when):
+        return (self.max_frequency - self.min_frequency) / 2 * (math.sin(index * self.step) + 1) + self.min_frequency
+
+
+class PiecewiseCurve:
+    """Linear interpolation between (time of day, frequency) points, wrapping at midnight."""
+
+    def __init__(self, points):
+        if not points:
+            raise ValueError("piecewise mode needs at least one point")
+        self.points = sorted((parse_clock(clock), frequency) for clock, frequency in points)
+
+    def interval(self, index, when):
+        seconds = seconds_of_day(when)
+        points = self.points
+        # Neighbours on either side, the last point wraps around to the first
+        for (start, start_value), (end, end_value) in zip(points, points[1:] + [(points[0][0] + 86400, points[0][1])]):
+            if seconds < start:
+                seconds += 86400
+            if start <= seconds < end:
+                return start_value + (end_value - start_value) * (seconds - start) / (end - start)
+        return points[0][1]
+
+
+class WindowCurve:
+    """Cron-like windows: the first window matching the weekday and time sets the frequency."""
+
+    def __init__(self, windows, default_frequency):
+        self.default_frequency = default_frequency
+        self.windows = [(self._parse_days(window.get('days', '*')), parse_clock(window['start']), parse_clock(window['end']), window['frequency'])
+                        for window in windows]
+
+    @staticmethod
+    def _parse_days(spec):
+        if spec == '*':
+            return set(range(7))
+        if isinstance(spec, str):
+            spec = spec.split(',')
+        days = set()
+        for part in spec:
+            part = part.strip().lower()
+            if '-' in part:
+                first, last = (DAY_NAMES.index(day) for day in part.split('-'))
+                days.update(range(first, last + 1))
+            else:
+                days.add(DAY_NAMES.index(part))
+        return days
+
+    def interval(self, index, when):
+        seconds = seconds_of_day(when)
+        for days, start, end, frequency in self.windows:
+            # A window may run past midnight, e.g. 22:00-02:00
+            inside = start <= seconds < end if start <= end else seconds >= start or seconds < end
+            if when.weekday() in days and inside:
+                return frequency
+        return self.default_frequency
+
+
+class ActivityCurve:
+    """Shorter intervals while the scene is changing.
+
+    The capture loop reports a 0-255 activity score per frame (mean absolute
+    difference to the previous frame); at `threshold` and above the interval
+    is `min_frequency`, with no activity it is `max_frequency`.
+    """
+
+    def __init__(self, min_frequency, max_frequency, threshold):
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.threshold = threshold
+        self.activity = 0.0
+
+    def report_activity(self, activity):
+        self.activity = activity
+
+    def interval(self, index, when):
+        level = min(1.0, self.activity / self.threshold) if self.threshold > 0 else 0.0
+        return self.max_frequency - (self.max_frequency - self.min_frequency) * level
+
+
+def build_curve(config, default_frequency):
+    """Curve from the fun_stuff.time_dilation settings, constant FREQUENCY when disabled."""
+    config = config or {}
+    if not config.get('enabled', False):
+        return ConstantCurve(default_frequency)
+
+    mode = config.get('mode', 'constant')
+    min_frequency = config.get('min_frequency', 5)
+    max_frequency = config.get('max_frequency', 120)
+    step = config.get('step', 0.1)
+
+    # A zero interval would spin the capture loop
+    frequencies = [min_frequency, max_frequency]
+    frequencies += [point['frequency'] for point in config.get('points', [])]
+    frequencies += [window['frequency'] for window in config.get('windows', [])]
+    if any(frequency <= 0 for frequency in frequencies):
+        raise ValueError(f"Time dilation frequencies must be positive, got {frequencies}")
+
+    if mode == 'constant':
+        return ConstantCurve(default_frequency)
+    if mode == 'linear':
+        return LinearCurve(min_frequency, max_frequency, step)
+    if mode == 'sine':
+        return SineCurve(min_frequency, max_frequency, step)
+    if mode == 'piecewise':
+        return PiecewiseCurve([(point['time'], point['frequency']) for point in config.get('points', [])])
+    if mode == 'windows':
+        return WindowCurve(config.get('windows', []), default_frequency)
+    if mode == 'activity':
+        return ActivityCurve(min_frequency, max_frequency, config.get('activity_threshold', 10))
+    raise ValueError(f"Invalid time dilation mode: {mode}")
+
+
+class JitterStats:
+    """Rolling window of how late each capture started, in seconds."""
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+
+    def add(self, lateness):
+        self.samples.append(lateness)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, round(percent / 100 * (len(ordered) - 1)))]
+
+
+class IntervalScheduler:
+    """Absolute capture deadlines on the monotonic clock.
+
+    Each deadline is the previous deadline plus the curve's interval, so time
+    spent capturing and processing never pushes the following frames later,
+    and wall clock jumps (NTP, DST) don't move them at all. Deadlines missed
+    by an overrunning loop are handled by `overrun_policy`.
+    """
+
+    def __init__(self, curve=None, overrun_policy=SKIP, max_catch_up=3, jitter_window=1000,
+                 clock=time_module.monotonic, sleep=time_module.sleep, wall_clock=datetime.now):
+        self.curve = curve
+        self.overrun_policy = overrun_policy
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.sleep = sleep
+        self.wall_clock = wall_clock
+        self.index = 0
+        self.deadline = None
+        self.interval = None
+        self.skipped = 0
+        self.jitter = JitterStats(jitter_window)
+
+    def set_curve(self, curve):
+        # Keeps the frame index and current deadline, only later intervals change
+        self.curve = curve
+
+    def start(self):
+        self.index = 0
+        self.deadline = self.clock()
+        return self.deadline
+
+    def _step(self):
+        # Wall time the current slot was due, for time-of-day curves
+        when = self.wall_clock() - timedelta(seconds=self.clock() - self.deadline)
+        interval = self.curve.interval(self.index, when)
+        self.deadline += interval
+        self.index += 1
+        return interval
+
+    def advance(self):
+        """Move to the next frame's deadline and return the interval used."""
+        if self.deadline is None:
+            self.start()
+        self.interval = self._step()
+
+        # Slots already in the past are dropped, keeping the rest on the grid
+        now = self.clock()
+        allowed = self.max_catch_up if self.overrun_policy == CATCH_UP else 0
+        while self.deadline <= now and self._missed(now) > allowed:
+            self._step()
+            self.skipped += 1
+        return self.interval
+
+    def _missed(self, now):
+        # Whole intervals the current deadline is behind, the newest interval
+        # is a good enough estimate for a slowly varying curve
+        return int((now - self.deadline) // self.interval) + 1
+
+    def wait(self):
+        """Sleep until the current deadline and return how late we woke up."""
+        if self.deadline is None:
+            self.start()
+        remaining = self.deadline - self.clock()
+        while remaining > 0:
+            self.sleep(remaining)
+            remaining = self.deadline - self.clock()
+        lateness = -remaining
+        self.jitter.add(lateness)
+        return lateness
+
+    def time_until_deadline(self):
+        return self.deadline - self.clock()
+
+    def stats_rows(self):
+        return [
+            ["Jitter p50", self.jitter.percentile(50)],
+            ["Jitter p95", self.jitter.percentile(95)],
+            ["Jitter p99", self.jitter.percentile(99)],
+            ["Skipped frames", self.skipped],
+        ]
+
+
+class PeriodicTrigger:
+    """True once per `period` seconds of monotonic time, for hourly housekeeping."""
+
+    def __init__(self, period, clock=time_module.monotonic):
+        self.period = period
+        self.clock = clock
+        self.next_due = clock()
+
+    def due(self):
+        now = self.clock()
+        if now < self.next_due:
+            return False
+        # Skip any periods we slept through rather than firing for each
+        self.next_due += self.period * (int((now - self.next_due) // self.period) + 1)
+        return True
+
+
+def generate_schedule(curve, start, duration):
+    """Every capture of a session starting at `start` lasting `duration`, as (index, time, interval).
+
+    Activity curves are evaluated at their current activity level.
+    """
+    schedule = []
+    index = 0
+    when = start
+    end = start + duration
+    while when < end:
+        interval = curve.interval(index, when)
+        schedule.append((index, when, interval))
+        when += timedelta(seconds=interval)
+        index += 1
+    return schedule
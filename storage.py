@@ -0,0 +1,443 @@
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from stat import S_ISREG
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from s3_client import get_client
+
+# Where frames and manifests are kept. Every backend has the same small
+# interface, modelled on S3:
+#
+#   put(key, data, content_type)    get(key, byte_range=None)    head(key)
+#   stream(key, chunk_size)         the body as an iterator of chunks
+#   list_range(prefix, start_after, end_before, limit)
+#   delete_batch(keys)              copy(source_key, key)        download(key, path)
+#
+# Keys are '/' separated and always listed in lexicographic order, so the
+# frames/YYYY/MM/DD/HH/ layout lists oldest first on every backend.
+
+BACKENDS = ('s3', 'local', 'minio')
+DEFAULT_LOCAL_DIR = './storage'
+
+CHUNK_SIZE = 1024 * 1024
+# delete_objects takes at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+    '.json': 'application/json',
+}
+
+
+class ObjectNotFound(LookupError):
+    pass
+
+
+class InvalidRange(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class ObjectInfo:
+    key: str
+    size: int
+    last_modified: datetime
+    etag: str
+    content_type: str = None
+
+
+@dataclass(frozen=True)
+class StoredObject:
+    info: ObjectInfo
+    data: bytes
+    # Inclusive (start, end) of `data` within the object, None for the whole object
+    byte_range: tuple = None
+
+
+def content_type_for(key):
+    extension = os.path.splitext(key)[1].lower()
+    return CONTENT_TYPES.get(extension) or mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+def _chunks(chunks, close):
+    # Releases the connection or file however the reader stops
+    try:
+        yield from chunks
+    finally:
+        close()
+
+
+def verify_download(path, expected_size, etag, md5):
+    size = os.path.getsize(path)
+    if size != expected_size:
+        raise IOError(f"Size mismatch for {path}: got {size}, expected {expected_size}")
+
+    # ETags of single part uploads are the MD5 of the body; multipart ETags
+    # ("<md5>-<parts>") aren't, so those only get the size check
+    etag = etag.strip('"')
+    if md5 is not None and '-' not in etag and md5.hexdigest() != etag:
+        raise IOError(f"Checksum mismatch for {path}")
+
+
+class S3Storage:
+    """Objects in an S3 bucket.
+
+    The client comes from s3_client and is only created on first use.
+    Listing uses StartAfter and stops paginating at `end_before`. Downloads
+    over `multipart_threshold` go through boto3's transfer manager, which
+    fetches byte ranges in parallel.
+    """
+
+    def __init__(self, bucket_name, client=None, max_pool_connections=10, max_attempts=3, retry_mode='standard',
+                 multipart_threshold=8 * 1024 * 1024):
+        self.bucket_name = bucket_name
+        self.multipart_threshold = multipart_threshold
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold, max_concurrency=4)
+        self._client = client
+        self._client_options = {'max_pool_connections': max_pool_connections, 'max_attempts': max_attempts, 'retry_mode': retry_mode}
+
+    def __str__(self):
+        return f"s3://{self.bucket_name}"
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_client(**self._client_options)
+        return self._client
+
+    def put(self, key, data, content_type=None):
+        extra = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket_name, Key=key, Body=data, **extra)
+
+    def get(self, key, byte_range=None):
+        extra = {}
+        if byte_range is not None:
+            start, end = byte_range
+            extra['Range'] = f"bytes={start}-{'' if end is None else end}"
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key, **extra)
+        except self.client.exceptions.NoSuchKey:
+            raise ObjectNotFound(key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                raise InvalidRange(f"{byte_range} is outside {key}")
+            raise
+
+        data = response['Body'].read()
+        size = response['ContentLength']
+        returned_range = None
+        if 'ContentRange' in response:
+            # "bytes 0-99/1234"
+            span, _, total = response['ContentRange'].split(' ')[-1].partition('/')
+            start, _, end = span.partition('-')
+            returned_range = (int(start), int(end))
+            size = int(total)
+        info = ObjectInfo(key, size, response['LastModified'], response['ETag'], response.get('ContentType'))
+        return StoredObject(info, data, returned_range)
+
+    def stream(self, key, chunk_size=CHUNK_SIZE):
+        """(ObjectInfo, chunks) without reading the body into memory. Close the chunks if not read to the end."""
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            raise ObjectNotFound(key)
+        info = ObjectInfo(key, response['ContentLength'], response['LastModified'], response['ETag'], response.get('ContentType'))
+        return info, _chunks(response['Body'].iter_chunks(chunk_size), response['Body'].close)
+
+    def head(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return ObjectInfo(key, response['ContentLength'], response['LastModified'], response['ETag'], response.get('ContentType'))
+
+    def list_range(self, prefix='', start_after=None, end_before=None, limit=None):
+        """Objects with `prefix` in (start_after, end_before), in key order, at most `limit` of them."""
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        remaining = limit
+        while remaining is None or remaining > 0:
+            # No point asking for a full page when only a few keys are wanted
+            response = self.client.list_objects_v2(MaxKeys=1000 if remaining is None else min(1000, remaining), **kwargs)
+            for obj in response.get('Contents', []):
+                if end_before is not None and obj['Key'] >= end_before:
+                    return
+                yield ObjectInfo(obj['Key'], obj['Size'], obj['LastModified'], obj.get('ETag'))
+                if remaining is not None:
+                    remaining -= 1
+            if not response.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def delete_batch(self, keys):
+        """Delete keys in 1000-key batches, returns the keys S3 refused to delete."""
+        keys = list(keys)
+        failed = set()
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[i:i + DELETE_BATCH_SIZE]
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True},
+            )
+            for error in response.get('Errors', []):
+                print(f"Failed to delete {error['Key']}: {error.get('Code')} {error.get('Message')}")
+                failed.add(error['Key'])
+        return failed
+
+    def copy(self, source_key, key):
+        # Server side, the bytes never leave the bucket
+        self.client.copy_object(Bucket=self.bucket_name, Key=key, CopySource={'Bucket': self.bucket_name, 'Key': source_key})
+
+    def download(self, key, path):
+        """Write the object to `path`, checked against its size and ETag."""
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            raise ObjectNotFound(key)
+        size = response['ContentLength']
+        etag = response['ETag']
+
+        if size > self.multipart_threshold:
+            # Ranged parallel GETs, the body we already opened is discarded
+            response['Body'].close()
+            self.client.download_file(self.bucket_name, key, path, Config=self.transfer_config)
+            md5 = None
+        else:
+            md5 = hashlib.md5()
+            with open(path, 'wb') as f:
+                for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+                    md5.update(chunk)
+                    f.write(chunk)
+
+        verify_download(path, size, etag, md5)
+        return ObjectInfo(key, size, response['LastModified'], etag, response.get('ContentType'))
+
+
+class MinioStorage(S3Storage):
+    """A bucket on MinIO or another self-hosted S3-compatible server.
+
+    The same requests as S3Storage against `endpoint_url`, with path-style
+    addressing and only the checksums the server requires. The server is
+    usually on the LAN, where splitting a frame into parallel ranged GETs
+    costs more than it saves, so the multipart threshold is much higher.
+    """
+
+    def __init__(self, bucket_name, endpoint_url, access_key=None, secret_key=None, client=None, max_pool_connections=10,
+                 max_attempts=3, retry_mode='standard', multipart_threshold=64 * 1024 * 1024):
+        super().__init__(bucket_name, client, max_pool_connections, max_attempts, retry_mode, multipart_threshold)
+        self.endpoint_url = endpoint_url
+        self._client_options.update(endpoint_url=endpoint_url, access_key=access_key, secret_key=secret_key, path_style=True)
+
+    def __str__(self):
+        return f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}"
+
+
+class LocalStorage:
+    """Objects as plain files under a root directory.
+
+    For fully local deployments (e.g. on NVMe) and for running the pipeline
+    offline. Keys map straight to paths, so an hour of frames is one
+    directory. Writes go through a hidden temp file and os.replace, so readers
+    never see a partial object. Content types come from the key's extension.
+    """
+
+    def __init__(self, root=DEFAULT_LOCAL_DIR):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def __str__(self):
+        return self.root
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        # Keys come from HTTP requests too, never leave the root
+        if not path.startswith(self.root + os.sep):
+            raise ObjectNotFound(key)
+        return path
+
+    def _info(self, key, stat):
+        # Changes whenever the file is replaced, which is all an ETag needs to do
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        return ObjectInfo(key, stat.st_size, datetime.fromtimestamp(stat.st_mtime, timezone.utc), etag, content_type_for(key))
+
+    def _replace_from(self, path, write):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=directory)
+        os.close(fd)
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def put(self, key, data, content_type=None):
+        def write(temp_path):
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        self._replace_from(self._path(key), write)
+
+    def get(self, key, byte_range=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if byte_range is None:
+                    return StoredObject(self._info(key, stat), f.read())
+
+                start, end = byte_range
+                if start >= stat.st_size:
+                    raise InvalidRange(f"{byte_range} is outside {key}")
+                end = stat.st_size - 1 if end is None else min(end, stat.st_size - 1)
+                f.seek(start)
+                return StoredObject(self._info(key, stat), f.read(end - start + 1), (start, end))
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise ObjectNotFound(key)
+
+    def stream(self, key, chunk_size=CHUNK_SIZE):
+        try:
+            f = open(self._path(key), 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise ObjectNotFound(key)
+        info = self._info(key, os.fstat(f.fileno()))
+        return info, _chunks(iter(lambda: f.read(chunk_size), b''), f.close)
+
+    def head(self, key):
+        try:
+            stat = os.stat(self._path(key))
+        except (OSError, ObjectNotFound):
+            return None
+        return self._info(key, stat) if S_ISREG(stat.st_mode) else None
+
+    def list_range(self, prefix='', start_after=None, end_before=None, limit=None):
+        """Objects with `prefix` in (start_after, end_before), in key order, at most `limit` of them.
+
+        Directories wholly outside the range are never opened, so listing an
+        hour only reads the directories on the way down to it.
+        """
+        if limit is not None and limit <= 0:
+            return
+        count = 0
+        for key, entry in self._walk('', prefix, start_after, end_before):
+            yield self._info(key, entry.stat())
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+    def _walk(self, directory_key, prefix, start_after, end_before):
+        try:
+            entries = list(os.scandir(os.path.join(self.root, directory_key)))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+
+        # A directory sorts as 'name/', which puts the walk in the same
+        # lexicographic order S3 lists keys in. Dotfiles are in-flight writes.
+        children = sorted((directory_key + entry.name + ('/' if entry.is_dir() else ''), entry)
+                          for entry in entries if not entry.name.startswith('.'))
+        for key, entry in children:
+            if end_before is not None and key >= end_before:
+                return
+            if key.endswith('/'):
+                # Everything below starts with `key`
+                if not (key.startswith(prefix) or prefix.startswith(key)):
+                    continue
+                if start_after is not None and key < start_after and not start_after.startswith(key):
+                    continue
+                yield from self._walk(key, prefix, start_after, end_before)
+            elif key.startswith(prefix) and (start_after is None or key > start_after):
+                yield key, entry
+
+    def delete_batch(self, keys):
+        """Delete files, returns the keys that couldn't be removed. Emptied directories go too."""
+        failed = set()
+        directories = set()
+        for key in keys:
+            try:
+                path = self._path(key)
+                os.unlink(path)
+                directories.add(os.path.dirname(path))
+            except (FileNotFoundError, ObjectNotFound):
+                # Already gone, same as S3
+                pass
+            except OSError as e:
+                print(f"Failed to delete {key}: {e}")
+                failed.add(key)
+
+        # Deepest first, so an emptied hour can take its emptied day with it
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory != self.root and directory.startswith(self.root + os.sep):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+        return failed
+
+    def _link_or_copy(self, source, path):
+        # A hard link costs nothing and is safe, objects are only ever replaced, never modified in place
+        def write(temp_path):
+            try:
+                os.unlink(temp_path)
+                os.link(source, temp_path)
+            except OSError:
+                shutil.copyfile(source, temp_path)
+        try:
+            self._replace_from(path, write)
+        except FileNotFoundError:
+            raise ObjectNotFound(source)
+
+    def copy(self, source_key, key):
+        self._link_or_copy(self._path(source_key), self._path(key))
+
+    def download(self, key, path):
+        source = self._path(key)
+        self._link_or_copy(source, path)
+        try:
+            return self._info(key, os.stat(source))
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+
+def storage_from_env(**client_options):
+    """The backend picked by the WEBCAMTIMELAPSE_STORAGE environment variables.
+
+    WEBCAMTIMELAPSE_STORAGE is s3 (the default), local or minio. S3 and MinIO
+    use WEBCAMTIMELAPSE_BUCKET_NAME, local keeps everything under
+    WEBCAMTIMELAPSE_STORAGE_DIR. MinIO also needs WEBCAMTIMELAPSE_STORAGE_ENDPOINT
+    and takes its keys from WEBCAMTIMELAPSE_STORAGE_ACCESS_KEY and
+    WEBCAMTIMELAPSE_STORAGE_SECRET_KEY (or the usual AWS variables).
+    `client_options` (pool size, retries) are ignored by the local backend.
+    """
+    backend = os.getenv('WEBCAMTIMELAPSE_STORAGE', 's3').lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid WEBCAMTIMELAPSE_STORAGE {backend!r}. Choose from {', '.join(BACKENDS)}.")
+
+    if backend == 'local':
+        return LocalStorage(os.getenv('WEBCAMTIMELAPSE_STORAGE_DIR', DEFAULT_LOCAL_DIR))
+
+    bucket_name = os.getenv('WEBCAMTIMELAPSE_BUCKET_NAME')
+    if not bucket_name:
+        raise ValueError("No BUCKET_NAME environment variable set")
+
+    if backend == 'minio':
+        endpoint_url = os.getenv('WEBCAMTIMELAPSE_STORAGE_ENDPOINT')
+        if not endpoint_url:
+            raise ValueError("No WEBCAMTIMELAPSE_STORAGE_ENDPOINT environment variable set for the minio backend")
+        return MinioStorage(bucket_name, endpoint_url, os.getenv('WEBCAMTIMELAPSE_STORAGE_ACCESS_KEY'),
+                            os.getenv('WEBCAMTIMELAPSE_STORAGE_SECRET_KEY'), **client_options)
+
+    return S3Storage(bucket_name, **client_options)
@@ -0,0 +1,201 @@
+import argparse
+import json
+import threading
+import time as time_module
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from renditions import RENDITIONS, decode_image, render_rendition
+from s3_layout import floor_hour, list_frames, rendition_key, strip_key
+from storage import ObjectNotFound
+
+# An hour of one rendition size packed into a single object, so the scrubber
+# gets an hour of frames in one request instead of one request per frame:
+#
+#   STRIP_MAGIC, 4 byte big-endian length of the index, the index JSON, then
+#   the JPEGs back to back
+#
+# The index is {"hour", "size", "frames": [{"key", "offset", "length"}]} with
+# offsets counted from the first JPEG, oldest frame first.
+
+STRIP_MAGIC = b'WTLS1\n'
+STRIP_CONTENT_TYPE = 'application/octet-stream'
+# Writes of what's left when the writer stops, a failed hour is retried on the next
+STOP_ATTEMPTS = 3
+STOP_RETRY_DELAY = 1
+
+
+def pack_strip(hour, size, frames):
+    """Strip bytes for `frames`, (key, jpeg bytes) pairs in order."""
+    index = []
+    offset = 0
+    for key, data in frames:
+        index.append({'key': key, 'offset': offset, 'length': len(data)})
+        offset += len(data)
+    header = json.dumps({'hour': hour.isoformat(), 'size': size, 'frames': index}, separators=(',', ':')).encode('utf-8')
+    return b''.join([STRIP_MAGIC, len(header).to_bytes(4, 'big'), header] + [data for _, data in frames])
+
+
+def unpack_strip(data):
+    """(key, jpeg bytes) pairs from strip bytes, raises ValueError for anything else."""
+    if not data.startswith(STRIP_MAGIC):
+        raise ValueError("Not a frame strip")
+    start = len(STRIP_MAGIC) + 4
+    header_length = int.from_bytes(data[len(STRIP_MAGIC):start], 'big')
+    index = json.loads(data[start:start + header_length])
+    base = start + header_length
+    return [(frame['key'], data[base + frame['offset']:base + frame['offset'] + frame['length']]) for frame in index['frames']]
+
+
+def read_strip(storage, key):
+    try:
+        return unpack_strip(storage.get(key).data)
+    except ObjectNotFound:
+        return []
+
+
+class StripWriter:
+    """Packs one rendition size into hourly strips as frames are captured.
+
+    `add_frame` only appends in memory. A background thread writes the
+    strips of the hours that changed, at most every `interval` seconds, so a
+    slow PUT never holds up the pipeline and two writes of one strip never
+    race. The first write of an hour merges what's already in storage, which
+    picks the strip up again after a restart. Only the newest hour stays in
+    memory once written.
+    """
+
+    def __init__(self, storage, size, interval=60):
+        self.storage = storage
+        self.size = size
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        # hour -> {key: jpeg bytes}
+        self._frames = {}
+        self._dirty = set()
+        # Hours already merged with their strip in storage
+        self._loaded = set()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"strip-writer-{self.size}", daemon=True)
+        self._thread.start()
+        return self
+
+    def add_frame(self, key, captured_utc, data):
+        hour = floor_hour(captured_utc)
+        with self._lock:
+            self._frames.setdefault(hour, {})[key] = data
+            self._dirty.add(hour)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.write()
+
+        # Frames added while the last write ran (stop() came in the middle of
+        # it) are still dirty, as are hours whose write failed
+        for attempt in range(STOP_ATTEMPTS):
+            if attempt:
+                time_module.sleep(STOP_RETRY_DELAY)
+            self.write()
+            with self._lock:
+                if not self._dirty:
+                    return
+        print(f"Gave up writing the {self.size} strips of {', '.join(hour.isoformat() for hour in sorted(self._dirty))}")
+
+    def write(self):
+        with self._lock:
+            dirty = sorted(self._dirty)
+            self._dirty = set()
+
+        for hour in dirty:
+            key = strip_key(self.size, hour)
+            try:
+                if hour not in self._loaded:
+                    existing = read_strip(self.storage, key)
+                    with self._lock:
+                        frames = self._frames[hour]
+                        for frame_key, data in existing:
+                            frames.setdefault(frame_key, data)
+                    self._loaded.add(hour)
+
+                with self._lock:
+                    frames = sorted(self._frames[hour].items())
+                self.storage.put(key, pack_strip(hour, self.size, frames), STRIP_CONTENT_TYPE)
+            except Exception as e:
+                print(f"Failed to write strip {key}: {e}")
+                traceback.print_exc()
+                with self._lock:
+                    self._dirty.add(hour)
+
+        with self._lock:
+            if self._frames:
+                newest = max(self._frames)
+                for hour in list(self._frames):
+                    if hour != newest and hour not in self._dirty:
+                        del self._frames[hour]
+                        self._loaded.discard(hour)
+
+    def stop(self):
+        # The thread writes whatever is left on its way out
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def build_strip(storage, hour, size, workers=8):
+    """Build the `size` strip of `hour` from its renditions (or the originals), returns its frame count."""
+    keys = [frame['key'] for frame in list_frames(storage, hour, hour + timedelta(hours=1))]
+    if not keys:
+        return 0
+
+    def load(key):
+        try:
+            return storage.get(rendition_key(key, size)).data
+        except ObjectNotFound:
+            try:
+                data = storage.get(key).data
+            except ObjectNotFound:
+                return None
+            return render_rendition(decode_image(data, RENDITIONS[size]), RENDITIONS[size])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = [(key, data) for key, data in zip(keys, executor.map(load, keys)) if data is not None]
+    if frames:
+        storage.put(strip_key(size, hour), pack_strip(hour, size, frames), STRIP_CONTENT_TYPE)
+    return len(frames)
+
+
+def main():
+    # Backfill for hours captured before strips existed, or to repair one
+    from storage import storage_from_env
+
+    parser = argparse.ArgumentParser(description="Build the frame strips of recent hours.")
+    parser.add_argument('--hours', type=float, default=168, help="How far back to go")
+    parser.add_argument('--size', default='thumb', choices=sorted(RENDITIONS))
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    storage = storage_from_env(max_pool_connections=args.workers)
+    now = datetime.now(timezone.utc)
+    hour = floor_hour(now - timedelta(hours=args.hours))
+    built = 0
+    while hour <= now:
+        count = build_strip(storage, hour, args.size, args.workers)
+        if count:
+            print(f"{strip_key(args.size, hour)}: {count} frames")
+            built += 1
+        hour += timedelta(hours=1)
+    print(f"Built {built} strips in {storage}")
+
+
+if __name__ == "__main__":
+    main()
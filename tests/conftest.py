@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'website', 'api_server'))
+
+from s3_layout import ManifestWriter, frame_key
+from storage import LocalStorage
+
+API_FRAMES = 120
+API_FRAME_SIZE = (1920, 1080)
+
+# Several modules (server.py, assemble_timelapse.py) set up their storage and
+# caches from the environment when they're imported, so it's set before any
+# test module is collected
+TMP = tempfile.mkdtemp(prefix='webcamtimelapse-tests-')
+os.environ.update({
+    'WEBCAMTIMELAPSE_STORAGE': 'local',
+    'WEBCAMTIMELAPSE_STORAGE_DIR': os.path.join(TMP, 'storage'),
+    'WEBCAMTIMELAPSE_CACHE_DIR': os.path.join(TMP, 'cache'),
+    'WEBCAMTIMELAPSE_CLIP_DIR': os.path.join(TMP, 'clips'),
+    'WEBCAMTIMELAPSE_DB_PATH': os.path.join(TMP, 'missing.db'),
+    # One render at a time and one waiting, so a test can fill the queue
+    'WEBCAMTIMELAPSE_CLIP_WORKERS': '1',
+    'WEBCAMTIMELAPSE_CLIP_QUEUE': '1',
+})
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP, ignore_errors=True)
+
+
+def seed_frames(storage, frames, size=API_FRAME_SIZE):
+    # One frame a minute ending an hour ago, each with its number drawn big
+    start = datetime.now(timezone.utc).replace(second=0, microsecond=0) - timedelta(hours=1, minutes=frames)
+    manifests = ManifestWriter(storage)
+    keys = []
+    for i in range(frames):
+        frame = np.full((size[1], size[0], 3), (i * 2) % 256, np.uint8)
+        cv2.putText(frame, str(i), (size[0] // 10, size[1] * 2 // 3), cv2.FONT_HERSHEY_SIMPLEX, size[1] / 54, (255, 255, 255),
+                    max(1, size[1] // 27))
+        captured = start + timedelta(minutes=i)
+        key = frame_key(captured)
+        storage.put(key, cv2.imencode('.jpg', frame)[1].tobytes(), 'image/jpeg')
+        manifests.add_frame(key, captured)
+        keys.append(key)
+    manifests.flush()
+    return start, start + timedelta(minutes=frames), keys
+
+
+@pytest.fixture(scope='session')
+def api():
+    """server.py over the local storage directory, seeded with API_FRAMES frames."""
+    since, until, keys = seed_frames(LocalStorage(os.environ['WEBCAMTIMELAPSE_STORAGE_DIR']), API_FRAMES)
+
+    import server
+    return SimpleNamespace(server=server, client=server.app.test_client(), since=since, until=until, keys=keys)
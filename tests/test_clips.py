@@ -0,0 +1,174 @@
+import queue
+import shutil
+import threading
+import time as time_module
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import pytest
+
+from clips import DONE, QUEUED, ClipParams, ClipRenderer
+from renditions import DiskCache
+
+from conftest import API_FRAMES
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg on PATH")
+
+PARAMS = ClipParams(datetime(2024, 8, 1, tzinfo=timezone.utc), datetime(2024, 8, 2, tzinfo=timezone.utc))
+KEYS = [f'frames/2024/08/01/00/2024_08_01_00_{minute:02}_00.jpg' for minute in range(10)]
+
+
+def renderers(directory, count, max_queued=8):
+    # API worker processes, sharing the clip directory; not started, so jobs stay queued
+    return [ClipRenderer(DiskCache(str(directory), 1024 ** 3), None, max_queued=max_queued) for _ in range(count)]
+
+
+def test_identical_submits_in_one_worker_share_a_job(tmp_path):
+    renderer, = renderers(tmp_path, 1)
+    first = renderer.submit(PARAMS, KEYS)
+    assert first.status == QUEUED
+    assert renderer.submit(PARAMS, KEYS) is first
+    assert renderer._queue.qsize() == 1
+
+
+def test_identical_submits_in_other_workers_share_the_claimed_job(tmp_path):
+    workers = renderers(tmp_path, 4)
+    jobs = []
+    threads = [threading.Thread(target=lambda renderer=renderer: jobs.append(renderer.submit(PARAMS, KEYS))) for renderer in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({job.id for job in jobs}) == 1
+    assert all(job.status == QUEUED for job in jobs)
+    # Exactly one worker renders it
+    assert sum(renderer._queue.qsize() for renderer in workers) == 1
+    # And the others answer for it
+    assert all(renderer.get(jobs[0].id).status == QUEUED for renderer in workers)
+
+
+def test_a_running_job_is_not_reset_to_queued_by_another_worker(tmp_path):
+    first, second = renderers(tmp_path, 2)
+    job = first.submit(PARAMS, KEYS)
+    job.status = 'running'
+    first._save(job)
+
+    assert second.submit(PARAMS, KEYS).status == 'running'
+    assert first.get(job.id).status == 'running'
+    assert second._queue.qsize() == 0
+
+
+def test_a_full_queue_raises_without_claiming(tmp_path):
+    renderer, other = renderers(tmp_path, 2, max_queued=1)
+    renderer.submit(PARAMS, KEYS)
+    with pytest.raises(queue.Full):
+        renderer.submit(PARAMS, KEYS[:5])
+    # Not left claimed by the worker that had no room
+    assert other.submit(PARAMS, KEYS[:5]).status == QUEUED
+    assert other._queue.qsize() == 1
+
+
+def test_unknown_and_malformed_ids_are_not_found(tmp_path):
+    renderer, = renderers(tmp_path, 1)
+    assert renderer.get('0' * 40) is None
+    assert renderer.get('../../etc/passwd') is None
+
+
+def wait(client, job, timeout=120):
+    deadline = time_module.monotonic() + timeout
+    while job['status'] in ('queued', 'running') and time_module.monotonic() < deadline:
+        time_module.sleep(0.1)
+        job = client.get(job['url']).get_json()
+    return job
+
+
+def video_info(path):
+    capture = cv2.VideoCapture(str(path))
+    frames = 0
+    size = None
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames += 1
+        size = (frame.shape[1], frame.shape[0])
+    capture.release()
+    return frames, size
+
+
+def window(api, **params):
+    return dict({'since': api.since.isoformat(), 'until': api.until.isoformat()}, **params)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize('params, frames, size, extension', [
+    ({'fps': 24, 'width': 640}, API_FRAMES, (640, 360), '.mp4'),
+    ({'fps': 30, 'width': 320, 'step': 2, 'format': 'webm'}, (API_FRAMES + 1) // 2, (320, 180), '.webm'),
+])
+def test_clip_renders_end_to_end(api, tmp_path, params, frames, size, extension):
+    client = api.client
+    response = client.post('/clips', json=window(api, **params))
+    assert response.status_code == 202
+    job = wait(client, response.get_json())
+    assert job['status'] == DONE, job['error']
+
+    video = client.get(job['video_url'])
+    assert video.status_code == 200
+    path = tmp_path / f'clip{extension}'
+    path.write_bytes(video.data)
+    assert video_info(path) == (frames, size)
+    assert client.get(job['video_url'], headers={'If-None-Match': video.headers['ETag']}).status_code == 304
+
+    # Asking again is served from the cache
+    again = client.post('/clips', json=window(api, **params))
+    assert again.status_code == 200
+    assert again.get_json()['id'] == job['id']
+
+    # Another API worker answers for the job and finds the clip
+    other = ClipRenderer(DiskCache(api.server.CLIP_DIR, api.server.CLIP_MB * 1024 ** 2), None)
+    other_job = other.get(job['id'])
+    assert other_job.status == DONE
+    assert other.video(other_job) is not None
+
+
+@needs_ffmpeg
+def test_identical_requests_share_one_render(api):
+    params = window(api, fps=12, width=480)
+    ids = []
+    threads = [threading.Thread(target=lambda: ids.append(api.client.post('/clips', json=params).get_json()['id'])) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(ids) == 8 and len(set(ids)) == 1
+    assert wait(api.client, api.client.get(f'/clips/{ids[0]}').get_json())['status'] == DONE
+
+
+@needs_ffmpeg
+def test_a_full_queue_answers_503(api):
+    responses = [api.client.post('/clips', json=window(api, fps=fps, width=1280)) for fps in range(1, 5)]
+    try:
+        assert 503 in [response.status_code for response in responses]
+        assert responses[-1].status_code in (202, 503)
+    finally:
+        # Before the storage goes away under them
+        for response in responses:
+            if response.status_code == 202:
+                wait(api.client, response.get_json())
+
+
+@pytest.mark.parametrize('params', [{'fps': 0}, {'fps': 61}, {'width': 8}, {'format': 'avi'}, {'until': None}])
+def test_bad_parameters_are_a_400(api, params):
+    body = {key: value for key, value in window(api, **params).items() if value is not None}
+    assert api.client.post('/clips', json=body).status_code == 400
+
+
+def test_an_empty_range_is_a_404(api):
+    body = {'since': (api.since - timedelta(days=2)).isoformat(), 'until': (api.since - timedelta(days=1)).isoformat()}
+    assert api.client.post('/clips', json=body).status_code == 404
+
+
+def test_an_unknown_clip_is_a_404(api):
+    assert api.client.get('/clips/0000').status_code == 404
+    assert api.client.get(f"/clips/{'0' * 40}/video").status_code == 404
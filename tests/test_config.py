@@ -0,0 +1,73 @@
+import os
+import shutil
+
+import pytest
+import yaml
+
+from conftest import ROOT
+from config import ConfigError, SettingsWatcher, parse_settings
+
+SETTINGS_YAML = os.path.join(ROOT, 'settings.yaml')
+
+
+@pytest.fixture
+def settings_path(tmp_path):
+    path = tmp_path / 'settings.yaml'
+    shutil.copy(SETTINGS_YAML, path)
+    return str(path)
+
+
+def rewrite(path, **settings):
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    config['settings'].update(settings)
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def test_watcher_reloads_a_changed_file(settings_path):
+    watcher = SettingsWatcher(settings_path)
+    first = watcher.current()
+    assert watcher.current() is first
+
+    rewrite(settings_path, FREQUENCY=first.frequency + 1)
+    assert watcher.current().frequency == first.frequency + 1
+
+
+def test_watcher_keeps_previous_settings_while_the_file_is_missing(settings_path):
+    watcher = SettingsWatcher(settings_path)
+    first = watcher.current()
+
+    # An editor that deletes the file and writes a new one
+    os.unlink(settings_path)
+    assert watcher.current() is first
+    assert watcher.current() is first
+
+    shutil.copy(SETTINGS_YAML, settings_path)
+    rewrite(settings_path, FREQUENCY=first.frequency + 2)
+    assert watcher.current().frequency == first.frequency + 2
+
+
+def test_watcher_keeps_previous_settings_on_a_bad_edit(settings_path):
+    watcher = SettingsWatcher(settings_path)
+    first = watcher.current()
+    rewrite(settings_path, FREQUENCY=-1)
+    assert watcher.current() is first
+
+
+def test_watcher_raises_without_settings_to_fall_back_to(tmp_path):
+    with pytest.raises(OSError):
+        SettingsWatcher(str(tmp_path / 'missing.yaml')).current()
+
+
+def load(**sections):
+    with open(SETTINGS_YAML) as f:
+        config = yaml.safe_load(f)
+    config.update(sections)
+    return config
+
+
+def test_camera_schedule_names_must_be_camera_properties():
+    assert parse_settings(load(camera_schedule={'BRIGHTNESS': {'day': 120, 'night': 128}})).camera_schedule
+    with pytest.raises(ConfigError, match='BRIGTNESS'):
+        parse_settings(load(camera_schedule={'BRIGTNESS': {'day': 120, 'night': 128}}))
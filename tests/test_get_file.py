@@ -0,0 +1,130 @@
+import hashlib
+import threading
+
+from renditions import CacheFill
+
+from conftest import API_FRAMES
+
+
+def frame_bytes(api, key):
+    return api.server.storage.get(key).data
+
+
+def test_a_miss_is_streamed_then_served_with_an_etag(api):
+    key = api.keys[0]
+    data = frame_bytes(api, key)
+
+    first = api.client.get('/get-file', query_string={'file_key': key})
+    assert first.status_code == 200
+    assert first.headers['X-Cache'] == 'MISS'
+    assert first.data == data
+    assert 'immutable' in first.headers['Cache-Control']
+
+    again = api.client.get('/get-file', query_string={'file_key': key})
+    assert again.headers['X-Cache'] in ('HIT', 'MEMORY')
+    assert again.data == data
+    assert again.headers['ETag'].strip('"') == hashlib.sha1(data).hexdigest()
+    assert api.client.get('/get-file', query_string={'file_key': key},
+                          headers={'If-None-Match': again.headers['ETag']}).status_code == 304
+
+
+def test_a_range_request_on_a_miss_is_a_206(api):
+    key = api.keys[1]
+    response = api.client.get('/get-file', query_string={'file_key': key}, headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert response.data == frame_bytes(api, key)[:100]
+
+
+def test_renditions_are_downscaled_jpegs(api):
+    response = api.client.get('/get-file', query_string={'file_key': api.keys[2], 'size': 'thumb'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert len(response.data) < len(frame_bytes(api, api.keys[2]))
+
+
+def test_bad_requests(api):
+    assert api.client.get('/get-file').status_code == 400
+    assert api.client.get('/get-file', query_string={'file_key': 'manifests/x.json'}).status_code == 400
+    assert api.client.get('/get-file', query_string={'file_key': api.keys[0], 'size': 'huge'}).status_code == 400
+    missing = api.keys[0].replace('.jpg', '.png')
+    assert api.client.get('/get-file', query_string={'file_key': missing}).status_code == 404
+
+
+def test_the_first_chunk_reaches_the_client_before_storage_finishes(api):
+    server = api.server
+    more = threading.Event()
+
+    def load():
+        yield b'first'
+        # Storage is still sending the rest
+        assert more.wait(5)
+        yield b'second'
+
+    with server.app.test_request_context('/get-file'):
+        response = server.serve_cached('streamed-test.jpg', load, 'streamed.jpg')
+    assert response.headers['X-Cache'] == 'MISS'
+    body = iter(response.response)
+    assert next(body) == b'first'
+
+    # Another request for it waits for the fill and gets the whole entry
+    waiting = {}
+    follower = threading.Thread(target=lambda: waiting.update(result=server.rendition_cache.stream('streamed-test.jpg', load)))
+    follower.start()
+    more.set()
+    assert list(body) == [b'second']
+    response.close()
+    follower.join(5)
+
+    status, (path, etag) = waiting['result']
+    assert status in ('COALESCED', 'HIT')
+    with open(path, 'rb') as f:
+        assert f.read() == b'firstsecond'
+    assert server.hot_cache.get('streamed-test.jpg') == (b'firstsecond', etag)
+
+
+def test_a_client_that_disconnects_still_completes_the_entry(api):
+    cache = api.server.rendition_cache
+    status, fill = cache.stream('abandoned-test.jpg', lambda: [b'a', b'b', b'c'])
+    assert status == 'MISS' and isinstance(fill, CacheFill)
+    body = iter(fill)
+    assert next(body) == b'a'
+    fill.close()
+
+    path, _ = cache.get('abandoned-test.jpg')
+    with open(path, 'rb') as f:
+        assert f.read() == b'abc'
+
+
+def test_a_failed_fill_leaves_nothing_behind(api):
+    cache = api.server.rendition_cache
+
+    def load():
+        yield b'partial'
+        raise IOError("connection reset")
+
+    status, fill = cache.stream('failed-test.jpg', load)
+    body = iter(fill)
+    assert next(body) == b'partial'
+    try:
+        next(body)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("the storage error was swallowed")
+    assert cache.get('failed-test.jpg') is None
+
+
+def test_list_files_pages_through_every_frame(api):
+    keys = []
+    cursor = None
+    while True:
+        params = {'since': api.since.isoformat(), 'limit': 50}
+        if cursor:
+            params['cursor'] = cursor
+        page = api.client.get('/list-files', query_string=params).get_json()
+        keys += page['files']
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert keys == api.keys
+    assert len(keys) == API_FRAMES
@@ -0,0 +1,71 @@
+import os
+
+from renditions import DiskCache, MemoryCache
+
+
+def directory_bytes(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith('.'))
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), 250)
+    for name in 'abc':
+        cache.put(name, b'x' * 100)
+    assert cache.get('a') is None
+    assert cache.get('b') is not None and cache.get('c') is not None
+    assert directory_bytes(tmp_path) <= 250
+
+
+def test_disk_cache_etag_is_the_sha1(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000)
+    path, etag = cache.put('a', b'hello')
+    assert etag == 'aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+    # And survives a restart
+    assert DiskCache(str(tmp_path), 1000).get('a') == (path, etag)
+
+
+def test_disk_cache_cap_covers_every_process_sharing_the_directory(tmp_path):
+    # API workers, each with its own index of the one directory
+    workers = [DiskCache(str(tmp_path), 1000, sync_interval=0) for _ in range(4)]
+    for i in range(20):
+        workers[i % 4].put(f'entry-{i}', b'x' * 100)
+        assert directory_bytes(tmp_path) <= 1000
+    # The newest survive, whoever wrote them
+    assert all(workers[0].get(f'entry-{i}') is not None for i in range(10, 20))
+
+
+def test_disk_cache_forgets_what_another_process_evicted(tmp_path):
+    first = DiskCache(str(tmp_path), 1000, sync_interval=0)
+    second = DiskCache(str(tmp_path), 1000, sync_interval=0)
+    first.put('a', b'x' * 600)
+    second.put('b', b'x' * 600)
+    assert first.get('a') is None
+    first.put('c', b'x' * 100)
+    assert first.total_bytes == 700
+
+
+def test_disk_cache_fetch_loads_once(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000)
+    calls = []
+
+    def load():
+        calls.append(1)
+        return [b'ab', b'cd']
+
+    path, _, status = cache.fetch('a', load)
+    assert status == 'MISS'
+    assert cache.fetch('a', load)[2] == 'HIT'
+    assert len(calls) == 1
+    with open(path, 'rb') as f:
+        assert f.read() == b'abcd'
+
+
+def test_memory_cache_keeps_the_newest_within_its_limits():
+    cache = MemoryCache(2, 1000, max_item_bytes=100)
+    cache.put('a', b'1', 'ea')
+    cache.put('b', b'2', 'eb')
+    cache.put('c', b'3', 'ec')
+    cache.put('big', b'x' * 200, 'ebig')
+    assert cache.get('a') is None
+    assert cache.get('c') == (b'3', 'ec')
+    assert cache.get('big') is None
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from database import connect, format_utc, initialize_schema
+from renditions import RENDITIONS
+from retention import delete_expired_frames
+from s3_layout import floor_hour, frame_key, rendition_key, strip_key
+from storage import S3Storage
+
+moto = pytest.importorskip('moto', reason="needs moto: pip install \"moto[s3]\"")
+boto3 = pytest.importorskip('boto3')
+
+BUCKET_NAME = 'retention-test'
+RETENTION_HOURS = 24
+
+
+@pytest.fixture
+def bucket(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET_NAME)
+        conn = connect(str(tmp_path / 'timelapse.db'))
+        initialize_schema(conn)
+        try:
+            yield s3, conn, str(tmp_path / 'timelapse.db')
+        finally:
+            conn.close()
+
+
+def seed(s3, conn, captured_times):
+    # Each frame with all its renditions and the strips of its hour
+    rows = []
+    keys = {}
+    for captured in captured_times:
+        key = frame_key(captured)
+        objects = [key] + [rendition_key(key, size) for size in RENDITIONS] + [strip_key(size, floor_hour(captured)) for size in RENDITIONS]
+        for object_key in objects:
+            s3.put_object(Bucket=BUCKET_NAME, Key=object_key, Body=b'')
+        keys[key] = objects
+        rows.append((captured.astimezone().replace(tzinfo=None), key, format_utc(captured)))
+    conn.executemany('INSERT INTO frames (timestamp, s3_key, captured_utc) VALUES (?, ?, ?)', rows)
+    conn.commit()
+    return keys
+
+
+def listed(s3):
+    paginator = s3.get_paginator('list_objects_v2')
+    return {obj['Key'] for page in paginator.paginate(Bucket=BUCKET_NAME) for obj in page.get('Contents', [])}
+
+
+def test_a_sweep_deletes_exactly_the_expired_frames_renditions_and_strips(bucket):
+    s3, conn, db_path = bucket
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    # Expired ones a few hours clear of the cutoff, so every hour they're in
+    # is past it too; live ones well inside the window
+    expired = seed(s3, conn, [now - timedelta(hours=RETENTION_HOURS + 6, minutes=10 * i) for i in range(30)])
+    live = seed(s3, conn, [now - timedelta(hours=RETENTION_HOURS - 6, minutes=10 * i) for i in range(30)])
+    s3.put_object(Bucket=BUCKET_NAME, Key='unrelated/object.txt', Body=b'')
+    before = listed(s3)
+
+    storage = S3Storage(BUCKET_NAME, client=s3)
+    assert delete_expired_frames(storage, RETENTION_HOURS, db_path) == len(expired)
+
+    expected_gone = {object_key for objects in expired.values() for object_key in objects}
+    assert before - listed(s3) == expected_gone
+    assert listed(s3) == {object_key for objects in live.values() for object_key in objects} | {'unrelated/object.txt'}
+
+    deleted = {key for key, deleted_at in conn.execute('SELECT s3_key, deleted_at FROM frames') if deleted_at is not None}
+    assert deleted == set(expired)
+
+    # Nothing is left to do
+    after = listed(s3)
+    assert delete_expired_frames(storage, RETENTION_HOURS, db_path) == 0
+    assert listed(s3) == after
+
+
+def test_frames_not_yet_in_storage_are_swept_without_error(bucket):
+    s3, conn, db_path = bucket
+    # Indexed but never uploaded, or already gone: deleting a missing key is a no-op
+    captured = datetime.now(timezone.utc) - timedelta(hours=RETENTION_HOURS * 2)
+    conn.execute('INSERT INTO frames (timestamp, s3_key, captured_utc) VALUES (?, ?, ?)',
+                 (captured.astimezone().replace(tzinfo=None), frame_key(captured), format_utc(captured)))
+    conn.commit()
+
+    storage = S3Storage(BUCKET_NAME, client=s3)
+    assert delete_expired_frames(storage, RETENTION_HOURS, db_path) == 1
+    assert delete_expired_frames(storage, RETENTION_HOURS, db_path) == 0
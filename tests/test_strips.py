@@ -0,0 +1,86 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import strips
+from s3_layout import strip_key
+from storage import LocalStorage
+from strips import StripWriter, pack_strip, read_strip, unpack_strip
+
+HOUR = datetime(2024, 8, 1, 12, tzinfo=timezone.utc)
+
+
+def frame(minute):
+    return f'frames/2024/08/01/12/2024_08_01_12_{minute:02}_00.jpg', HOUR + timedelta(minutes=minute), b'jpeg %d' % minute
+
+
+class BlockingStorage(LocalStorage):
+    """Holds the first strip PUT until `release` is set."""
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def put(self, key, data, content_type=None):
+        if key.startswith('strips/') and not self.writing.is_set():
+            self.writing.set()
+            self.release.wait(5)
+        return super().put(key, data, content_type)
+
+
+class FailingStorage(LocalStorage):
+    """Fails the first `failures` strip PUTs."""
+
+    def __init__(self, directory, failures):
+        super().__init__(directory)
+        self.failures = failures
+
+    def put(self, key, data, content_type=None):
+        if key.startswith('strips/') and self.failures:
+            self.failures -= 1
+            raise OSError("storage unavailable")
+        return super().put(key, data, content_type)
+
+
+def test_pack_and_unpack_round_trip():
+    frames = [('a', b'first'), ('b', b''), ('c', b'third')]
+    assert unpack_strip(pack_strip(HOUR, 'thumb', frames)) == frames
+
+
+def test_stop_writes_frames_added_during_an_in_flight_write(tmp_path):
+    storage = BlockingStorage(str(tmp_path))
+    writer = StripWriter(storage, 'thumb', interval=0.01).start()
+    writer.add_frame(*frame(0))
+    assert storage.writing.wait(5)
+
+    # Captured while the first write is stuck in its PUT, then shut down
+    writer.add_frame(*frame(1))
+    stopping = threading.Thread(target=writer.stop)
+    stopping.start()
+    storage.release.set()
+    stopping.join(10)
+
+    assert [key for key, _ in read_strip(storage, strip_key('thumb', HOUR))] == [frame(0)[0], frame(1)[0]]
+
+
+def test_stop_retries_a_failed_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(strips, 'STOP_RETRY_DELAY', 0)
+    storage = FailingStorage(str(tmp_path), failures=2)
+    writer = StripWriter(storage, 'thumb', interval=3600).start()
+    writer.add_frame(*frame(0))
+    writer.stop()
+
+    assert [key for key, _ in read_strip(storage, strip_key('thumb', HOUR))] == [frame(0)[0]]
+
+
+def test_a_restarted_writer_merges_the_stored_strip(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    writer = StripWriter(storage, 'thumb', interval=3600).start()
+    writer.add_frame(*frame(0))
+    writer.stop()
+
+    writer = StripWriter(storage, 'thumb', interval=3600).start()
+    writer.add_frame(*frame(1))
+    writer.stop()
+
+    assert read_strip(storage, strip_key('thumb', HOUR)) == [frame(0)[::2], frame(1)[::2]]
@@ -1,59 +1,158 @@
 import cv2
 import os
-import boto3
-from datetime import datetime, timedelta, timezone, time
-import math
+import threading
+from datetime import datetime, timezone, time
 import time as time_module
-import yaml
 import pytz
 from tabulate import tabulate
 import traceback
-import sqlite3
+import json
+import tempfile
+from camera_schedule import CameraSchedule
+from config import SettingsWatcher
+from database import DatabaseWriter
+from retention import delete_expired_frames, delete_expired_objects
+from renditions import RENDITIONS, render_rendition
+from s3_layout import ManifestWriter, frame_key, rendition_key
+from strips import StripWriter
+from frame_grabber import FrameGrabber
+from pipeline import Stage, Pipeline, BLOCK, DROP_NEWEST, DROP_OLDEST
+from scheduler import IntervalScheduler, PeriodicTrigger, build_curve
+from metrics import REGISTRY, start_http_server
+from overlay import OverlayCompositor, TextStyle
+from storage import storage_from_env
+from uploader import UploadQueue
 
 # Define the images directory
 images_dir = './images'
 
-# SQL db
-conn = sqlite3.connect('timelapse.db')
+IMAGE_CONTENT_TYPES = {'.jpg': 'image/jpeg', '.webp': 'image/webp', '.avif': 'image/avif'}
+
+# Extra destinations for every encoded frame, called as sink(image_bytes, job)
+# from the upload stage once the frame is queued for upload. archive_frame is
+# added per frame when debug.LOCAL_ARCHIVE_DIR is set.
+frame_sinks = []
+
+# Rolling hour/day manifests for uploaded frames, created on first upload.
+# Uploads finish on several threads, the lock keeps manifest writes in order.
+manifest_writer = None
+manifest_lock = threading.Lock()
+
+# Frames are uploaded in the background, failed uploads wait in the spool
+# directory (across restarts too) until storage is reachable again
+upload_queue = None
+UPLOAD_WORKERS = 4
+UPLOAD_SPOOL_DIR = './upload_spool'
+
+# Hourly strips of the encoding.strip_size rendition for the web scrubber,
+# written from a background thread, created on first frame
+strip_writer = None
+
+# SQL db, one long-lived batching writer per capture session
+db_writer = None
+SESSION_ID = None
 
 # Define the Central Time Zone
 central = pytz.timezone('US/Central')
 
 previous_times = {}
 
-# Load environment variables
-BUCKET_NAME = os.getenv('WEBCAMTIMELAPSE_BUCKET_NAME')
-if not BUCKET_NAME:
-    raise ValueError("No BUCKET_NAME environment variable set")
+# settings.yaml, reloaded only when it changes. SETTINGS is the validated
+# snapshot the module-level constants below were last bound from.
+settings_watcher = SettingsWatcher('settings.yaml')
+SETTINGS = None
+
+# Precomputed day of camera targets, see load_settings and calculate_camera_targets
+camera_schedule = CameraSchedule(central)
+
+# Capture deadlines. The interval comes from the fun_stuff.time_dilation curve,
+# or is just FREQUENCY when time dilation is off.
+interval_scheduler = IntervalScheduler()
+MAX_CATCH_UP = 3  # overdue frames taken back to back with OVERRUN_POLICY: catch_up
+RETENTION_INTERVAL = 3600  # seconds between retention sweeps
+previous_thumbnail = None
+
+# Overlay panels are rendered once per distinct text and blended in, see overlay.py
+overlay_compositor = OverlayCompositor()
+TIMESTAMP_STYLE = TextStyle(font_scale=0.6, thickness=2)
+PANEL_STYLE = TextStyle()
+TIMING_STYLE = TextStyle(line_type=cv2.LINE_8)
+
+# Capture pipeline queue sizes. Capture never waits on the sinks: a full
+# annotate queue drops its oldest frame, later stages apply backpressure.
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_BLOCK_TIMEOUT = 300  # seconds a stage may wait on a slow downstream stage
+
+# Scraped from http://127.0.0.1:METRICS_PORT/metrics, pipeline.py adds the
+# per-stage queue metrics
+STEP_SECONDS = REGISTRY.histogram('timelapse_step_duration_seconds', 'Duration of each capture loop and pipeline step', labels=('step',))
+CAPTURE_LATENESS = REGISTRY.histogram('timelapse_capture_lateness_seconds', 'How late each capture started after its deadline')
+CAPTURE_FAILURES = REGISTRY.counter('timelapse_capture_failures', 'Frames the camera failed to deliver')
+CAMERA_DROPPED = REGISTRY.counter('timelapse_camera_dropped_frames', 'Frames the grabber discarded to stay current')
+SKIPPED_CAPTURES = REGISTRY.counter('timelapse_skipped_captures', 'Capture deadlines skipped after an overrun')
+ENCODED_BYTES = REGISTRY.histogram('timelapse_encoded_frame_bytes', 'Size of each encoded frame', labels=('format',),
+                                   buckets=(50e3, 100e3, 200e3, 400e3, 800e3, 1.6e6, 3.2e6, 6.4e6))
+SINK_FAILURES = REGISTRY.counter('timelapse_sink_failures', 'Extra frame sinks that raised', labels=('sink',))
+FRAMES_CAPTURED = REGISTRY.counter('timelapse_frames_captured', 'Frames handed to the pipeline')
+
+# S3, MinIO or a local directory, picked by the WEBCAMTIMELAPSE_STORAGE
+# environment variables (see storage.py). One pooled client for uploads,
+# manifests and retention.
+storage = storage_from_env(max_pool_connections=UPLOAD_WORKERS + 2)
 
 
 def load_settings():
+    global SETTINGS
     global MAX_RUNTIME_HOURS, IMAGE_RETENTION_HOURS, FREQUENCY
     global SUNRISE_TIME, SUNSET_TIME, NIGHT_BRIGHTNESS, DAY_BRIGHTNESS
     global SHOW_CAMERA_SETTINGS, SHOW_TIMESTAMP, SAVE_LOCAL_LATEST_IMG, SAVE_S3
-    global SHOW_TIMING, ENABLED, SAVE_SQLITE
-
-    with open('settings.yaml', 'r') as f:
-        config = yaml.safe_load(f)
-
-    settings = config['settings']
-    debug = config['debug']
-
-    MAX_RUNTIME_HOURS = settings['MAX_RUNTIME_HOURS']
-    IMAGE_RETENTION_HOURS = settings['IMAGE_RETENTION_HOURS']
-    FREQUENCY = settings['FREQUENCY']
-    SUNRISE_TIME = central.localize(datetime.strptime(settings['SUNRISE_TIME'], '%H:%M')).time()
-    SUNSET_TIME = central.localize(datetime.strptime(settings['SUNSET_TIME'], '%H:%M')).time()
-    NIGHT_BRIGHTNESS = settings['NIGHT_BRIGHTNESS']
-    DAY_BRIGHTNESS = settings['DAY_BRIGHTNESS']
-    ENABLED = settings['ENABLED']
+    global SHOW_TIMING, ENABLED, SAVE_SQLITE, METRICS_PORT
+    global CAPTURE_BUFFER_SIZE, SETTLE_FRAMES, OVERRUN_POLICY
+    global LATITUDE, LONGITUDE, TRANSITION_MINUTES, CAMERA_SCHEDULE
+
+    # One stat() per call, the file is only parsed when it changed
+    settings = settings_watcher.current()
+    if settings is SETTINGS:
+        return
+    SETTINGS = settings
+
+    MAX_RUNTIME_HOURS = settings.max_runtime_hours
+    IMAGE_RETENTION_HOURS = settings.image_retention_hours
+    FREQUENCY = settings.frequency
+    SUNRISE_TIME = settings.sunrise_time
+    SUNSET_TIME = settings.sunset_time
+    NIGHT_BRIGHTNESS = settings.night_brightness
+    DAY_BRIGHTNESS = settings.day_brightness
+    ENABLED = settings.enabled
+    CAPTURE_BUFFER_SIZE = settings.capture_buffer_size
+    SETTLE_FRAMES = settings.settle_frames
+    OVERRUN_POLICY = settings.overrun_policy
+    # With a location, sunrise/sunset are computed for each day instead of fixed
+    LATITUDE = settings.latitude
+    LONGITUDE = settings.longitude
+    TRANSITION_MINUTES = settings.transition_minutes
+    # Extra day/night targets, e.g. {'GAIN': {'day': 200, 'night': 255}}
+    CAMERA_SCHEDULE = settings.camera_schedule
     
-    SHOW_CAMERA_SETTINGS = debug['SHOW_CAMERA_SETTINGS']
-    SHOW_TIMESTAMP = debug['SHOW_TIMESTAMP']
-    SHOW_TIMING = debug['SHOW_TIMING']
-    SAVE_LOCAL_LATEST_IMG = debug['SAVE_LOCAL_LATEST_IMG']
-    SAVE_S3 = debug['SAVE_S3']
-    SAVE_SQLITE = debug['SAVE_SQLITE']
+    SHOW_CAMERA_SETTINGS = settings.show_camera_settings
+    SHOW_TIMESTAMP = settings.show_timestamp
+    SHOW_TIMING = settings.show_timing
+    SAVE_LOCAL_LATEST_IMG = settings.save_local_latest_img
+    SAVE_S3 = settings.save_s3
+    SAVE_SQLITE = settings.save_sqlite
+    METRICS_PORT = settings.metrics_port
+
+    # Only rebuilds its tables if any of this actually changed
+    camera_schedule.configure(
+        dict(CAMERA_SCHEDULE, BRIGHTNESS={'day': DAY_BRIGHTNESS, 'night': NIGHT_BRIGHTNESS}),
+        sunrise=SUNRISE_TIME, sunset=SUNSET_TIME, latitude=LATITUDE, longitude=LONGITUDE,
+        transition_seconds=TRANSITION_MINUTES * 60,
+    )
+    # Already validated by parse_settings. The frame count carries over so a
+    # reload doesn't restart the curve.
+    interval_scheduler.set_curve(build_curve(settings.time_dilation, FREQUENCY))
+    interval_scheduler.overrun_policy = OVERRUN_POLICY
+    interval_scheduler.max_catch_up = MAX_CATCH_UP
 
 def initialize_camera():
     load_settings()
@@ -63,199 +162,95 @@ def initialize_camera():
         print("Error: Cannot open webcam")
         raise IOError("Cannot open webcam")
 
+    # Grab in the background so a capture is always the newest frame
+    cap = FrameGrabber(cap, buffer_size=CAPTURE_BUFFER_SIZE, settle_frames=SETTLE_FRAMES).start()
+
     cap.set(cv2.CAP_PROP_GAIN, 215)
 
 
     print("Camera initialized successfully.")
     return cap
 
-def initialize_database(db_path='timelapse.db', conn=None):
-    global SESSION_ID
-    if conn is None:
-        conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS frames (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME,
-            file_name TEXT,
-            brightness INTEGER,
-            contrast INTEGER,
-            saturation INTEGER,
-            gain INTEGER,
-            white_balance_temperature INTEGER,
-            frequency INTEGER,
-            timelapse_session TEXT,
-            FOREIGN KEY (timelapse_session) REFERENCES timelapse_sessions(session_id)
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS timelapse_sessions (
-            session_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            start_time DATETIME,
-            end_time DATETIME
-        )
-    ''')
-
-    cursor.execute('''
-                   INSERT INTO timelapse_sessions (start_time)
-                   VALUES (?)
-                   ''', (datetime.now(),))
-    
-    SESSION_ID = cursor.lastrowid
-
-    conn.commit()
-
-def insert_frame_database(timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, db_path='timelapse.db'):
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO frames (timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, timelapse_session)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, SESSION_ID))
-    conn.commit()
-    conn.close()
-
-def close_session_database(db_path='timelapse.db', conn=None):
-    if conn is None:
-        conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE timelapse_sessions
-        SET end_time = ?
-        WHERE session_id = ?
-    ''', (datetime.now(), SESSION_ID))
-    conn.commit()
-    conn.close()
+def initialize_database(db_path='timelapse.db'):
+    global SESSION_ID, db_writer
+    db_writer = DatabaseWriter(db_path).start()
+    SESSION_ID = db_writer.start_session()
 
+def insert_frame_database(timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, s3_key=None, timings=None, image_size=None, captured_utc=None):
 
-def capture_frame(cap):
+    # Queued, the writer commits in batches
+    db_writer.insert_frame(timestamp, brightness, contrast, saturation, gain, white_balance_temperature, file_name, frequency, SESSION_ID, s3_key, timings, image_size, captured_utc)
 
-    ret, frame = cap.read()
-    if not ret:
-        print("Error: Failed to capture frame")
-        raise IOError("Failed to capture frame")
+def close_session_database():
+    global db_writer
+    # Safe to call more than once, e.g. from both the crash path and finally
+    if db_writer is None:
+        return
+    db_writer.close_session(SESSION_ID)
+    db_writer.close()
+    db_writer = None
 
-    # BUFFER FLUSH (TEST)
-    for i in range(60):
-        cap.read()
 
-    return frame
+def wait_for_next_second(last_captured_utc):
+    # Frame keys are whole seconds; catch-up captures come back to back and
+    # would otherwise share a key and overwrite each other. Capped at a
+    # second in case the wall clock stepped back.
+    if last_captured_utc is None:
+        return
+    remaining = int(last_captured_utc.timestamp()) + 1 - time_module.time()
+    if remaining > 0:
+        time_module.sleep(min(remaining, 1))
 
-def calculate_brightness(current_time):
-    # Convert times to seconds since midnight
-    def time_to_seconds(t):
-        return t.hour * 3600 + t.minute * 60 + t.second
-
-    current_seconds = time_to_seconds(current_time)
-    sunrise_seconds = time_to_seconds(SUNRISE_TIME)
-    sunset_seconds = time_to_seconds(SUNSET_TIME)
-
-    # Define transition duration (1 hour)
-    transition_duration = 3600  # 1 hour in seconds
-
-    # Calculate the duration of day and night
-    day_duration = sunset_seconds - sunrise_seconds
-    night_duration = 24 * 3600 - day_duration
-
-    if sunrise_seconds - transition_duration <= current_seconds <= sunrise_seconds + transition_duration:
-        # Morning transition
-        transition_progress = (current_seconds - (sunrise_seconds - transition_duration)) / (2 * transition_duration)
-        brightness = NIGHT_BRIGHTNESS + (DAY_BRIGHTNESS - NIGHT_BRIGHTNESS) * (0.5 * (1 + math.sin(math.pi * (transition_progress - 0.5))))
-    elif sunset_seconds - transition_duration <= current_seconds <= sunset_seconds + transition_duration:
-        # Evening transition
-        transition_progress = (current_seconds - (sunset_seconds - transition_duration)) / (2 * transition_duration)
-        brightness = DAY_BRIGHTNESS + (NIGHT_BRIGHTNESS - DAY_BRIGHTNESS) * (0.5 * (1 + math.sin(math.pi * (transition_progress - 0.5))))
-    elif sunrise_seconds + transition_duration < current_seconds < sunset_seconds - transition_duration:
-        # Daytime
-        brightness = DAY_BRIGHTNESS
-    else:
-        # Nighttime
-        brightness = NIGHT_BRIGHTNESS
-
-    return brightness
-
-def add_timestamp_to_frame(frame, timestamp, position='bottom-left'):
-
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.6
-    font_thickness = 2
-    margin = 5
-    text_color = (255, 255, 255)
-    background_color = (0, 0, 0)
-
-    text_size, _ = cv2.getTextSize(timestamp, font, font_scale, font_thickness)
-    text_width, text_height = text_size
-
-    if position == 'top-left':
-        text_x, text_y = margin, margin + text_height
-    elif position == 'top-right':
-        text_x, text_y = frame.shape[1] - text_width - margin, margin + text_height
-    elif position == 'bottom-left':
-        text_x, text_y = margin, frame.shape[0] - margin
-    elif position == 'bottom-right':
-        text_x, text_y = frame.shape[1] - text_width - margin, frame.shape[0] - margin
-    else:
-        raise ValueError("Invalid position. Choose from 'top-left', 'top-right', 'bottom-left', 'bottom-right'.")
 
-    cv2.rectangle(frame, (text_x - margin, text_y + margin), 
-                  (text_x + text_width + margin, text_y - text_height - margin), 
-                  background_color, -1)
-    cv2.putText(frame, timestamp, (text_x, text_y), font, font_scale, text_color, font_thickness, cv2.LINE_AA)
+def capture_frame(cap):
+
+    # Waits for a frame grabbed after the last brightness change instead of
+    # flushing the driver buffer
+    try:
+        frame = cap.read(wait_for_settings=True)
+    except IOError as e:
+        CAPTURE_FAILURES.inc()
+        print(f"Error: Failed to capture frame: {e}")
+        raise
 
     return frame
 
-def add_previous_timing(frame, times_list, position='top-right'):
+def measure_activity(frame):
+    """Mean absolute difference (0-255) to the previous frame, on a small grey thumbnail."""
+    global previous_thumbnail
+    thumbnail = cv2.cvtColor(cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    activity = 0.0 if previous_thumbnail is None else float(cv2.absdiff(thumbnail, previous_thumbnail).mean())
+    previous_thumbnail = thumbnail
+    return activity
+
+def read_camera_settings(cap):
+    # Read in the capture thread, the worker stages never touch cap
+    return {
+        'brightness': cap.get(cv2.CAP_PROP_BRIGHTNESS),
+        'contrast': cap.get(cv2.CAP_PROP_CONTRAST),
+        'saturation': cap.get(cv2.CAP_PROP_SATURATION),
+        'gain': cap.get(cv2.CAP_PROP_GAIN),
+        'white_balance_temperature': cap.get(cv2.CAP_PROP_WB_TEMPERATURE),
+    }
+
+def calculate_camera_targets(current_time):
+    # O(1) lookup into the table camera_schedule built for today
+    return camera_schedule.lookup(current_time)
+
+def calculate_brightness(current_time):
+    return calculate_camera_targets(current_time)['BRIGHTNESS']
+
+def add_timestamp_to_frame(frame, timestamp, position='bottom-left', offsets=None):
+    return overlay_compositor.compose(frame, [([timestamp], TIMESTAMP_STYLE, position)], offsets)
+
+def add_previous_timing(frame, times_list, position='top-right', offsets=None):
     # Safely format the duration, replacing None with a placeholder
     def format_duration(duration):
         return f"{duration:.2f}s" if duration is not None else "N/A"
 
     times_text = "--- PREVIOUS FRAME ---\n\n\n" + "\n\n".join([f"{task}: {format_duration(duration)}" for task, duration in times_list])
-    
-    # Define font and text properties
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.4
-    font_thickness = 1
-    margin = 5
-    text_color = (255, 255, 255)
-    background_color = (0, 0, 0)
-
-    # Split the times text into lines
-    lines = times_text.split('\n')
-    
-    # Calculate the maximum text width of all lines
-    max_text_width = 0
-    for line in lines:
-        text_size, _ = cv2.getTextSize(line, font, font_scale, font_thickness)
-        max_text_width = max(max_text_width, text_size[0])
-
-    # Calculate the size of the text box
-    text_height = text_size[1] * len(lines)
-    
-    # Determine the position of the text box
-    if position == 'top-left':
-        text_x, text_y = margin, margin + text_height
-    elif position == 'top-right':
-        text_x, text_y = frame.shape[1] - max_text_width - margin, margin + text_height
-    elif position == 'bottom-left':
-        text_x, text_y = margin, frame.shape[0] - margin
-    elif position == 'bottom-right':
-        text_x, text_y = frame.shape[1] - max_text_width - margin, frame.shape[0] - margin
-    else:
-        raise ValueError("Invalid position argument")
 
-    # Draw the background rectangle
-    cv2.rectangle(frame, (text_x - margin, text_y - text_height - margin), 
-                  (text_x + max_text_width + margin, text_y + margin), background_color, cv2.FILLED)
-    
-    # Draw each line of text
-    for i, line in enumerate(lines):
-        line_y = text_y - (len(lines) - i - 1) * text_size[1]
-        cv2.putText(frame, line, (text_x, line_y), font, font_scale, text_color, font_thickness)
-
-    return frame
+    return overlay_compositor.compose(frame, [(times_text.split('\n'), TIMING_STYLE, position)], offsets)
 
 def calculate_times(times):
     # Create a list to hold the times
@@ -272,22 +267,36 @@ def calculate_times(times):
     times_list.append(["Calculate brightness", safe_time_diff(times['calculate_brightness'][0], times['calculate_brightness'][1])])
     times_list.append(["Set brightness", safe_time_diff(times['set_brightness'][0], times['set_brightness'][1])])
     times_list.append(["Capture frame", safe_time_diff(times['capture_frame'][0], times['capture_frame'][1])])
-
-    if times["add_timestamp"]:
+    if times.get("capture_stats"):
+        grab_latency, frame_age, dropped_frames = times['capture_stats']
+        times_list.append(["Capture grab latency", grab_latency])
+        times_list.append(["Capture frame age", frame_age])
+        times_list.append(["Capture dropped frames", dropped_frames])
+
+    # Stage times come from the last frame that made it through the pipeline
+    if times.get("add_timestamp"):
         times_list.append(["Add timestamp", safe_time_diff(times['add_timestamp'][0], times['add_timestamp'][1])])
-    if times["add_camera_settings"]:
+    if times.get("add_camera_settings"):
         times_list.append(["Add camera settings", safe_time_diff(times['add_camera_settings'][0], times['add_camera_settings'][1])])
-    if times["save_frame"]:
+    if times.get("encode_frame"):
+        times_list.append(["Encode frame", safe_time_diff(times['encode_frame'][0], times['encode_frame'][1])])
+    if times.get("save_frame"):
         times_list.append(["Save frame", safe_time_diff(times['save_frame'][0], times['save_frame'][1])])
-    if times["upload_to_s3"]:
-        times_list.append(["Upload to S3", safe_time_diff(times['upload_to_s3'][0], times['upload_to_s3'][1])])
-    if times["delete_old_images"]:
-        times_list.append(["Delete old images from S3", safe_time_diff(times['delete_old_images'][0], times['delete_old_images'][1])])
-    if times["add_prev_timing"]:
+    if times.get("queue_upload"):
+        times_list.append(["Queue upload", safe_time_diff(times['queue_upload'][0], times['queue_upload'][1])])
+    if times.get("save_sqlite"):
+        times_list.append(["Save to SQLite", safe_time_diff(times['save_sqlite'][0], times['save_sqlite'][1])])
+    if times.get("delete_old_images"):
+        times_list.append(["Delete old images", safe_time_diff(times['delete_old_images'][0], times['delete_old_images'][1])])
+    if times.get("add_prev_timing"):
         times_list.append(["Add previous timing", safe_time_diff(times['add_prev_timing'][0], times['add_prev_timing'][1])])
 
     return times_list
 
+def record_step_times(times):
+    for step, (start, end) in times.items():
+        STEP_SECONDS.observe(end - start, step=step)
+
 def format_times_table(times_list, loop_duration, FREQUENCY, deviation, adjusted_sleep_duration):
     # Add additional information to the times list
     times_list.append(["Total loop duration", loop_duration])
@@ -304,92 +313,153 @@ def format_times_table(times_list, loop_duration, FREQUENCY, deviation, adjusted
 
     return output
 
-def save_frame(frame, images_dir):
+def encode_params(settings):
+    """cv2.imencode extension and flags for the configured output format."""
+    if settings.image_format == 'webp':
+        return '.webp', [cv2.IMWRITE_WEBP_QUALITY, settings.image_quality]
+    if settings.image_format == 'avif':
+        return '.avif', [cv2.IMWRITE_AVIF_QUALITY, settings.image_quality]
+    return '.jpg', [
+        cv2.IMWRITE_JPEG_QUALITY, settings.image_quality,
+        cv2.IMWRITE_JPEG_PROGRESSIVE, int(settings.jpeg_progressive),
+        cv2.IMWRITE_JPEG_OPTIMIZE, int(settings.jpeg_optimize),
+    ]
+
+def encode_frame(frame, settings):
+
+    # Encoded once in memory, every sink gets these same bytes
+    extension, params = encode_params(settings)
+    ok, buffer = cv2.imencode(extension, frame, params)
+    if not ok:
+        raise IOError(f"Failed to encode frame as {extension}")
+
+    return buffer.tobytes()
+
+def write_file_atomic(path, data):
+    # Readers (the web UI, an editor tab on last.jpg) never see a partial image
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix=os.path.splitext(path)[1], dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def save_frame(image_bytes, images_dir, extension='.jpg'):
 
-    image_path = os.path.join(images_dir, 'last.jpg')
-    cv2.imwrite(image_path, frame)
+    image_path = os.path.join(images_dir, f'last{extension}')
+    write_file_atomic(image_path, image_bytes)
 
     return image_path
 
-def upload_to_s3(image_path, timestamp):
+def upload_frame(image_bytes, captured_utc, extension='.jpg'):
+
+    key = frame_key(captured_utc, extension)
+    # A single PUT straight from memory, no temp file or multipart setup
+    storage.put(key, image_bytes, IMAGE_CONTENT_TYPES[extension])
+
+    return key
+
+def on_frame_uploaded(key, metadata):
+    # Renditions aren't frames, they stay out of the manifests
+    if 'rendition' in metadata:
+        return
+    metadata = dict(metadata)
+    captured_utc = datetime.fromisoformat(metadata.pop('captured_utc'))
+    add_frame_to_manifest(key, captured_utc, **metadata)
+
+def queue_upload(image_bytes, captured_utc, extension='.jpg', **metadata):
+    """Hand a frame to the background uploader, returns its key straight away."""
+    global upload_queue
+    if upload_queue is None:
+        upload_queue = UploadQueue(storage, UPLOAD_SPOOL_DIR, workers=UPLOAD_WORKERS, on_uploaded=on_frame_uploaded).start()
+
+    key = frame_key(captured_utc, extension)
+    # Kept JSON friendly, spooled frames store their metadata on disk
+    upload_queue.put(key, image_bytes, IMAGE_CONTENT_TYPES[extension], captured_utc=captured_utc.isoformat(), **metadata)
+    return key
+
+def queue_renditions(key, renditions):
+    # Queued after their frame, so they share its retries and spool
+    for size, image_bytes in renditions.items():
+        upload_queue.put(rendition_key(key, size), image_bytes, 'image/jpeg', rendition=size)
+
+def add_frame_to_strip(key, captured_utc, size, image_bytes):
+    global strip_writer
+    if strip_writer is not None and strip_writer.size != size:
+        # encoding.strip_size changed, finish the old strips first
+        stop_strip_writer()
+    if strip_writer is None:
+        strip_writer = StripWriter(storage, size).start()
+    strip_writer.add_frame(key, captured_utc, image_bytes)
+
+def stop_strip_writer():
+    global strip_writer
+    if strip_writer is None:
+        return
+    strip_writer.stop()
+    strip_writer = None
+
+def stop_upload_queue():
+    global upload_queue
+    if upload_queue is None:
+        return
+    upload_queue.stop()
+    upload_queue = None
+
+def archive_frame(image_bytes, job):
+    # Every frame, laid out like the bucket, under debug.LOCAL_ARCHIVE_DIR
+    extension, _ = encode_params(job['settings'])
+    write_file_atomic(os.path.join(job['settings'].local_archive_dir, frame_key(job['captured_utc'], extension)), image_bytes)
+
+def add_frame_to_manifest(key, captured_utc, **metadata):
+    global manifest_writer
+    with manifest_lock:
+        if manifest_writer is None:
+            manifest_writer = ManifestWriter(storage)
+        manifest_writer.add_frame(key, captured_utc, **metadata)
+
+def flush_manifests():
+    if manifest_writer is None:
+        return
+    try:
+        with manifest_lock:
+            manifest_writer.flush()
+    except Exception as e:
+        print(f"Failed to flush manifests: {e}")
 
-    s3 = boto3.client('s3')
-    with open(image_path, "rb") as data:
-        s3.upload_fileobj(data, 'pmc-timelapses', f'{timestamp.replace(":", "").replace(" ", "_")}.jpg')
 
+def delete_old_images():
 
-def delete_old_images_from_s3():
+    # The frames table knows every uploaded key, so only expired rows are
+    # touched. Without it fall back to listing the bucket.
+    if SAVE_SQLITE:
+        deleted = delete_expired_frames(storage, IMAGE_RETENTION_HOURS)
+    else:
+        deleted = delete_expired_objects(storage, IMAGE_RETENTION_HOURS)
 
-    s3 = boto3.client('s3')
-    retention_period = datetime.now(timezone.utc) - timedelta(hours=IMAGE_RETENTION_HOURS)
-    
-    objects = s3.list_objects_v2(Bucket=BUCKET_NAME)
-    if 'Contents' in objects:
-        for obj in objects['Contents']:
-            obj_time = obj['LastModified']
-            if obj_time < retention_period:
-                s3.delete_object(Bucket=BUCKET_NAME, Key=obj['Key'])
+    print(f"Deleted {deleted} expired images from {storage}")
 
 
 
-def add_camera_settings_to_frame(frame, cap, position='bottom-right'):
+def add_camera_settings_to_frame(frame, camera_settings, frequency, position='bottom-right', offsets=None):
 
     
-    # Retrieve camera settings
-    brightness = round(cap.get(cv2.CAP_PROP_BRIGHTNESS))
-    contrast = round(cap.get(cv2.CAP_PROP_CONTRAST))
-    saturation = round(cap.get(cv2.CAP_PROP_SATURATION))
-    gain = round(cap.get(cv2.CAP_PROP_GAIN))
-    white_balance_temperature = round(cap.get(cv2.CAP_PROP_WB_TEMPERATURE))
-
-    # Format the settings text
-    settings_text = f"Freq: {FREQUENCY}\n\nBrightness: {brightness}\n\nContrast: {contrast:}\n\nSaturation: {saturation:}\n\nGain: {gain:}\n\nWhite Balance: {white_balance_temperature:}"
-    
-    # Define font and text properties
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.4
-    font_thickness = 1
-    margin = 5
-    text_color = (255, 255, 255)
-    background_color = (0, 0, 0)
+    # Camera settings are read by the capture thread, see read_camera_settings
+    brightness = round(camera_settings['brightness'])
+    contrast = round(camera_settings['contrast'])
+    saturation = round(camera_settings['saturation'])
+    gain = round(camera_settings['gain'])
+    white_balance_temperature = round(camera_settings['white_balance_temperature'])
 
-    
-    # Split the settings text into lines
-    lines = settings_text.split('\n')
-    
-    # Calculate the maximum text width of all lines
-    max_text_width = 0
-    for line in lines:
-        text_size, _ = cv2.getTextSize(line, font, font_scale, font_thickness)
-        max_text_width = max(max_text_width, text_size[0])
-
-    # Calculate the size of the text box
-    text_height = text_size[1] * len(lines)
-    
-    # Determine the position of the text box
-    if position == 'top-left':
-        text_x, text_y = margin, margin + text_height
-    elif position == 'top-right':
-        text_x, text_y = frame.shape[1] - max_text_width - margin, margin + text_height
-    elif position == 'bottom-left':
-        text_x, text_y = margin, frame.shape[0] - margin
-    elif position == 'bottom-right':
-        text_x, text_y = frame.shape[1] - max_text_width - margin, frame.shape[0] - margin
-    else:
-        raise ValueError("Invalid position. Choose from 'top-left', 'top-right', 'bottom-left', 'bottom-right'.")
-    
-    # Draw the background rectangle
-    cv2.rectangle(frame, (text_x - margin, text_y + margin), 
-                  (text_x + max_text_width + margin, text_y - text_height - margin), 
-                  background_color, -1)
-    
-    # Overlay each line of text
-    for i, line in enumerate(lines):
-        y = text_y - (len(lines) - i - 1) * text_size[1]
-        cv2.putText(frame, line, (text_x, y), font, font_scale, text_color, font_thickness, cv2.LINE_AA)
-    
+    # Format the settings text. Time dilated intervals are rounded so the
+    # panel (and its cached sprite) doesn't change on every frame.
+    settings_text = f"Freq: {round(frequency, 1)}\n\nBrightness: {brightness}\n\nContrast: {contrast:}\n\nSaturation: {saturation:}\n\nGain: {gain:}\n\nWhite Balance: {white_balance_temperature:}"
 
-    return frame
+    return overlay_compositor.compose(frame, [(settings_text.split('\n'), PANEL_STYLE, position)], offsets)
 
 def take_test_image():
     cap = initialize_camera()
@@ -397,17 +467,20 @@ def take_test_image():
     try:
         frame = capture_frame(cap)
         
+        captured_utc = datetime.now(timezone.utc)
         if SHOW_TIMESTAMP:
-            timestamp = datetime.now(timezone.utc).strftime('%Y %m %d_%H %M %S')
+            timestamp = captured_utc.strftime('%Y %m %d_%H %M %S')
             frame = add_timestamp_to_frame(frame, timestamp)
         
         if SHOW_CAMERA_SETTINGS:
-            frame = add_camera_settings_to_frame(frame, cap)
+            frame = add_camera_settings_to_frame(frame, read_camera_settings(cap), FREQUENCY)
         
-        image_path = save_frame(frame, images_dir)
+        extension, _ = encode_params(SETTINGS)
+        image_bytes = encode_frame(frame, SETTINGS)
+        save_frame(image_bytes, images_dir, extension)
         
         if SAVE_S3:
-            upload_to_s3(image_path, timestamp)
+            upload_frame(image_bytes, captured_utc, extension)
         
 
     except Exception as e:
@@ -416,106 +489,246 @@ def take_test_image():
         cap.release()
         print("Camera released after taking test image.")
 
+def annotate_stage(job):
+    frame = job['frame']
+    times = job['times']
+    layout = job['settings'].overlay_layout
+    # Panels placed in the same corner stack instead of overlapping
+    offsets = {}
+
+    if job['settings'].show_timestamp:
+        add_timestamp_start = time_module.time()
+        image_timestamp = job['captured_local'].strftime('%m/%d/%Y %H:%M')
+        frame = add_timestamp_to_frame(frame, image_timestamp, layout['timestamp'], offsets)
+        times['add_timestamp'] = (add_timestamp_start, time_module.time())
+
+    if job['settings'].show_timing:
+        add_timing_start = time_module.time()
+        frame = add_previous_timing(frame, job['previous_times'], layout['timing'], offsets)
+        times['add_prev_timing'] = (add_timing_start, time_module.time())
+
+    if job['settings'].show_camera_settings:
+        add_camera_settings_start = time_module.time()
+        frame = add_camera_settings_to_frame(frame, job['camera_settings'], job['frequency'], layout['camera_settings'], offsets)
+        times['add_camera_settings'] = (add_camera_settings_start, time_module.time())
+
+    job['frame'] = frame
+    return job
+
+def encode_stage(job):
+    times = job['times']
+
+    encode_frame_start = time_module.time()
+    job['extension'], _ = encode_params(job['settings'])
+    job['image_bytes'] = encode_frame(job['frame'], job['settings'])
+    times['encode_frame'] = (encode_frame_start, time_module.time())
+
+    # Web UI sizes, from the frame in memory instead of decoding the upload later
+    job['renditions'] = {}
+    if job['settings'].save_s3 and job['settings'].renditions:
+        encode_renditions_start = time_module.time()
+        for size in job['settings'].renditions:
+            job['renditions'][size] = render_rendition(job['frame'], RENDITIONS[size])
+        times['encode_renditions'] = (encode_renditions_start, time_module.time())
+
+    job['frame'] = None  # raw frame is no longer needed, free it early
+    job['image_size'] = len(job['image_bytes'])
+    ENCODED_BYTES.observe(job['image_size'], format=job['settings'].image_format)
+
+    if job['settings'].save_local_latest_img:
+        save_frame_start = time_module.time()
+        save_frame(job['image_bytes'], images_dir, job['extension'])
+        times['save_frame'] = (save_frame_start, time_module.time())
+
+    return job
+
+def upload_stage(job):
+    if job['settings'].save_s3:
+        queue_upload_start = time_module.time()
+        # The manifest entry is added once the upload has actually finished
+        job['s3_key'] = queue_upload(job['image_bytes'], job['captured_utc'], job['extension'], size=job['image_size'], brightness=job['brightness'], frequency=job['frequency'])
+        queue_renditions(job['s3_key'], job['renditions'])
+        if job['settings'].strip_size:
+            add_frame_to_strip(job['s3_key'], job['captured_utc'], job['settings'].strip_size, job['renditions'][job['settings'].strip_size])
+        job['times']['queue_upload'] = (queue_upload_start, time_module.time())
+
+    sinks = list(frame_sinks)
+    if job['settings'].local_archive_dir:
+        sinks.append(archive_frame)
+    for sink in sinks:
+        # One broken sink shouldn't cost the frame its database row
+        try:
+            sink(job['image_bytes'], job)
+        except Exception as e:
+            SINK_FAILURES.inc(sink=sink.__name__)
+            print(f"Frame sink {sink.__name__} failed: {e}")
+
+    job['image_bytes'] = None
+    job['renditions'] = None
+    return job
+
+def database_stage(job):
+    if job['settings'].save_sqlite:
+        save_sqlite_start = time_module.time()
+        camera_settings = job['camera_settings']
+        timings = None
+        if job['settings'].save_timings:
+            steps = dict(job['capture_times'], **job['times'])
+            timings = json.dumps({step: round(end - start, 4) for step, (start, end) in steps.items()})
+        insert_frame_database(job['captured_local'], job['brightness'], camera_settings['contrast'], camera_settings['saturation'], camera_settings['gain'], camera_settings['white_balance_temperature'], job['file_timestamp'], job['frequency'], job.get('s3_key'), timings, job['image_size'], job['captured_utc'])
+        job['times']['save_sqlite'] = (save_sqlite_start, time_module.time())
+
+    return job
+
+def retention_stage(job):
+    delete_old_images_start = time_module.time()
+    delete_old_images()
+    job['times']['delete_old_images'] = (delete_old_images_start, time_module.time())
+
+    return job
+
+def build_capture_pipeline(on_complete):
+    # Capture -> annotate -> encode -> upload -> database. Only the first hop
+    # drops frames, every later hop pushes back so nothing half-processed is lost.
+    pipeline = Pipeline([
+        Stage('Annotate', annotate_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_policy=DROP_OLDEST),
+        Stage('Encode', encode_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_policy=BLOCK, block_timeout=PIPELINE_BLOCK_TIMEOUT),
+        Stage('Upload', upload_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_policy=BLOCK, block_timeout=PIPELINE_BLOCK_TIMEOUT),
+        Stage('Database', database_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_policy=BLOCK, block_timeout=PIPELINE_BLOCK_TIMEOUT),
+    ], on_complete=on_complete)
+
+    # Retention sweeps run beside the pipeline, a sweep still in progress
+    # makes the next trigger a no-op
+    retention = Pipeline([
+        Stage('Retention', retention_stage, maxsize=1, drop_policy=DROP_NEWEST),
+    ], on_complete=on_complete)
+
+    return pipeline, retention
+
 def main():
     global previous_times
     
     current_time = datetime.now(timezone.utc)
     print(f"[{current_time.isoformat()}] Starting main process...")
     cap = initialize_camera()
-    start_time = datetime.now(timezone.utc)
+    # Monotonic, so a wall clock step can't end the session early or late
+    start_time = time_module.monotonic()
 
     if SAVE_SQLITE:
-        initialize_database(conn=conn)
-
+        initialize_database()
+
+    # Stage timings of the most recently completed frame and retention sweep
+    completed_times = {}
+
+    def on_complete(job):
+        completed_times.update(job['times'])
+        record_step_times(job['times'])
+
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            metrics_server = start_http_server(METRICS_PORT)
+            print(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+        except OSError as e:
+            # e.g. the port is taken, capturing matters more than metrics
+            print(f"Not serving metrics, port {METRICS_PORT} is unavailable: {e}")
+    camera_dropped = 0
+
+    pipeline, retention = build_capture_pipeline(on_complete)
+    pipeline.start()
+    retention.start()
+    interval_scheduler.start()
+    retention_trigger = PeriodicTrigger(RETENTION_INTERVAL)
+    captured_utc = None
 
     try:
-        while (datetime.now(timezone.utc) - start_time) < timedelta(hours=MAX_RUNTIME_HOURS):
+        while time_module.monotonic() - start_time < MAX_RUNTIME_HOURS * 3600:
+            # Returns at this frame's deadline, however long the last loop took
+            CAPTURE_LATENESS.observe(interval_scheduler.wait())
+
             load_settings_start = time_module.time()
             load_settings()
             load_settings_end = time_module.time()
             
 
-            loop_start_time = time_module.time()
-            current_time = datetime.now(timezone.utc)
+            loop_start_time = time_module.monotonic()
             
             calculate_brightness_start = time_module.time()
-            brightness = calculate_brightness(datetime.now())
+            camera_targets = calculate_camera_targets(datetime.now(central))
+            brightness = camera_targets['BRIGHTNESS']
             calculate_brightness_end = time_module.time()
             
             set_brightness_start = time_module.time()
-            cap.set(cv2.CAP_PROP_BRIGHTNESS, brightness)
+            for name, value in camera_targets.items():
+                cap.set(getattr(cv2, f'CAP_PROP_{name}'), value)
             set_brightness_end = time_module.time()
             
+            wait_for_next_second(captured_utc)
             capture_frame_start = time_module.time()
             frame = capture_frame(cap)
             capture_frame_end = time_module.time()
 
-            if SHOW_TIMESTAMP:
-                add_timestamp_start = time_module.time()
-                image_timestamp = datetime.now().strftime('%m/%d/%Y %H:%M')
-                frame = add_timestamp_to_frame(frame, image_timestamp)
-                add_timestamp_end = time_module.time()
+            # Activity driven curves shorten the interval while the scene changes
+            if hasattr(interval_scheduler.curve, 'report_activity'):
+                interval_scheduler.curve.report_activity(measure_activity(frame))
+            # Next deadline is an absolute time on the monotonic clock, so the
+            # time spent in this loop doesn't push the following frames back
+            skipped = interval_scheduler.skipped
+            interval = interval_scheduler.advance()
+            SKIPPED_CAPTURES.inc(interval_scheduler.skipped - skipped)
 
-            if SHOW_TIMING:
-                add_timing_start = time_module.time()
-                frame = add_previous_timing(frame, previous_times)
-                add_timing_end = time_module.time()
-            
-            if SHOW_CAMERA_SETTINGS:
-                add_camera_settings_start = time_module.time()
-                frame = add_camera_settings_to_frame(frame, cap)
-                add_camera_settings_end = time_module.time()
-
-            if SAVE_LOCAL_LATEST_IMG:
-                save_frame_start = time_module.time()
-                image_path = save_frame(frame, images_dir)
-                save_frame_end = time_module.time()
-
-            if SAVE_S3:
-                upload_to_s3_start = time_module.time()
-                file_timestamp = datetime.now(timezone.utc).strftime('%Y %m %d_%H %M %S')
-                upload_to_s3(image_path, file_timestamp)
-                upload_to_s3_end = time_module.time()
-
-            if SAVE_SQLITE:
-                save_sqlite_start = time_module.time()
-                insert_frame_database(datetime.now(), brightness, cap.get(cv2.CAP_PROP_CONTRAST), cap.get(cv2.CAP_PROP_SATURATION), cap.get(cv2.CAP_PROP_GAIN), cap.get(cv2.CAP_PROP_WB_TEMPERATURE), file_timestamp, FREQUENCY)
-                save_sqlite_end = time_module.time()
-
-
-            if (current_time - start_time).seconds % 3600 < FREQUENCY:
-                delete_old_images_start = time_module.time()
-                delete_old_images_from_s3()
-                delete_old_images_end = time_module.time()
-
-            loop_end_time = time_module.time()
-            loop_duration = loop_end_time - loop_start_time
-            deviation = loop_duration - FREQUENCY
-
-            adjusted_sleep_duration = max(0, FREQUENCY - loop_duration)
-
-            times = {
+            capture_times = {
                 "load_settings": (load_settings_start, load_settings_end),
                 "calculate_brightness": (calculate_brightness_start, calculate_brightness_end),
                 "set_brightness": (set_brightness_start, set_brightness_end),
                 "capture_frame": (capture_frame_start, capture_frame_end),
-                "add_timestamp": (add_timestamp_start, add_timestamp_end) if SHOW_TIMESTAMP else (None, None),
-                'add_prev_timing': (add_timing_start, add_timing_end) if SHOW_TIMING else (None, None),
-                "add_camera_settings": (add_camera_settings_start, add_camera_settings_end) if SHOW_CAMERA_SETTINGS else (None, None),
-                "save_frame": (save_frame_start, save_frame_end) if SAVE_LOCAL_LATEST_IMG else (None, None),
-                "upload_to_s3": (upload_to_s3_start, upload_to_s3_end) if SAVE_S3 else (None, None),
-                "save_sqlite": (save_sqlite_start, save_sqlite_end) if SAVE_SQLITE else (None, None),
-                "delete_old_images": (delete_old_images_start, delete_old_images_end) if (current_time - start_time).seconds % 3600 < FREQUENCY else (None, None),
             }
+            record_step_times(capture_times)
+            CAMERA_DROPPED.inc(cap.dropped - camera_dropped)
+            camera_dropped = cap.dropped
+            FRAMES_CAPTURED.inc()
+
+            # Everything after the capture runs on the pipeline workers
+            captured_utc = datetime.now(timezone.utc)
+            pipeline.submit({
+                'frame': frame,
+                'captured_local': datetime.now(),
+                'captured_utc': captured_utc,
+                'file_timestamp': captured_utc.strftime('%Y %m %d_%H %M %S'),
+                'brightness': brightness,
+                'camera_settings': read_camera_settings(cap),
+                'frequency': interval,
+                # Stages read this snapshot, not the globals a reload may rebind
+                'settings': SETTINGS,
+                'previous_times': previous_times,
+                'capture_times': capture_times,
+                'times': {},
+            })
+
+            if retention_trigger.due():
+                retention.submit({'times': {}})
+
+            loop_end_time = time_module.monotonic()
+            loop_duration = loop_end_time - loop_start_time
+            deviation = loop_duration - interval
+
+            adjusted_sleep_duration = max(0, interval_scheduler.time_until_deadline())
+
+            times = dict(completed_times)
+            times.update(capture_times)
+            times["capture_stats"] = (cap.last_latency, cap.last_age, cap.dropped)
             times_list = calculate_times(times)
-            formatted_table = format_times_table(times_list, loop_duration, FREQUENCY, deviation, adjusted_sleep_duration)
+            times_list.extend(pipeline.stats_rows())
+            times_list.extend(retention.stats_rows())
+            times_list.extend(interval_scheduler.stats_rows())
+            if upload_queue is not None:
+                times_list.extend(upload_queue.stats_rows())
+            formatted_table = format_times_table(times_list, loop_duration, interval, deviation, adjusted_sleep_duration)
             print("████████████████████████████████████████████████████████████████████████")
             print(f" [{datetime.now(timezone.utc).isoformat()}] Loop completed.")
             print(formatted_table)
             
             previous_times = times_list
-            
-            time_module.sleep(adjusted_sleep_duration)
 
         else:
             print("⚠ ⚠ ⚠ CAMERA DISABLED ⚠ ⚠ ⚠")
@@ -524,13 +737,23 @@ def main():
             
 
     except Exception as e:
+        # Flush queued frames before anything else can fail
+        pipeline.stop()
         close_session_database()
         print(f"[{datetime.now(timezone.utc).isoformat()}] An error occurred: {e}")
         traceback.print_exc()
     finally:
+        # Let queued frames finish uploading before the session is closed
+        pipeline.stop()
+        retention.stop()
+        stop_upload_queue()
+        flush_manifests()
+        stop_strip_writer()
         cap.release()
         close_session_database()
+        if metrics_server is not None:
+            metrics_server.shutdown()
         print(f"[{datetime.now(timezone.utc).isoformat()}] Camera released after main process.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
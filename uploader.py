@@ -0,0 +1,276 @@
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time as time_module
+import traceback
+
+from metrics import REGISTRY
+
+UPLOAD_QUEUE_DEPTH = REGISTRY.gauge('upload_queue_depth', 'Frames waiting to be uploaded, in memory and spooled')
+UPLOAD_SPOOL_FILES = REGISTRY.gauge('upload_spool_files', 'Frames spooled to disk after a failed upload')
+UPLOAD_SPOOL_BYTES = REGISTRY.gauge('upload_spool_bytes', 'Bytes of spooled frames on disk')
+UPLOADS = REGISTRY.counter('upload_completed', 'Frames uploaded')
+UPLOAD_SECONDS = REGISTRY.histogram('upload_duration_seconds', 'Time of each successful upload request')
+UPLOAD_RETRIES = REGISTRY.counter('upload_retries', 'Failed upload attempts that will be retried')
+SPOOL_DROPPED = REGISTRY.counter('upload_spool_dropped', 'Spooled frames deleted to stay under the spool size limit')
+
+
+class UploadQueue:
+    """Background uploads with retries and a disk spool.
+
+    `put` returns straight away. Worker threads upload from memory; a frame
+    whose upload fails is written to `spool_dir` and retried with exponential
+    backoff, so it survives both an outage and a restart (the spool is loaded
+    again on `start`). The first success after a failure pulls every waiting
+    retry forward, so a backlog drains across all workers as soon as the
+    network is back.
+    """
+
+    def __init__(self, storage, spool_dir, workers=4, base_backoff=1.0, max_backoff=300.0,
+                 max_spool_bytes=2 * 1024 ** 3, on_uploaded=None):
+        self.storage = storage
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_spool_bytes = max_spool_bytes
+        # Called as on_uploaded(key, metadata) from a worker thread
+        self.on_uploaded = on_uploaded
+
+        self.uploaded = 0
+        self.retries = 0
+        self.spool_files = 0
+        self.spool_bytes = 0
+
+        self._cond = threading.Condition()
+        self._heap = []  # (due, seq, item)
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._failing = False
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for item in self._load_spool():
+            self._schedule(item, 0)
+        if self.spool_files:
+            print(f"Resuming {self.spool_files} spooled uploads ({self.spool_bytes / 1024 ** 2:.1f} MB)")
+
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"uploader-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def put(self, key, data, content_type, **metadata):
+        item = {'id': f"{time_module.time_ns()}-{next(self._seq)}", 'key': key, 'content_type': content_type,
+                'metadata': metadata, 'attempts': 0, 'data': data}
+        self._schedule(item, 0)
+
+    def _schedule(self, item, due):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), item))
+            self._cond.notify()
+        self._update_gauges()
+
+    def _next_item(self):
+        with self._cond:
+            while self._running:
+                now = time_module.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    self._in_flight += 1
+                    return heapq.heappop(self._heap)[2]
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+        return None
+
+    def _run(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                return
+            try:
+                self._upload(item)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def _upload(self, item):
+        data = item['data']
+        if data is None:
+            with open(self._data_path(item), 'rb') as f:
+                data = f.read()
+
+        started = time_module.monotonic()
+        try:
+            self.storage.put(item['key'], data, item['content_type'])
+        except Exception as e:
+            item['attempts'] += 1
+            with self._cond:
+                self.retries += 1
+            UPLOAD_RETRIES.inc()
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (item['attempts'] - 1)) * random.uniform(0.5, 1.0)
+            print(f"Upload of {item['key']} failed ({e}), attempt {item['attempts']}, retrying in {delay:.1f}s")
+            if item['data'] is not None:
+                self._spool(item)
+            with self._cond:
+                self._failing = True
+            self._schedule(item, time_module.monotonic() + delay)
+            return
+
+        UPLOAD_SECONDS.observe(time_module.monotonic() - started)
+        if item['data'] is None:
+            self._unspool(item)
+        UPLOADS.inc()
+
+        with self._cond:
+            self.uploaded += 1
+            if self._failing:
+                # Connectivity is back, retry everything now instead of
+                # waiting out each frame's backoff
+                self._failing = False
+                self._heap = [(0, seq, waiting) for _, seq, waiting in self._heap]
+                heapq.heapify(self._heap)
+                self._cond.notify_all()
+        self._update_gauges()
+
+        if self.on_uploaded is not None:
+            self.on_uploaded(item['key'], item['metadata'])
+
+    def _data_path(self, item):
+        return os.path.join(self.spool_dir, item['id'] + '.bin')
+
+    def _meta_path(self, item):
+        return os.path.join(self.spool_dir, item['id'] + '.json')
+
+    def _spool(self, item):
+        # Data first, then the metadata file that marks the entry complete
+        data = item['data']
+        for path, content, mode in ((self._data_path(item), data, 'wb'),
+                                    (self._meta_path(item), json.dumps({k: v for k, v in item.items() if k != 'data'}), 'w')):
+            with open(path + '.tmp', mode) as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+
+        item['data'] = None
+        item['size'] = len(data)
+        with self._cond:
+            self.spool_files += 1
+            self.spool_bytes += len(data)
+        self._enforce_spool_limit()
+
+    def _unspool(self, item):
+        for path in (self._meta_path(item), self._data_path(item)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        with self._cond:
+            self.spool_files -= 1
+            self.spool_bytes -= item.get('size', 0)
+
+    def _enforce_spool_limit(self):
+        with self._cond:
+            if self.spool_bytes <= self.max_spool_bytes:
+                return
+            # Oldest frames go first, ids start with the enqueue time
+            spooled = sorted((entry for entry in self._heap if entry[2]['data'] is None), key=lambda entry: entry[2]['id'])
+            dropped = []
+            while self.spool_bytes > self.max_spool_bytes and spooled:
+                entry = spooled.pop(0)
+                self._heap.remove(entry)
+                dropped.append(entry[2])
+                self.spool_bytes -= entry[2].get('size', 0)
+                self.spool_files -= 1
+            heapq.heapify(self._heap)
+
+        for item in dropped:
+            for path in (self._meta_path(item), self._data_path(item)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            SPOOL_DROPPED.inc()
+            print(f"Upload spool over {self.max_spool_bytes} bytes, dropped {item['key']}")
+
+    def _load_spool(self):
+        items = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith('.tmp'):
+                os.unlink(path)
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(path) as f:
+                    item = json.load(f)
+                item['data'] = None
+                item['size'] = os.path.getsize(self._data_path(item))
+            except (OSError, ValueError) as e:
+                print(f"Skipping unreadable spool entry {name}: {e}")
+                continue
+            items.append(item)
+            self.spool_files += 1
+            self.spool_bytes += item['size']
+
+        # Data files whose metadata never got written can't be uploaded
+        known = {item['id'] for item in items}
+        for name in os.listdir(self.spool_dir):
+            if name.endswith('.bin') and name[:-len('.bin')] not in known:
+                os.unlink(os.path.join(self.spool_dir, name))
+        return items
+
+    def _update_gauges(self):
+        with self._cond:
+            depth = len(self._heap) + self._in_flight
+        UPLOAD_QUEUE_DEPTH.set(depth)
+        UPLOAD_SPOOL_FILES.set(self.spool_files)
+        UPLOAD_SPOOL_BYTES.set(self.spool_bytes)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queue_depth': len(self._heap) + self._in_flight,
+                'spool_files': self.spool_files,
+                'spool_bytes': self.spool_bytes,
+                'uploaded': self.uploaded,
+                'retries': self.retries,
+            }
+
+    def stats_rows(self):
+        stats = self.stats()
+        return [
+            ["Upload queue depth", stats['queue_depth']],
+            ["Upload spool files", stats['spool_files']],
+            ["Upload spool MB", stats['spool_bytes'] / 1024 ** 2],
+            ["Upload retries", stats['retries']],
+        ]
+
+    def stop(self, timeout=30):
+        """Give queued uploads `timeout` seconds, then spool whatever is left for next time."""
+        deadline = time_module.monotonic() + timeout
+        with self._cond:
+            while (self._heap or self._in_flight) and not self._failing:
+                remaining = deadline - time_module.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._running = False
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        pending, self._heap = self._heap, []
+        for _, _, item in pending:
+            if item['data'] is not None:
+                self._spool(item)
+        self._update_gauges()
@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import json
+import os
+import traceback
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Mount, Route
+
+from server import REFRESH_INTERVAL, app as flask_app, file_list
+
+# Production entry point for the API. The Flask routes are served unchanged
+# on a thread pool, /events is native asyncio: one background task per worker
+# refreshes the file list and pushes the new frame keys to every connected
+# viewer over Server-Sent Events. Viewers cost a queue each, not a refresh.
+#
+#   python asgi.py                       # WEBCAMTIMELAPSE_API_WORKERS processes
+#   uvicorn asgi:app --workers 4 --port 5000 --timeout-graceful-shutdown 5
+
+PORT = int(os.getenv('WEBCAMTIMELAPSE_API_PORT', 5000))
+WORKERS = int(os.getenv('WEBCAMTIMELAPSE_API_WORKERS', min(4, os.cpu_count() or 1)))
+# Threads per worker for the Flask routes, which block on storage and disk
+WSGI_THREADS = 32
+# Event streams never end by themselves, they're cut after this on shutdown
+SHUTDOWN_TIMEOUT = 5
+
+# Comment line sent when there's been nothing else for this long, keeps proxies from closing the stream
+KEEPALIVE_INTERVAL = 15
+# Events a viewer can fall behind by before its stream is closed; it reconnects and catches up
+SUBSCRIBER_QUEUE_SIZE = 64
+
+# One queue per connected viewer
+subscribers = set()
+
+
+def frames_event(keys, latest):
+    # The id is the newest key, EventSource sends it back as Last-Event-ID on reconnect
+    return f"id: {latest}\nevent: frames\ndata: {json.dumps({'files': keys, 'latest': latest})}\n\n"
+
+
+def close_stream(queue):
+    subscribers.discard(queue)
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+def publish(message):
+    for queue in list(subscribers):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Too slow to keep up, end its stream
+            close_stream(queue)
+
+
+async def refresh_loop():
+    entries, version = file_list.snapshot()
+    latest = entries[-1][1] if entries else None
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            # Storage and SQLite calls block, keep them off the event loop
+            await asyncio.to_thread(file_list.refresh)
+        except Exception as e:
+            print(f"File list refresh failed: {e}")
+            traceback.print_exc()
+            continue
+
+        entries, new_version = file_list.snapshot()
+        if new_version == version or not entries:
+            continue
+        version = new_version
+        keys = file_list.query(entries, after=latest)[0] if latest else [key for _, key in entries]
+        latest = entries[-1][1]
+        if keys:
+            publish(frames_event(keys, latest))
+
+
+async def events(request):
+    """New frame keys as they arrive, `frames` events of {files, latest}.
+
+    A reconnecting EventSource sends the newest key it saw as Last-Event-ID
+    (or pass it as `after`) and first gets everything newer than that.
+    """
+    after = request.headers.get('last-event-id') or request.query_params.get('after')
+    queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    async def stream():
+        # Subscribed before the catch-up, so nothing falls in between; clients
+        # skip keys they already have
+        subscribers.add(queue)
+        try:
+            yield 'retry: 5000\n\n'
+            if after:
+                entries, _ = file_list.snapshot()
+                try:
+                    keys = file_list.query(entries, after=after)[0]
+                except ValueError:
+                    keys = []
+                if keys:
+                    yield frames_event(keys, entries[-1][1])
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            subscribers.discard(queue)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx would otherwise buffer the stream
+        'X-Accel-Buffering': 'no',
+        'Access-Control-Allow-Origin': '*',
+    })
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await asyncio.to_thread(file_list.start, False)
+    task = asyncio.create_task(refresh_loop())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+app = Starlette(routes=[
+    Route('/events', events),
+    Mount('/', WSGIMiddleware(flask_app, workers=WSGI_THREADS)),
+], lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    uvicorn.run('asgi:app', host='0.0.0.0', port=PORT, workers=WORKERS, timeout_graceful_shutdown=SHUTDOWN_TIMEOUT,
+                app_dir=os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,112 @@
+import bisect
+import math
+import threading
+import traceback
+from datetime import datetime, timezone
+
+from s3_layout import parse_frame_time
+
+# The frames the API serves, as a sorted list of (captured_utc, key) that
+# requests bisect into. The list is only ever replaced, never changed in
+# place, so a request works on whatever list it picked up without locking.
+
+
+class FileList:
+    """Sorted frame keys for /list-files, refreshed from `load` on a background thread.
+
+    `load(since)` returns (captured_utc, key) pairs captured at or after
+    `since` (or everything for None). Each refresh asks for frames from the
+    newest hour already held onwards and merges them in, and frames older
+    than `lookback` are dropped, the same window retention keeps in storage.
+    """
+
+    def __init__(self, load, lookback, refresh_interval=10):
+        self.load = load
+        self.lookback = lookback
+        self.refresh_interval = refresh_interval
+        # Bumped on every change, part of the ETag
+        self.version = 0
+
+        self._entries = []
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self, refresh_thread=True):
+        # First call loads synchronously so the first request has a list to serve.
+        # The ASGI server refreshes from its own task instead of the thread.
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        self.refresh()
+        if refresh_thread:
+            threading.Thread(target=self._run, name="file-list-refresh", daemon=True).start()
+        return self
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"File list refresh failed: {e}")
+                traceback.print_exc()
+
+    def refresh(self):
+        entries = self._entries
+        now = datetime.now(timezone.utc)
+        if entries:
+            since = entries[-1][0].replace(minute=0, second=0, microsecond=0)
+        else:
+            since = now - self.lookback
+        loaded = self.load(since)
+
+        # Only the tail from `since` can overlap with what was loaded
+        position = bisect.bisect_left(entries, (since,))
+        tail = entries[position:]
+        merged = entries[:position] + sorted(set(tail).union(loaded))
+        cutoff = bisect.bisect_left(merged, (now - self.lookback,))
+        merged = merged[cutoff:]
+
+        added = len(merged) - len(entries) + cutoff
+        if merged != entries:
+            with self._lock:
+                self._entries = merged
+                self.version += 1
+            print(f'Loaded {added}/{len(merged)} new files into file list, dropped {cutoff} expired')
+
+    def snapshot(self):
+        with self._lock:
+            return self._entries, self.version
+
+    def query(self, entries, since=None, until=None, after=None, step=1, limit=None):
+        """Keys in [since, until) after the key `after`, every `step`th one, at most `limit`.
+
+        Returns (keys, total, next_cursor). `total` counts the frames in the
+        range after `after`, before step and limit are applied, so with a
+        cursor it's what is left from there on. `next_cursor` is the last key
+        returned when more frames follow, else None. Steps are counted from
+        the start of the range, so paging with the cursor keeps the same
+        spacing across pages.
+        """
+        start = 0 if since is None else bisect.bisect_left(entries, (since,))
+        end = len(entries) if until is None else bisect.bisect_left(entries, (until,))
+
+        first = start
+        if after is not None:
+            # By the key's own time, so a delta works even after the key itself expired
+            after_time = parse_frame_time(after)
+            if after_time is None:
+                raise ValueError(f"Not a frame key: {after!r}")
+            first = max(start, bisect.bisect_right(entries, (after_time, after)))
+        total = max(0, end - first)
+
+        # Round up to the next position on the step grid from `start`
+        first = start + math.ceil((first - start) / step) * step
+        positions = range(first, end, step)
+        if limit is not None:
+            positions = positions[:limit]
+
+        keys = [entries[i][1] for i in positions]
+        next_cursor = keys[-1] if keys and positions[-1] + step < end else None
+        return keys, total, next_cursor
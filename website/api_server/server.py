@@ -1,86 +1,430 @@
 from flask import Flask, jsonify, request, send_file, Response
 from flask_cors import CORS
-import boto3
 from botocore.exceptions import NoCredentialsError
-from datetime import datetime
-import io
+from datetime import datetime, timedelta, timezone
+import hashlib
 import os
+import queue
+import sys
+import uuid
+
+# Shared modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from database import DB_PATH
+from frame_index import frame_index_from_env
+from renditions import RENDITION_QUALITY, RENDITIONS, DiskCache, MemoryCache, decode_image, render_rendition
+from s3_layout import FRAME_NAME_FORMAT, FRAMES_PREFIX, floor_hour, is_frame_key, list_frames, parse_frame_time, rendition_key, strip_key
+from storage import ObjectNotFound, content_type_for, storage_from_env
+from strips import STRIP_CONTENT_TYPE
+from clips import CLIP_FORMATS, MAX_CLIP_FRAMES, DONE, ClipParams, ClipRenderer
+
+from file_list import FileList
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Load environment variables
-BUCKET_NAME = os.getenv('WEBCAMTIMELAPSE_BUCKET_NAME')
-if not BUCKET_NAME:
-    raise ValueError("No BUCKET_NAME environment variable set")
+# How far back the file list goes, matches IMAGE_RETENTION_HOURS by default
+LOOKBACK_HOURS = int(os.getenv('WEBCAMTIMELAPSE_LOOKBACK_HOURS', 168))
 
-s3 = boto3.client('s3')
+# S3, MinIO or a local directory, picked by WEBCAMTIMELAPSE_STORAGE. Flask
+# serves requests on threads, they all share the client's connection pool.
+storage = storage_from_env(max_pool_connections=32)
 
-# Declare cached_files at the top level
-cached_files = []
+# timelapse.db next to the capture loop, when the API runs on the same machine.
+# Without it the file list comes from the storage manifests.
+frame_index = frame_index_from_env(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', DB_PATH))
 
-def update_cache():
-    global cached_files
+# Seconds between background refreshes of the file list
+REFRESH_INTERVAL = int(os.getenv('WEBCAMTIMELAPSE_REFRESH_INTERVAL', 10))
 
-    new_files = []
+# Part of every ETag, so tags from before a restart never match
+BOOT_ID = uuid.uuid4().hex[:8]
 
-    # Determine the last file in the cache
-    if cached_files:
-        last_file = cached_files[-1]
-    else:
-        last_file = None
+# Frames and renditions served by /get-file, kept on local disk. A frame key
+# never changes content, so entries never go stale, they only get evicted.
+CACHE_DIR = os.getenv('WEBCAMTIMELAPSE_CACHE_DIR', './rendition_cache')
+CACHE_MB = int(os.getenv('WEBCAMTIMELAPSE_CACHE_MB', 1024))
+rendition_cache = DiskCache(CACHE_DIR, CACHE_MB * 1024 ** 2)
 
-    while True:
-        if last_file:
-            response = s3.list_objects_v2(Bucket=BUCKET_NAME, StartAfter=last_file)
-        else:
-            response = s3.list_objects_v2(Bucket=BUCKET_NAME)
+# The last frames served, kept in memory as well, the newest frame is asked
+# for by every viewer at once
+HOT_FRAMES = int(os.getenv('WEBCAMTIMELAPSE_HOT_FRAMES', 64))
+HOT_MB = int(os.getenv('WEBCAMTIMELAPSE_HOT_MB', 256))
+hot_cache = MemoryCache(HOT_FRAMES, HOT_MB * 1024 ** 2)
 
-        if 'Contents' in response:
-            for item in response['Contents']:
-                if item['Key'] not in cached_files:
-                    new_files.append(item['Key'])
+# A year, the longest max-age caches honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
-        if response.get('IsTruncated'):  # Check if there are more pages
-            last_file = response['Contents'][-1]['Key']
-        else:
-            break
+# How long after its hour ends a strip may still be rewritten (StripWriter
+# writes once a minute), only then is it cached as immutable
+STRIP_GRACE = timedelta(minutes=5)
+
+# Clips rendered by POST /clips, in their own cache so a burst of frame
+# requests can't evict them. Each render thread runs its own fetch pool and
+# ffmpeg, a few are plenty.
+CLIP_DIR = os.getenv('WEBCAMTIMELAPSE_CLIP_DIR', './clip_cache')
+CLIP_MB = int(os.getenv('WEBCAMTIMELAPSE_CLIP_MB', 4096))
+CLIP_WORKERS = int(os.getenv('WEBCAMTIMELAPSE_CLIP_WORKERS', 2))
+# Clips waiting for a render thread, past this POST /clips answers 503
+CLIP_QUEUE = int(os.getenv('WEBCAMTIMELAPSE_CLIP_QUEUE', 8))
+MAX_CLIP_FPS = 60
+MAX_CLIP_WIDTH = 3840
+
+def load_frames(since):
+    if frame_index is not None:
+        # An indexed local query, nothing goes over the network
+        return [(frame.captured_utc, frame.key) for frame in frame_index.range(since=since)]
 
-    # Update the cache with new files
-    cached_files.extend(new_files)
-    cached_files = sorted(cached_files)  # Sort the cached files
-    
-    print(f'Loaded {len(new_files)}/{len(cached_files)} new files into cache')
+    # Read the manifests from `since` onwards, a refresh is usually a single
+    # hour manifest GET
+    frames = list_frames(storage, since, datetime.now(timezone.utc) + timedelta(hours=1))
+    if frames or file_list.version:
+        return [(datetime.fromisoformat(frame['timestamp']), frame['key']) for frame in frames]
+
+    # Nothing in the manifests, the bucket may still use the flat layout.
+    # Flat keys are timestamps, so this only lists keys newer than `since`.
+    objects = storage.list_range(start_after=since.strftime(FRAME_NAME_FORMAT), end_before=FRAMES_PREFIX)
+    return [(parse_frame_time(obj.key), obj.key) for obj in objects if is_frame_key(obj.key)]
+
+file_list = FileList(load_frames, timedelta(hours=LOOKBACK_HOURS), REFRESH_INTERVAL)
+
+def parse_time_arg(name, values=None):
+    value = (request.args if values is None else values).get(name)
+    if not value:
+        return None
+    # Naive times are taken as UTC, like the frame keys
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def parse_int_arg(name, default, minimum, values=None):
+    value = (request.args if values is None else values).get(name)
+    if value is None:
+        return default
+    value = int(value)
+    if value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return value
 
 @app.route('/list-files', methods=['GET'])
 def list_files():
-    global cached_files
-    update_cache()
+    """Frame keys, oldest first, from the in-memory file list.
+
+    Query parameters, all optional:
+      since, until  ISO 8601 range, UTC unless an offset is given
+      limit         at most this many keys; 0 only returns the counts
+      step          every Nth frame of the range
+      cursor        the next_cursor of the previous page
+      after         a key the client already has, for just the newer ones
+    Responses carry an ETag and answer If-None-Match with 304.
+    """
+    file_list.start()
+    entries, version = file_list.snapshot()
 
-    return jsonify(cached_files)
+    etag = hashlib.sha1(f"{BOOT_ID}|{version}|{request.query_string.decode()}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        try:
+            keys, total, next_cursor = file_list.query(
+                entries,
+                since=parse_time_arg('since'),
+                until=parse_time_arg('until'),
+                after=request.args.get('cursor') or request.args.get('after'),
+                step=parse_int_arg('step', 1, 1),
+                limit=parse_int_arg('limit', None, 0),
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        response = jsonify({
+            'files': keys,
+            'total': total,
+            'next_cursor': next_cursor,
+            'latest': entries[-1][1] if entries else None,
+        })
+
+    response.set_etag(etag)
+    # Cacheable, but always revalidated, so polling costs a 304 until something changes
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def load_file(file_key, size, quality):
+    """Chunks of `file_key` at `size` and `quality`, from storage where possible."""
+    if size == 'full' and quality is None:
+        # Straight into the disk cache, the original is never whole in memory
+        return storage.stream(file_key)[1]
+
+    if quality is None:
+        # Made by the capture loop at upload time
+        try:
+            return storage.stream(rendition_key(file_key, size))[1]
+        except ObjectNotFound:
+            pass
+
+    width = RENDITIONS.get(size)
+    return [render_rendition(decode_image(storage.get(file_key).data, width), width, quality or RENDITION_QUALITY)]
+
+def cache_name(file_key, size, quality):
+    # Originals keep their format, anything re-encoded is a JPEG
+    extension = os.path.splitext(file_key)[1] if size == 'full' and quality is None else '.jpg'
+    return hashlib.sha1(f"{file_key}|{size}|{quality}".encode()).hexdigest() + extension
+
+def memory_response(data, etag, name):
+    response = Response(data, mimetype=content_type_for(name))
+    response.set_etag(etag)
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
 
 @app.route('/get-file', methods=['GET'])
 def get_file():
+    """A frame, or a downscaled JPEG of it.
+
+    Query parameters:
+      file_key  frame key from /list-files
+      size      full (default) or one of the RENDITIONS names
+      quality   JPEG quality 1-100 to re-encode at, optional
+    Responses are immutable, with a strong ETag, and support Range requests.
+    """
     file_key = request.args.get('file_key')
-    print(f'get-file: {file_key}')
     if not file_key:
         return jsonify({'error': 'file_key parameter is required'}), 400
+    if not is_frame_key(file_key):
+        return jsonify({'error': f'Not a frame key: {file_key}'}), 400
+
+    size = request.args.get('size', 'full')
+    if size != 'full' and size not in RENDITIONS:
+        return jsonify({'error': f"size must be full or one of {', '.join(RENDITIONS)}"}), 400
+    try:
+        quality = parse_int_arg('quality', None, 1)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if quality is not None and quality > 100:
+        return jsonify({'error': 'quality must be at most 100'}), 400
+
+    name = cache_name(file_key, size, quality)
+    return serve_cached(name, lambda: load_file(file_key, size, quality), os.path.basename(file_key))
+
+def serve_cached(name, load, filename):
+    """Immutable response for the cache entry `name`, filled from the chunks `load()` returns.
 
+    A miss is streamed to the client while it's written to the disk cache.
+    Range and conditional requests need the whole entry first, they're
+    answered from the file.
+    """
+    def keep_hot(path, etag, data):
+        if data is not None:
+            hot_cache.put(name, data, etag)
+
+    hot = hot_cache.get(name)
+    whole = bool(request.range or request.if_none_match)
+    if hot is not None:
+        response = memory_response(hot[0], hot[1], name)
+        cache_status = 'MEMORY'
+    else:
+        for _ in range(2):
+            try:
+                if whole:
+                    path, etag, cache_status = rendition_cache.fetch(name, load)
+                else:
+                    # Concurrent requests for the same file share one storage fetch
+                    cache_status, cached = rendition_cache.stream(name, load, hot_cache.max_item_bytes, keep_hot)
+            except ObjectNotFound:
+                return jsonify({'error': 'File not found'}), 404
+            except NoCredentialsError:
+                return jsonify({'error': 'Credentials not available'}), 403
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            if not whole and cache_status == 'MISS':
+                # No ETag yet, it's the hash of bytes still on their way
+                response = Response(cached, mimetype=content_type_for(name))
+                response.cache_control.max_age = IMMUTABLE_MAX_AGE
+                break
+            if not whole:
+                path, etag = cached
+
+            try:
+                if os.path.getsize(path) <= hot_cache.max_item_bytes:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    hot_cache.put(name, data, etag)
+                    response = memory_response(data, etag, name)
+                else:
+                    # Handles If-None-Match (304) and Range (206) against the cached file
+                    response = send_file(path, mimetype=content_type_for(name), conditional=True, etag=etag, max_age=IMMUTABLE_MAX_AGE)
+                break
+            except FileNotFoundError:
+                # Evicted between the lookup and the open, make it again
+                continue
+        else:
+            return jsonify({'error': 'File was evicted while being served'}), 503
+
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers['Content-Disposition'] = 'inline; filename="{}"'.format(filename)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+@app.route('/strip', methods=['GET'])
+def get_strip():
+    """An hour of one rendition size in one response, see strips.py for the format.
+
+    Query parameters:
+      hour  ISO 8601 time within the hour, UTC unless an offset is given
+      size  one of the RENDITIONS names, thumb by default
+    Strips of past hours are immutable like /get-file. The current hour's
+    is still growing, it's revalidated on every request.
+    """
     try:
-        file_obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
-        file_content = file_obj['Body'].read()
-        mime_type = 'image/jpeg'  # Default MIME type
-        print(f'MIME type: {mime_type}')
-        
-        # Create a response object and set the Content-Disposition header to inline
-        response = Response(io.BytesIO(file_content), mimetype=mime_type)
-        response.headers['Content-Disposition'] = 'inline; filename="{}"'.format(file_key)
+        hour = parse_time_arg('hour')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if hour is None:
+        return jsonify({'error': 'hour parameter is required'}), 400
+    hour = floor_hour(hour.astimezone(timezone.utc))
+    size = request.args.get('size', 'thumb')
+    if size not in RENDITIONS:
+        return jsonify({'error': f"size must be one of {', '.join(RENDITIONS)}"}), 400
+
+    key = strip_key(size, hour)
+    if hour + timedelta(hours=1) + STRIP_GRACE > datetime.now(timezone.utc):
+        # Still being written by the capture loop
+        try:
+            strip = storage.get(key)
+        except ObjectNotFound:
+            return jsonify({'error': 'Strip not found'}), 404
+        except NoCredentialsError:
+            return jsonify({'error': 'Credentials not available'}), 403
+        response = Response(strip.data, mimetype=STRIP_CONTENT_TYPE)
+        response.set_etag(strip.info.etag.strip('"'))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    name = hashlib.sha1(key.encode()).hexdigest() + '.strip'
+    return serve_cached(name, lambda: storage.stream(key)[1], os.path.basename(key))
+
+def load_clip_frame(file_key, width):
+    """BGR frame of `file_key` for a clip `width` pixels wide.
+
+    Read from the smallest rendition at least that wide, through the same
+    disk cache as /get-file, so clips of frames viewers already looked at
+    (or of other clips) don't go back to storage.
+    """
+    fits = sorted((size_width, size) for size, size_width in RENDITIONS.items() if size_width >= width)
+    size = fits[0][1] if fits else 'full'
+    name = cache_name(file_key, size, None)
+    for _ in range(2):
+        path, _, _ = rendition_cache.fetch(name, lambda: load_file(file_key, size, None))
+        try:
+            with open(path, 'rb') as f:
+                return decode_image(f.read(), width)
+        except FileNotFoundError:
+            # Evicted between the lookup and the open, make it again
+            continue
+    raise IOError(f"{file_key} was evicted while being read")
+
+clip_renderer = ClipRenderer(DiskCache(CLIP_DIR, CLIP_MB * 1024 ** 2), load_clip_frame, CLIP_WORKERS, CLIP_QUEUE)
+
+def clip_response(job, status=200):
+    response = jsonify({**job.as_dict(), 'url': f'/clips/{job.id}', 'video_url': f'/clips/{job.id}/video'})
+    response.status_code = status
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/clips', methods=['POST'])
+def create_clip():
+    """Render a timelapse clip of a range of frames, in the background.
+
+    Parameters, as JSON or form fields:
+      since, until  ISO 8601 range, required, UTC unless an offset is given
+      fps           frames per second, 1-60, 30 by default
+      width         pixels, 16-3840, 1280 by default; height keeps the aspect
+      format        mp4 (default) or webm
+      step          every Nth frame of the range
+      session_id    only frames of this capture session (needs timelapse.db)
+    Answers 202 with the job, poll its url until status is done (or failed),
+    then fetch video_url. The same request for the same frames returns the
+    job already rendering, or 200 once its clip is in the cache.
+    """
+    values = request.get_json(silent=True) or request.values
+    try:
+        since = parse_time_arg('since', values)
+        until = parse_time_arg('until', values)
+        if since is None or until is None:
+            raise ValueError('since and until are required')
+        if since >= until:
+            raise ValueError('since must be before until')
+        fps = parse_int_arg('fps', 30, 1, values)
+        width = parse_int_arg('width', 1280, 16, values)
+        step = parse_int_arg('step', 1, 1, values)
+        session_id = parse_int_arg('session_id', None, 0, values)
+        if fps > MAX_CLIP_FPS:
+            raise ValueError(f'fps must be at most {MAX_CLIP_FPS}')
+        if width > MAX_CLIP_WIDTH:
+            raise ValueError(f'width must be at most {MAX_CLIP_WIDTH}')
+        video_format = values.get('format', 'mp4')
+        if video_format not in CLIP_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(CLIP_FORMATS)}")
+        if session_id is not None and frame_index is None:
+            raise ValueError('session_id needs the frame index (timelapse.db)')
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    params = ClipParams(since.astimezone(timezone.utc), until.astimezone(timezone.utc), fps, width, video_format, step, session_id)
+    if session_id is not None:
+        keys = [frame.key for frame in frame_index.range(params.since, params.until, session_id, step, MAX_CLIP_FRAMES + 1)]
+    else:
+        file_list.start()
+        entries, _ = file_list.snapshot()
+        keys = file_list.query(entries, since=params.since, until=params.until, step=step, limit=MAX_CLIP_FRAMES + 1)[0]
+    if not keys:
+        return jsonify({'error': 'No frames in that range'}), 404
+    if len(keys) > MAX_CLIP_FRAMES:
+        return jsonify({'error': f'More than {MAX_CLIP_FRAMES} frames, use a larger step'}), 400
+
+    clip_renderer.start()
+    try:
+        job = clip_renderer.submit(params, keys)
+    except queue.Full:
+        response = jsonify({'error': 'Too many clips rendering, try again later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
         return response
-    except s3.exceptions.NoSuchKey:
-        return jsonify({'error': 'File not found'}), 404
-    except NoCredentialsError:
-        return jsonify({'error': 'Credentials not available'}), 403
+    response = clip_response(job, 200 if job.status == DONE else 202)
+    response.headers['Location'] = f'/clips/{job.id}'
+    return response
+
+@app.route('/clips/<clip_id>', methods=['GET'])
+def get_clip(clip_id):
+    """Status of a clip job: queued, running, done or failed, with frames written so far."""
+    job = clip_renderer.get(clip_id)
+    if job is None:
+        return jsonify({'error': 'Clip not found'}), 404
+    return clip_response(job)
+
+@app.route('/clips/<clip_id>/video', methods=['GET'])
+def get_clip_video(clip_id):
+    """The rendered clip, immutable, with Range support for seeking."""
+    job = clip_renderer.get(clip_id)
+    if job is None:
+        return jsonify({'error': 'Clip not found'}), 404
+    if job.status != DONE:
+        return jsonify({'error': f'Clip is {job.status}', **job.as_dict()}), 409
+    video = clip_renderer.video(job)
+    if video is None:
+        # Evicted since, POST it again
+        return jsonify({'error': 'Clip no longer cached'}), 404
+
+    path, etag = video
+    try:
+        response = send_file(path, mimetype=job.content_type, conditional=True, etag=etag, max_age=IMMUTABLE_MAX_AGE)
+    except FileNotFoundError:
+        return jsonify({'error': 'Clip no longer cached'}), 404
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.headers['Content-Disposition'] = 'inline; filename="timelapse-{}{}"'.format(clip_id[:12], os.path.splitext(job.name)[1])
+    return response
 
 if __name__ == '__main__':
-    update_cache()
+    file_list.start()
     app.run(debug=True, host='0.0.0.0')